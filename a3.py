@@ -9,15 +9,294 @@
 # 49753193
 
 # a3.py
-from ds_messenger import DirectMessenger
+"""Direct messaging client.
+
+Without arguments a3.py runs the interactive menu. For scripting it takes
+subcommands that stream their input and output, reuse one authenticated
+connection and save the notebook in batches:
+
+    python a3.py -u alice send --from-file messages.jsonl
+    python a3.py -u alice fetch --since 2024-01-01 --out dump.jsonl
+    python a3.py -u alice sync
+
+Each line of a send file is a JSON object {"to": ..., "message": ...}; "-"
+reads standard input. Sends are streamed in constant memory, but fetch and
+sync receive the mailbox in a single response, so they hold every fetched
+message in memory at once and --since is applied on the client. The password comes from --password or the
+DSP_PASSWORD environment variable. --latency prints a summary of connect,
+round trip and decode times on exit.
+
+Exit status: 0 on success, 1 if any message failed, 2 on usage errors and
+3 if the server could not be reached or refused the login.
+"""
+from ds_messenger import DirectMessenger, LatencyAggregator, StartupTimer
 from notebook import Notebook, Diary
+from datetime import datetime
+import argparse
+import json
 import os
-import time
+import sys
+import threading
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_OFFLINE = 3
+NOTEBOOK_BATCH = 500  # diaries merged into the notebook at a time in bulk mode
+
+
+def parse_since(text):
+    """Parses a --since value, either seconds since the epoch or an ISO 8601 date."""
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a timestamp or ISO date: {text!r}") from None
+
+
+def read_sends(lines, counts):
+    """Yields (recipient, message) pairs from JSON lines, reporting bad lines on stderr."""
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        counts["read"] += 1
+        try:
+            item = json.loads(line)
+            recipient = item.get("to", item.get("recipient"))
+            message = item["message"]
+        except (ValueError, KeyError, AttributeError):
+            recipient = message = None
+        if not recipient or not isinstance(recipient, str) or not isinstance(message, str):
+            counts["invalid"] += 1
+            print(f"line {number}: expected {{\"to\": ..., \"message\": ...}}", file=sys.stderr)
+            continue
+        yield recipient, message
+
+
+def diary_of(m):
+    """The notebook diary of a retrieved or sent message, or None if it has no peer or timestamp."""
+    if m.sender:
+        entry = f"{m.sender} → You: {m.message}"
+    elif m.recipient:
+        entry = f"You → {m.recipient}: {m.message}"
+    else:
+        return None
+    try:
+        return Diary(entry=entry, timestamp=float(m.timestamp))
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_batch(notebook, diaries):
+    """Merges a batch of diaries into the notebook, schedules a save and empties the batch."""
+    result = notebook.merge_diaries(diaries)
+    if result.inserted:
+        notebook.mark_dirty()
+    diaries.clear()
+    return result
+
+
+def send_command(args, messenger, notebook):
+    """Sends every message of a JSON lines file over one connection."""
+    counts = {"read": 0, "invalid": 0, "sent": 0, "failed": 0}
+    source = sys.stdin if args.from_file == "-" else open(args.from_file, encoding="utf-8")
+    batch = []
+    try:
+        for recipient, _, stored in messenger.send_many(read_sends(source, counts)):
+            if stored is not None:
+                counts["sent"] += 1
+                # Stored with the server's timestamp, so a later sync recognizes the fetched copy
+                batch.append(diary_of(stored))
+                if len(batch) >= NOTEBOOK_BATCH:
+                    merge_batch(notebook, batch)
+            else:
+                counts["failed"] += 1
+                print(f"Send to {recipient} failed.", file=sys.stderr)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        merge_batch(notebook, batch)
+    unsent = counts["read"] - counts["invalid"] - counts["sent"] - counts["failed"]
+    print(f"Sent {counts['sent']} messages, {counts['failed']} failed, {counts['invalid']} invalid.")
+    if messenger.error is not None and (unsent or counts["failed"]):
+        print(f"Stopped: {messenger.error}", file=sys.stderr)
+    return EXIT_OK if counts["sent"] == counts["read"] else EXIT_FAILED
+
+
+def fetch_command(args, messenger, notebook):
+    """Writes fetched messages as JSON lines and stores them in the notebook.
+
+    The whole mailbox is fetched in one response, so memory is O(mailbox);
+    only the output and the notebook merges are streamed.
+    """
+    msgs = messenger.retrieve_new() if args.unread else messenger.retrieve_all()
+    if messenger.error is not None:
+        print(f"Fetch failed: {messenger.error}", file=sys.stderr)
+        return EXIT_FAILED
+    out = sys.stdout if args.out in (None, "-") else open(args.out, "w", encoding="utf-8")
+    written = 0
+    batch = []
+    try:
+        for m in msgs:
+            diary = diary_of(m)
+            if diary is None:
+                continue
+            batch.append(diary)
+            if len(batch) >= NOTEBOOK_BATCH:
+                merge_batch(notebook, batch)
+            if args.since is not None and diary.timestamp < args.since:
+                continue
+            record = {"id": m.id, "message": m.message, "timestamp": diary.timestamp}
+            record.update({"from": m.sender} if m.sender else {"recipient": m.recipient})
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            written += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        merge_batch(notebook, batch)
+    print(f"Exported {written} messages.", file=sys.stderr if out is sys.stdout else sys.stdout)
+    return EXIT_OK
+
+
+def sync_command(args, messenger, notebook):  # pylint: disable=unused-argument
+    """Merges every message on the server into the notebook."""
+    msgs = messenger.retrieve_all()
+    if messenger.error is not None:
+        print(f"Sync failed: {messenger.error}", file=sys.stderr)
+        return EXIT_FAILED
+    inserted = skipped = 0
+    batch = []
+    for i, m in enumerate(msgs, 1):
+        diary = diary_of(m)
+        if diary is not None:
+            batch.append(diary)
+        if len(batch) >= NOTEBOOK_BATCH or i == len(msgs):
+            result = merge_batch(notebook, batch)
+            inserted += result.inserted
+            skipped += result.skipped
+    print(f"Synced {inserted} new messages ({skipped} already stored).")
+    return EXIT_OK
+
+
+COMMANDS = {"send": send_command, "fetch": fetch_command, "sync": sync_command}
+
 
-def main():
+def open_notebook(username, password, path):
+    """Loads the user's notebook from path, or creates a new one if it does not exist."""
+    notebook = Notebook(username=username, password=password, bio="Default bio")
+    if os.path.exists(path):
+        notebook.load(path)
+    return notebook
+
+
+def parse_args(argv):
+    """Parses the bulk mode command line."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0],
+                                     epilog="Run without arguments for the interactive menu.")
+    parser.add_argument("-u", "--username", required=True)
+    parser.add_argument("-p", "--password", default=os.environ.get("DSP_PASSWORD"),
+                        help="defaults to the DSP_PASSWORD environment variable")
+    parser.add_argument("-s", "--server", default="127.0.0.1", help="DSP server address")
+    parser.add_argument("--notebook", help="notebook file, <username>.json by default")
+    parser.add_argument("--latency", action="store_true",
+                        help="print a client latency summary to stderr on exit")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send = commands.add_parser("send", help="send messages from a JSON lines file")
+    send.add_argument("--from-file", required=True, metavar="PATH",
+                      help='JSON lines of {"to": ..., "message": ...}, or - for stdin')
+
+    fetch = commands.add_parser("fetch", help="export messages as JSON lines",
+                                description="Export messages as JSON lines. The mailbox arrives in one "
+                                            "response, so memory use grows with its size.")
+    fetch.add_argument("--since", type=parse_since, metavar="TIME",
+                       help="only export messages from this time on (epoch seconds or ISO date); "
+                            "filtered after the whole mailbox is fetched")
+    fetch.add_argument("--unread", action="store_true", help="only fetch unread messages")
+    fetch.add_argument("--out", metavar="PATH", help="output file, standard output by default")
+
+    commands.add_parser("sync", help="merge every message on the server into the notebook",
+                        description="Merge every message on the server into the notebook. The mailbox "
+                                    "arrives in one response, so memory use grows with its size.")
+
+    args = parser.parse_args(argv)
+    if args.password is None:
+        parser.error("a password is required (--password or DSP_PASSWORD)")
+    return args
+
+
+def connect_in_background(messenger, startup):
+    """Starts authenticating the messenger on a thread and returns the thread."""
+    def connect():
+        if messenger.connect():
+            startup.mark("online")
+
+    thread = threading.Thread(target=connect, daemon=True)
+    thread.start()
+    return thread
+
+
+def ensure_online(messenger, connecting):
+    """Waits for the background login, retrying once if it failed; prints why if still offline."""
+    connecting.join()
+    if messenger.connect():
+        return True
+    print(f"Offline: {messenger.error}")
+    return False
+
+
+def run(argv):
+    """Runs one bulk mode subcommand and returns the exit status."""
+    args = parse_args(argv)
+    startup = StartupTimer()
+    latency = LatencyAggregator()
+    messenger = DirectMessenger(dsuserver=args.server, username=args.username, password=args.password,
+                                hooks=[latency] if args.latency else None, autoconnect=False)
+    # Log in while the notebook loads
+    connecting = connect_in_background(messenger, startup)
+    notebook_path = args.notebook or f"{args.username}.json"
+    try:
+        notebook = open_notebook(args.username, args.password, notebook_path)
+    except Exception as e:  # pylint: disable=broad-except
+        print(f"Failed to load notebook: {e}", file=sys.stderr)
+        return EXIT_FAILED
+    startup.mark("notebook")
+    notebook.enable_autosave(notebook_path)
+
+    connecting.join()
+    try:
+        if not messenger.authenticated:
+            print(f"Failed to authenticate: {messenger.error}", file=sys.stderr)
+            return EXIT_OFFLINE
+        return COMMANDS[args.command](args, messenger, notebook)
+    finally:
+        notebook.flush()
+        if args.latency:
+            print(startup.summary(), file=sys.stderr)
+            print(latency.summary(), file=sys.stderr)
+
+
+def main(argv=None):
+    """Runs the subcommand given on the command line, or the interactive menu without arguments."""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return run(argv)
+    interactive()
+    return EXIT_OK
+
+
+def interactive():
     username = input("Enter your username: ")
     password = input("Enter your password: ")
 
+    # Connect to server in the background, the menu works offline until it is needed
+    startup = StartupTimer()
+    latency = LatencyAggregator()
+    messenger = DirectMessenger(username=username, password=password, hooks=[latency], autoconnect=False)
+    connecting = connect_in_background(messenger, startup)
+
     # Notebook setup
     notebook_path = f"{username}.json"
     notebook = Notebook(username=username, password=password, bio="Default bio")
@@ -29,69 +308,69 @@ def main():
             print("Failed to load notebook.")
     else:
         print("New notebook created.")
-
-    # Connect to server
-    messenger = DirectMessenger(username=username, password=password)
-
-    if not messenger.authenticated:
-        print("Failed to authenticate.")
-        return
+    notebook.enable_autosave(notebook_path)
+    startup.mark("notebook")
 
     while True:
-        print("\n1. Send Message\n2. Fetch New\n3. Fetch All\n4. Exit")
+        startup.mark("menu")
+        print("\n1. Send Message\n2. Fetch New\n3. Fetch All\n4. Exit\n5. Latency Summary")
         choice = input("Select: ")
+        if choice in ("1", "2", "3") and not ensure_online(messenger, connecting):
+            continue
+
         if choice == "1":
             recipient = input("To: ")
             msg = input("Message: ")
-            if messenger.send(msg, recipient):
+            stored = messenger.send_message(msg, recipient)
+            if stored is not None:
                 print("Message sent!")
 
-                # Save to notebook
-                entry = f"You → {recipient}: {msg}"
-                diary = Diary(entry=entry, timestamp=time.time())
-                notebook.add_diary(diary)
-                if recipient not in notebook.contacts:
-                    notebook.contacts.append(recipient)
-                notebook.save(notebook_path)
+                # Save to notebook with the server's timestamp
+                notebook.add_diary(diary_of(stored))
+                notebook.add_contact(recipient)
+                notebook.mark_dirty()
             else:
                 print("Send failed.")
 
         elif choice == "2":
             msgs = messenger.retrieve_new()
+            diaries = []
             for m in msgs:
                 print(f"[NEW] {m.sender}: {m.message}")
+                diary = diary_of(m)
+                if diary is not None:
+                    diaries.append(diary)
 
-                # Save to notebook
-                entry = f"{m.sender} → You: {m.message}"
-                diary = Diary(entry=entry, timestamp=float(m.timestamp))
-                notebook.add_diary(diary)
-                if m.sender not in notebook.contacts:
-                    notebook.contacts.append(m.sender)
-            notebook.save(notebook_path)
+            # Save to notebook
+            if notebook.merge_diaries(diaries).inserted:
+                notebook.mark_dirty()
 
         elif choice == "3":
             msgs = messenger.retrieve_all()
+            diaries = []
             for m in msgs:
                 if m.sender:
                     print(f"{m.sender} → you: {m.message}")
-                    entry = f"{m.sender} → You: {m.message}"
-                    name = m.sender
                 elif m.recipient:
                     print(f"you → {m.recipient}: {m.message}")
-                    entry = f"You → {m.recipient}: {m.message}"
-                    name = m.recipient
-                else:
-                    continue
-
-                # Save to notebook
-                diary = Diary(entry=entry, timestamp=float(m.timestamp))
-                notebook.add_diary(diary)
-                if name and name not in notebook.contacts:
-                    notebook.contacts.append(name)
-            notebook.save(notebook_path)
+                diary = diary_of(m)
+                if diary is not None:
+                    diaries.append(diary)
+
+            # Save to notebook
+            result = notebook.merge_diaries(diaries)
+            print(f"Saved {result.inserted} new messages ({result.skipped} already stored).")
+            if result.inserted:
+                notebook.mark_dirty()
 
         elif choice == "4":
             break
 
+        elif choice == "5":
+            print(startup.summary())
+            print(latency.summary())
+
+    notebook.flush()
+
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Micro-benchmarks for the ds_protocol, ds_messenger and notebook hot paths.
+
+Each case is timed with timeit and reported as the best seconds per call.
+Results can be stored as a baseline and later runs checked against it:
+
+    python bench_micro.py --save-baseline bench_baseline.json
+    python bench_micro.py --check bench_baseline.json --threshold 0.25
+
+The check exits with status 1 if any case is slower than the baseline by
+more than the threshold fraction.
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+from ds_protocol import (
+    create_auth_message,
+    create_direct_message,
+    create_fetch_message,
+    encode_frame,
+    extract_json
+)
+from ds_messenger import DirectMessage
+from notebook import Notebook, Diary
+
+DEFAULT_SIZES = (1000, 10000, 100000, 1000000)
+QUICK_SIZES = (1000, 10000)
+DEFAULT_THRESHOLD = 0.25
+LARGE_RESPONSE_MESSAGES = 100000
+
+
+def _fetch_response(count: int) -> dict:
+    """Builds a fetch response with count messages."""
+    messages = [{"from": f"user{i % 50}", "message": f"message number {i}",
+                 "timestamp": str(1700000000.0 + i)} for i in range(count)]
+    return {"response": {"type": "ok", "messages": messages}}
+
+
+def _make_direct_message():
+    """Constructs a DirectMessage the way DirectMessenger does."""
+    dm = DirectMessage()
+    dm.message = "hello there"
+    dm.timestamp = "1700000000.0"
+    dm.sender = "alice"
+    dm.recipient = None
+    return dm
+
+
+def time_call(func, min_time: float = 0.2, repeat: int = 5) -> float:
+    """
+    Returns the best observed seconds per call of func.
+
+    Args:
+        func (Callable): Zero-argument callable to time.
+        min_time (float): Minimum seconds each repeat should run for.
+        repeat (int): Number of repeats; the fastest one is reported.
+
+    Returns:
+        float: Seconds per call.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 10 ** 7:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    best = min([elapsed] + timer.repeat(repeat - 1, number)) if repeat > 1 else elapsed
+    return best / number
+
+
+def protocol_cases() -> dict:
+    """Returns the ds_protocol and DirectMessage cases."""
+    small = json.dumps({"response": {"type": "ok", "message": "Welcome back, alice!",
+                                     "token": "abcd1234-abcd-abcd-abcd-abcdefabcdef"}})
+    response = _fetch_response(LARGE_RESPONSE_MESSAGES)
+    large = json.dumps(response)
+    frame = encode_frame(response)
+    return {
+        "create_auth_message": lambda: create_auth_message("alice", "secret"),
+        "create_direct_message": lambda: create_direct_message("tok", "hello there", "bob",
+                                                                1700000000.0),
+        "create_fetch_message": lambda: create_fetch_message("tok", "unread"),
+        "extract_json_small": lambda: extract_json(small),
+        f"extract_json_{LARGE_RESPONSE_MESSAGES}": lambda: extract_json(large),
+        f"encode_frame_{LARGE_RESPONSE_MESSAGES}": lambda: encode_frame(response),
+        f"extract_frame_{LARGE_RESPONSE_MESSAGES}": lambda: extract_json(frame),
+        "direct_message_construct": _make_direct_message,
+    }
+
+
+def notebook_cases(sizes, tmpdir: str) -> dict:
+    """Returns Notebook.save and Notebook.load cases for each size."""
+    cases = {}
+    for size in sizes:
+        notebook = Notebook("alice", "secret", "bio")
+        for i in range(size):
+            notebook.add_diary(Diary(f"user{i % 50} → You: message number {i}", 1700000000.0 + i))
+        path = os.path.join(tmpdir, f"notebook_{size}.json")
+        notebook.save(path)
+        cases[f"notebook_save_{size}"] = lambda n=notebook, p=path: n.save(p)
+        cases[f"notebook_load_{size}"] = lambda p=path: Notebook("", "", "").load(p)
+    return cases
+
+
+def run(sizes=DEFAULT_SIZES, min_time: float = 0.2, repeat: int = 5) -> dict:
+    """
+    Runs every case and returns a mapping of case name to seconds per call.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cases = protocol_cases()
+        cases.update(notebook_cases(sizes, tmpdir))
+        for name, func in cases.items():
+            results[name] = time_call(func, min_time, repeat)
+            print(f"{name:32} {results[name] * 1e6:14.3f} us", file=sys.stderr)
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float = DEFAULT_THRESHOLD) -> list:
+    """
+    Compares results against a baseline.
+
+    Args:
+        results (dict): Case name to seconds per call for this run.
+        baseline (dict): Case name to seconds per call from the baseline.
+        threshold (float): Allowed slowdown as a fraction, e.g. 0.25 for 25%.
+
+    Returns:
+        list: (name, baseline, current, ratio) tuples for regressed cases.
+    """
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get(name)
+        if base and current > base * (1 + threshold):
+            regressions.append((name, base, current, current / base))
+    return regressions
+
+
+def main(argv=None) -> int:
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true",
+                        help=f"only time notebooks of {QUICK_SIZES} diaries")
+    parser.add_argument("--sizes", type=lambda v: tuple(int(x) for x in v.split(",")),
+                        help="comma separated notebook sizes")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum seconds per timing repeat")
+    parser.add_argument("--repeat", type=int, default=5, help="timing repeats per case")
+    parser.add_argument("--out", help="write JSON results to this file")
+    parser.add_argument("--save-baseline", metavar="PATH", help="store results as a baseline")
+    parser.add_argument("--check", metavar="PATH", help="compare results against a baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slowdown fraction before --check fails")
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (QUICK_SIZES if args.quick else DEFAULT_SIZES)
+    results = run(sizes, args.min_time, args.repeat)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+
+    if args.check:
+        with open(args.check, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, base, current, ratio in regressions:
+            print(f"REGRESSION {name}: {base * 1e6:.3f} us -> {current * 1e6:.3f} us "
+                  f"({ratio:.2f}x)", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,346 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Load-generation and latency benchmark for DSUServer.
+
+Starts server.py on a free local port with a temporary store directory and
+drives concurrent simulated users through the real DSP protocol messages.
+Results are written as JSON so runs can be compared across commits.
+
+Example:
+    python bench_server.py --users 20 --duration 30 --mix auth=1,send=5,unread=3,all=1
+"""
+
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from ds_protocol import (
+    create_auth_message,
+    create_direct_message,
+    create_fetch_message,
+    extract_json
+)
+
+COMMANDS = ("auth", "send", "unread", "all")
+DEFAULT_MIX = "auth=1,send=5,unread=3,all=1"
+SERVER_PATH = Path(__file__).resolve().parent / "server.py"
+NO_RATE_LIMITS = ("--user-limit", "0", "--address-limit", "0", "--fetch-all-limit", "0")
+
+
+def parse_mix(text: str) -> dict:
+    """
+    Parses a command mix such as "auth=1,send=5" into weights.
+
+    Args:
+        text (str): Comma separated command=weight pairs.
+
+    Returns:
+        dict: Mapping of command name to weight.
+
+    Raises:
+        ValueError: If a command is unknown or no weight is positive.
+    """
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in COMMANDS:
+            raise ValueError(f"Unknown command in mix: {name!r}")
+        mix[name] = float(weight or 1)
+    if not any(w > 0 for w in mix.values()):
+        raise ValueError("Command mix needs at least one positive weight")
+    return mix
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    """
+    Returns the nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(sorted_values))))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def free_port() -> int:
+    """
+    Asks the OS for a free local TCP port.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class Connection:
+    """A DSP client connection that sends one command and reads one response."""
+
+    def __init__(self, host: str, port: int):
+        """Opens the socket and line-based reader and writer."""
+        self.sock = socket.create_connection((host, port))
+        self.send_file = self.sock.makefile("w")
+        self.recv_file = self.sock.makefile("r")
+
+    def request(self, payload: str):
+        """Sends a command and returns the parsed DSPResponse."""
+        self.send_file.write(payload + "\r\n")
+        self.send_file.flush()
+        return extract_json(self.recv_file.readline())
+
+    def close(self):
+        """Closes the connection."""
+        self.sock.close()
+
+
+class SimulatedUser(threading.Thread):
+    """Runs a weighted random mix of commands against the server."""
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, index, host, port, usernames, mix, deadline, recorder):
+        """Creates a user that runs until the deadline."""
+        super().__init__(daemon=True)
+        self.username = usernames[index]
+        self.password = f"pw-{index}"
+        self.host = host
+        self.port = port
+        self.peers = [u for u in usernames if u != self.username] or usernames
+        self.commands = list(mix)
+        self.weights = [mix[c] for c in self.commands]
+        self.deadline = deadline
+        self.recorder = recorder
+        self.rng = random.Random(index)
+        self.conn = None
+        self.token = None
+
+    def login(self):
+        """Opens a connection and authenticates, returning the response."""
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = Connection(self.host, self.port)
+        resp = self.conn.request(create_auth_message(self.username, self.password))
+        self.token = resp.token if resp.type == "ok" else None
+        return resp
+
+    def run_command(self, command: str):
+        """Executes one command and returns its response."""
+        if command == "auth":
+            return self.login()
+        if command == "send":
+            msg = create_direct_message(self.token, f"bench message {self.rng.random()}",
+                                        self.rng.choice(self.peers), time.time())
+            return self.conn.request(msg)
+        return self.conn.request(create_fetch_message(self.token, command))
+
+    def run(self):
+        """Issues commands until the deadline, recording their latencies."""
+        try:
+            self.login()
+        except OSError:
+            self.recorder.record("auth", 0.0, False)
+            return
+        while time.perf_counter() < self.deadline:
+            command = self.rng.choices(self.commands, self.weights)[0]
+            start = time.perf_counter()
+            try:
+                ok = self.run_command(command).type == "ok"
+            except OSError:
+                ok = False
+            self.recorder.record(command, time.perf_counter() - start, ok)
+            if not ok and command != "auth":
+                try:
+                    self.login()
+                except OSError:
+                    pass
+        if self.conn is not None:
+            self.conn.close()
+
+
+class Recorder:
+    """Collects per-command latencies from all simulated users."""
+
+    def __init__(self):
+        """Creates empty latency and error tables."""
+        self.lock = threading.Lock()
+        self.latencies = {c: [] for c in COMMANDS}
+        self.errors = {c: 0 for c in COMMANDS}
+
+    def record(self, command: str, seconds: float, ok: bool):
+        """Records one command result."""
+        with self.lock:
+            if ok:
+                self.latencies[command].append(seconds)
+            else:
+                self.errors[command] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        """Returns throughput and latency percentiles (in ms) per command."""
+        result = {}
+        for command in COMMANDS:
+            values = sorted(self.latencies[command])
+            if not values and not self.errors[command]:
+                continue
+            result[command] = {
+                "count": len(values),
+                "errors": self.errors[command],
+                "throughput": len(values) / elapsed,
+                "mean_ms": 1000 * sum(values) / len(values) if values else 0.0,
+                "p50_ms": 1000 * percentile(values, 50),
+                "p95_ms": 1000 * percentile(values, 95),
+                "p99_ms": 1000 * percentile(values, 99),
+            }
+        return result
+
+
+def start_server(port: int, store_dir: str, server_args=()) -> subprocess.Popen:
+    """
+    Starts server.py in a subprocess and waits until it accepts connections.
+
+    Args:
+        port (int): Port for the server to listen on.
+        store_dir (str): Store directory for the server.
+        server_args (tuple): Extra server.py command line options.
+
+    Raises:
+        RuntimeError: If the server does not come up within 10 seconds.
+    """
+    proc = subprocess.Popen(
+        [sys.executable, str(SERVER_PATH), str(port), store_dir, *server_args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("Server did not start listening in time")
+
+
+def sample_store_size(users_path: Path, stop: threading.Event, interval: float, start: float, out: list):
+    """
+    Appends [elapsed_seconds, bytes] samples of the store file until stopped.
+    """
+    while True:
+        try:
+            size = os.path.getsize(users_path)
+        except OSError:
+            size = 0
+        out.append([round(time.perf_counter() - start, 3), size])
+        if stop.wait(interval):
+            return
+
+
+def git_revision() -> str:
+    """
+    Returns the current git commit hash, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=SERVER_PATH.parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(users: int, duration: float, mix: dict, sample_interval: float = 1.0,
+                  rate_limits: bool = False) -> dict:
+    """
+    Runs a complete benchmark and returns the results as a dict.
+
+    Args:
+        users (int): Number of concurrent simulated users.
+        duration (float): Seconds to run the load for.
+        mix (dict): Command weights as returned by parse_mix.
+        sample_interval (float): Seconds between store size samples.
+        rate_limits (bool): Keep the server's default rate limits instead of disabling them.
+
+    Returns:
+        dict: Configuration, per-command statistics and store size samples.
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store_dir = os.path.join(tmpdir, "store")
+        port = free_port()
+        proc = start_server(port, store_dir, () if rate_limits else NO_RATE_LIMITS)
+        try:
+            usernames = [f"bench{i}" for i in range(users)]
+            # Register every user first so direct messages have recipients
+            for i, name in enumerate(usernames):
+                conn = Connection("127.0.0.1", port)
+                conn.request(create_auth_message(name, f"pw-{i}"))
+                conn.close()
+
+            recorder = Recorder()
+            sizes = []
+            stop = threading.Event()
+            start = time.perf_counter()
+            sampler = threading.Thread(
+                target=sample_store_size,
+                args=(Path(store_dir) / "users.json", stop, sample_interval, start, sizes),
+                daemon=True
+            )
+            sampler.start()
+            workers = [SimulatedUser(i, "127.0.0.1", port, usernames, mix, start + duration, recorder)
+                       for i in range(users)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            elapsed = time.perf_counter() - start
+            stop.set()
+            sampler.join()
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    commands = recorder.summary(elapsed)
+    return {
+        "revision": git_revision(),
+        "config": {"users": users, "duration": duration, "mix": mix, "rate_limits": rate_limits},
+        "elapsed": elapsed,
+        "throughput": sum(c["count"] for c in commands.values()) / elapsed,
+        "commands": commands,
+        "store_size": sizes
+    }
+
+
+def main(argv=None) -> int:
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10, help="concurrent simulated users")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="command weights, e.g. " + DEFAULT_MIX)
+    parser.add_argument("--sample-interval", type=float, default=1.0,
+                        help="seconds between store size samples")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the server's default rate limits (disabled by default)")
+    parser.add_argument("--out", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    results = run_benchmark(args.users, args.duration, mix, args.sample_interval, args.rate_limits)
+    text = json.dumps(results, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Structured, queue-based logging shared by the DSP server and client.
+
+Records are handed to a queue on the calling thread and formatted and
+written by a background listener, so logging never blocks a request on
+stdout. Payload dumps are sampled and skipped entirely unless DEBUG
+logging is enabled.
+"""
+
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+LOGGER_NAME = "dsp"
+PAYLOAD_SAMPLE_RATE = 1.0  # Fraction of payloads dumped when DEBUG logging is on
+
+_RESERVED = frozenset(logging.LogRecord(
+    "", logging.INFO, "", 0, "", (), None).__dict__) | {"message", "asctime"}
+_connection_ids = itertools.count(1)
+_listener = None
+_payload_sample_rate = PAYLOAD_SAMPLE_RATE
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, including extra fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Returns the JSON line for a record."""
+        entry = {
+            "ts": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=repr)
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Returns a logger below the shared "dsp" logger.
+
+    Args:
+        name (str): Child logger name, e.g. "server" or "client".
+    """
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def setup_logging(level: int = logging.INFO, stream=None,
+                  sample_rate: float = PAYLOAD_SAMPLE_RATE) -> logging.handlers.QueueListener:
+    """
+    Routes "dsp" logging through a queue to a background JSON writer.
+
+    Calling it again replaces the previous configuration.
+
+    Args:
+        level (int): Minimum level to log.
+        stream: Where the listener writes lines; defaults to sys.stdout.
+        sample_rate (float): Fraction of payloads dumped by RequestLogger.payload.
+
+    Returns:
+        QueueListener: The running listener, stopped automatically at exit.
+    """
+    global _listener, _payload_sample_rate  # pylint: disable=global-statement
+    shutdown_logging()
+
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    _payload_sample_rate = sample_rate
+    return _listener
+
+
+def shutdown_logging() -> None:
+    """Stops the background listener after it drains queued records."""
+    global _listener  # pylint: disable=global-statement
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+class RequestLogger(logging.LoggerAdapter):
+    """Adds connection and request IDs to every record of one connection."""
+
+    def __init__(self, logger: logging.Logger, **fields):
+        """Assigns a new connection ID; extra fields are attached to every record."""
+        super().__init__(logger, {"conn": next(_connection_ids), **fields})
+        self._requests = itertools.count(1)
+        self.request_id = None
+
+    def next_request(self) -> str:
+        """Starts a new request on this connection and returns its ID."""
+        self.request_id = f"{self.extra['conn']}-{next(self._requests)}"
+        return self.request_id
+
+    def process(self, msg, kwargs):
+        """Merges the connection fields and current request ID into the record."""
+        extra = dict(self.extra)
+        if self.request_id is not None:
+            extra["request_id"] = self.request_id
+        extra.update(kwargs.get("extra") or {})
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+    def payload(self, direction: str, data) -> None:
+        """
+        Dumps a sampled raw payload at DEBUG level.
+
+        Costs a single level check when DEBUG logging is off.
+
+        Args:
+            direction (str): "in" or "out".
+            data: The payload as sent or received.
+        """
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if _payload_sample_rate < 1.0 and random.random() >= _payload_sample_rate:
+            return
+        self.debug("payload %s %r", direction, data,
+                   extra={"direction": direction, "bytes": len(data)})
+
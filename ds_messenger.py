@@ -3,15 +3,33 @@
 # STUDENT ID: 49753193
 """Messenger client to handle DSP socket communication and message formatting."""
 
+import json
+import random
 import socket
+import threading
 import time
+from collections import deque
+from ds_logging import get_logger, RequestLogger
 from ds_protocol import (
+    BINARY_ENCODING,
+    ZLIB_ENCODING,
     create_auth_message,
     create_direct_message,
     create_fetch_message,
-    extract_json
+    create_search_message,
+    create_conversation_message,
+    encode_frame,
+    extract_json,
+    read_message
 )
 
+logger = get_logger("client")
+
+SEND_RETRIES = 5  # Times send_many retries a message the server asked to retry later
+TIMING_EVENTS = ("connect", "auth", "command", "decode")  # Events whose value is seconds
+BYTE_EVENTS = ("bytes_sent", "bytes_received")  # Events whose value is a byte count
+LATENCY_WINDOW = 1000  # Recent samples per event kept by LatencyAggregator
+
 
 class DirectMessage:
     """Simple structure to represent a direct message."""
@@ -22,6 +40,7 @@ class DirectMessage:
         self.message = None
         self.sender = None
         self.timestamp = None
+        self.id = None  # pylint: disable=invalid-name
 
     def __str__(self):
         """Returns a formatted string representation of the message."""
@@ -34,34 +53,238 @@ class DirectMessage:
         return bool(self.message and self.recipient)
 
 
+class LatencyAggregator:
+    """Collects DirectMessenger timing events and summarizes them.
+
+    An instance is itself a hook: pass it in DirectMessenger(hooks=[...])
+    or to add_hook. Percentiles are computed over the most recent samples
+    of each event; counts and totals cover the whole session. Hooks are
+    called from whichever thread runs the messenger, so access is locked.
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        """Creates an empty aggregator keeping window samples per event."""
+        self.window = window
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.totals = {}
+        self.samples = {}
+
+    def __call__(self, event: str, value: float) -> None:
+        """Records one event."""
+        with self.lock:
+            self.counts[event] = self.counts.get(event, 0) + 1
+            self.totals[event] = self.totals.get(event, 0) + value
+            if event not in BYTE_EVENTS:
+                self.samples.setdefault(event, deque(maxlen=self.window)).append(value)
+
+    def snapshot(self) -> dict:
+        """Returns per-event counts and totals, with latency percentiles in ms for timings."""
+        with self.lock:
+            result = {}
+            for event, count in self.counts.items():
+                entry = {"count": count, "total": self.totals[event]}
+                values = sorted(self.samples.get(event, ()))
+                if values:
+                    entry.update({
+                        "mean_ms": 1000 * sum(values) / len(values),
+                        "p50_ms": 1000 * values[(len(values) - 1) // 2],
+                        "p95_ms": 1000 * values[min(len(values) - 1, int(len(values) * 0.95))],
+                        "max_ms": 1000 * values[-1],
+                    })
+                result[event] = entry
+            return result
+
+    def summary(self) -> str:
+        """Returns a printable table of the recorded events."""
+        stats = self.snapshot()
+        if not stats:
+            return "No requests timed yet."
+        lines = [f"{'phase':10} {'count':>7} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}"]
+        for event in TIMING_EVENTS:
+            if event in stats:
+                s = stats[event]
+                lines.append(f"{event:10} {s['count']:7} {s['mean_ms']:9.2f} {s['p50_ms']:9.2f} "
+                             f"{s['p95_ms']:9.2f} {s['max_ms']:9.2f}")
+        sent = stats.get("bytes_sent", {}).get("total", 0)
+        received = stats.get("bytes_received", {}).get("total", 0)
+        lines.append(f"{sent} bytes sent, {received} bytes received")
+        return "\n".join(lines)
+
+
+class StartupTimer:
+    """Records how long after startup each startup phase was first reached."""
+
+    def __init__(self):
+        """Starts the clock."""
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase: str) -> float:
+        """Records that phase was reached, unless it already was, and returns its time in seconds."""
+        return self.phases.setdefault(phase, time.perf_counter() - self.start)
+
+    def summary(self) -> str:
+        """Returns the phases in the order they were reached, in milliseconds."""
+        if not self.phases:
+            return "startup: no phases recorded"
+        return "startup: " + ", ".join(f"{phase} {1000 * seconds:.1f} ms"
+                                       for phase, seconds in self.phases.items())
+
+
+class PollScheduler:
+    """Computes delays between polls for new messages.
+
+    Polls run every active_interval seconds while a conversation is active,
+    fall back to base_interval afterwards and back off exponentially up to
+    max_interval while nothing arrives. Every delay is jittered so that
+    clients started together do not poll the server in lockstep, and a
+    server-suggested retry_after is always honored.
+    """
+
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+    def __init__(self, active_interval=1.0, base_interval=5.0, max_interval=60.0,
+                 backoff=2.0, jitter=0.2, active_window=30.0):
+        """Initializes the scheduler with intervals given in seconds."""
+        self.active_interval = active_interval
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.jitter = jitter
+        self.active_window = active_window
+        self.idle_polls = 0
+        self._last_activity = None
+
+    def mark_activity(self):
+        """Records user or conversation activity, switching to fast polling."""
+        self._last_activity = time.monotonic()
+        self.idle_polls = 0
+
+    def is_active(self) -> bool:
+        """Returns True if there was activity within the active window."""
+        return (self._last_activity is not None
+                and time.monotonic() - self._last_activity < self.active_window)
+
+    def initial_delay(self) -> float:
+        """Returns a random first delay so that a fleet of clients spreads out."""
+        return random.uniform(0, self.base_interval)
+
+    def next_delay(self, got_messages: bool = False, retry_after: float = None) -> float:
+        """Returns the number of seconds to wait before the next poll.
+
+        Args:
+            got_messages (bool): Whether the last poll returned new messages.
+            retry_after (float): Minimum delay suggested by the server, if any.
+
+        Returns:
+            float: The jittered delay in seconds.
+        """
+        if got_messages:
+            self.mark_activity()
+
+        if self.is_active():
+            delay = self.active_interval
+        else:
+            delay = min(self.max_interval, self.base_interval * self.backoff ** self.idle_polls)
+            if delay < self.max_interval:  # Stop counting at the cap so the power cannot overflow
+                self.idle_polls += 1
+
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        if retry_after:
+            delay = max(delay, retry_after)
+        return delay
+
+
 class DirectMessenger:
     """Handles connection, authentication, sending, and receiving messages over DSP."""
 
-    def __init__(self, dsuserver=None, username=None, password=None):
-        """Initializes DirectMessenger and attempts authentication."""
+    # pylint: disable=too-many-arguments
+    def __init__(self, dsuserver=None, username=None, password=None, binary=False,
+                 compress=False, hooks=None, autoconnect=True):
+        """Initializes DirectMessenger and attempts authentication.
+
+        Args:
+            dsuserver (str): Server address.
+            username (str): Account name.
+            password (str): Account password.
+            binary (bool): Offer the compact binary encoding when authenticating;
+                the server decides whether it is used.
+            compress (bool): Offer zlib so the server may compress large responses.
+            hooks (list): Callables invoked as hook(event, value) for every
+                timing event; see add_hook.
+            autoconnect (bool): Authenticate right away. If False the
+                messenger starts offline until connect() is called, which
+                lets callers authenticate on a background thread.
+        """
         self.dsuserver = dsuserver or '127.0.0.1'
         self.port = 3001
         self.username = username
         self.password = password
+        self.binary = binary
+        self.compress = compress
         self.token = None
-        self.authenticated = self._authenticate()
+        self.retry_after = None
+        self.cursor = None
+        self.version = None
+        self.versions = {}
+        self.error = None
+        self.hooks = list(hooks or [])
+        self.authenticated = False
+        if autoconnect:
+            self.connect()
+
+    def connect(self) -> bool:
+        """Authenticates with the server unless already authenticated.
+
+        Returns:
+            bool: Whether the messenger is now online; if not, self.error says why.
+        """
+        if not self.authenticated:
+            self.error = None
+            self.authenticated = self._authenticate()
+        return self.authenticated
+
+    def add_hook(self, hook) -> None:
+        """Registers a timing hook.
+
+        The hook is called as hook(event, value). Events are "connect",
+        "auth" and "command" round trips and "decode" time in seconds, and
+        "bytes_sent" and "bytes_received" per request. Hooks run on the
+        calling thread and should return quickly.
+
+        Args:
+            hook (Callable): The callback, e.g. a LatencyAggregator.
+        """
+        self.hooks.append(hook)
+
+    def _emit(self, event: str, value: float) -> None:
+        """Passes one timing event to every hook."""
+        for hook in self.hooks:
+            hook(event, value)
+
+    def _connect(self):
+        """Opens a connection to the server, timing it as the "connect" event."""
+        start = time.perf_counter()
+        client = socket.create_connection((self.dsuserver, self.port))
+        if self.hooks:
+            self._emit("connect", time.perf_counter() - start)
+        return client
 
     def _authenticate(self) -> bool:
         """Attempts to authenticate the user with the DSP server."""
         try:
-            with socket.create_connection((self.dsuserver, self.port)) as client:
-                send = client.makefile('w')
-                recv = client.makefile('r')
-                auth_msg = create_auth_message(self.username, self.password)
-                send.write(auth_msg + '\r\n')
-                send.flush()
-
-                resp = extract_json(recv.readline())
+            with self._connect() as client:
+                log = RequestLogger(logger, server=f"{self.dsuserver}:{self.port}")
+                send = client.makefile('wb')
+                recv = client.makefile('rb')
+                resp = self._request(send, recv, self._auth_message(), log)
                 if resp.type == 'ok':
                     self.token = resp.token
                     return True
+                self.error = resp.message or "Authentication failed"
         except (OSError, socket.error) as e:
-            print(f"Authentication failed: {e}")
+            self.error = str(e)
+            logger.warning(f"Authentication failed: {e}")
         return False
 
     def send(self, message: str, recipient: str) -> bool:
@@ -74,34 +297,171 @@ class DirectMessenger:
         Returns:
             bool: True if the message was successfully sent, False otherwise.
         """
+        return self.send_message(message, recipient) is not None
+
+    def send_message(self, message: str, recipient: str):
+        """Sends a message and returns the copy the server stored.
+
+        The copy carries the server's id and timestamp, so it matches the
+        sent message in later fetches.
+
+        Args:
+            message (str): The content of the message.
+            recipient (str): The username of the recipient.
+
+        Returns:
+            DirectMessage: The stored copy, or None if the message was not sent.
+        """
         if not self.authenticated:
-            return False  # Offline mode: cannot send
+            return None  # Offline mode: cannot send
 
         try:
-            client = socket.create_connection((self.dsuserver, self.port))
-            send = client.makefile('w')
-            recv = client.makefile('r')
+            client = self._connect()
+            log = RequestLogger(logger, server=f"{self.dsuserver}:{self.port}")
+            send = client.makefile('wb')
+            recv = client.makefile('rb')
 
             # Authenticate and get a fresh token
-            auth_msg = create_auth_message(self.username, self.password)
-            send.write(auth_msg + '\r\n')
-            send.flush()
-            auth_resp = extract_json(recv.readline())
+            auth_resp = self._request(send, recv, self._auth_message(), log)
             if auth_resp.type != 'ok':
-                return False
+                return None
             token = auth_resp.token
 
             # Send the direct message
-            msg = create_direct_message(token, message, recipient, time.time())
-            send.write(msg + '\r\n')
-            send.flush()
-            resp = extract_json(recv.readline())
+            sent_at = time.time()
+            msg = create_direct_message(token, message, recipient, sent_at)
+            resp = self._request(send, recv, msg, log, auth_resp)
             client.close()
 
-            return resp.type == 'ok'
+            return self._stored_copy(resp, message, recipient, sent_at) if resp.type == 'ok' else None
         except (OSError, socket.error) as e:
-            print(f"Send failed: {e}")
-            return False
+            logger.warning(f"Send failed: {e}")
+            return None
+
+    @staticmethod
+    def _stored_copy(resp, message: str, recipient: str, sent_at: float) -> DirectMessage:
+        """Builds the sender's copy of a sent message from the server's reply.
+
+        Servers that do not report the stored id and timestamp leave the id
+        empty and the local send time in place.
+        """
+        dm = DirectMessage()
+        dm.message = message
+        dm.recipient = recipient
+        message_id = getattr(resp, 'id', None)
+        timestamp = getattr(resp, 'timestamp', None)
+        dm.id = message_id if isinstance(message_id, int) and not isinstance(message_id, bool) else None
+        valid = isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool)
+        dm.timestamp = timestamp if valid else sent_at
+        return dm
+
+    def send_many(self, messages):
+        """Sends many messages over one connection, authenticating only once.
+
+        Messages are taken from the iterable one at a time, so it can be a
+        stream of any length. A message the server refuses with a
+        retry_after hint is retried after that delay, up to SEND_RETRIES
+        times. If the connection fails, self.error is set and no further
+        messages are consumed.
+
+        Args:
+            messages (Iterable): (recipient, message) pairs.
+
+        Yields:
+            tuple: (recipient, message, stored) for every message consumed,
+            where stored is the server's copy as returned by send_message,
+            or None if the message was not sent.
+        """
+        self.error = None
+        if not self.authenticated:
+            self.error = "Not authenticated"
+            for recipient, message in messages:
+                yield recipient, message, None
+            return
+
+        client = None
+        try:
+            client = self._connect()
+            log = RequestLogger(logger, server=f"{self.dsuserver}:{self.port}")
+            send = client.makefile('wb')
+            recv = client.makefile('rb')
+
+            auth_resp = self._request(send, recv, self._auth_message(), log)
+            if auth_resp.type != 'ok':
+                self.error = auth_resp.message or "Authentication failed"
+                for recipient, message in messages:
+                    yield recipient, message, None
+                return
+
+            for recipient, message in messages:
+                for _ in range(SEND_RETRIES + 1):
+                    sent_at = time.time()
+                    msg = create_direct_message(auth_resp.token, message, recipient, sent_at)
+                    resp = self._request(send, recv, msg, log, auth_resp)
+                    self.retry_after = None
+                    self._record_retry_hint(resp)
+                    if resp.type == 'ok' or self.retry_after is None:
+                        break
+                    time.sleep(self.retry_after)
+                stored = self._stored_copy(resp, message, recipient, sent_at) if resp.type == 'ok' else None
+                yield recipient, message, stored
+        except (OSError, socket.error) as e:
+            self.error = str(e)
+            logger.warning(f"Send failed: {e}")
+        finally:
+            if client is not None:
+                client.close()
+
+    def _auth_message(self) -> str:
+        """Returns the authenticate command, offering the enabled encodings."""
+        accept = [BINARY_ENCODING] if self.binary else []
+        if self.compress:
+            accept.append(ZLIB_ENCODING)
+        return create_auth_message(self.username, self.password, accept)
+
+    def _request(self, send, recv, payload: str, log: RequestLogger, session=None):
+        """Writes one command and returns the parsed response.
+
+        The round trip is reported to the hooks as "auth" when there is no
+        session yet and as "command" otherwise, followed by the bytes sent
+        and received and the time spent decoding the response.
+
+        Args:
+            send: Writable binary file wrapping the socket.
+            recv: Readable binary file wrapping the socket.
+            payload (str): The JSON command to send.
+            log (RequestLogger): Logger for this connection.
+            session (DSPResponse): The authenticate response of this connection,
+                whose encoding and compression were agreed with the server.
+
+        Returns:
+            DSPResponse: The parsed server response.
+        """
+        binary = getattr(session, "encoding", None) == BINARY_ENCODING
+        framed = binary or getattr(session, "compression", None) == ZLIB_ENCODING
+        log.next_request()
+        log.payload("out", payload)
+        data = encode_frame(json.loads(payload)) if binary else payload.encode() + b'\r\n'
+        start = time.perf_counter()
+        send.write(data)
+        send.flush()
+        line = read_message(recv) if framed else recv.readline()
+        received = time.perf_counter()
+        log.payload("in", line)
+        decode_start = time.perf_counter()
+        resp = extract_json(line)
+        if self.hooks:
+            self._emit("auth" if session is None else "command", received - start)
+            self._emit("bytes_sent", len(data))
+            self._emit("bytes_received", len(line))
+            self._emit("decode", time.perf_counter() - decode_start)
+        return resp
+
+    def _record_retry_hint(self, resp) -> None:
+        """Stores the server-suggested retry delay from a response, if any."""
+        retry_after = getattr(resp, 'retry_after', None)
+        if isinstance(retry_after, (int, float)) and not isinstance(retry_after, bool):
+            self.retry_after = retry_after
 
     def _retrieve(self, fetch_type: str) -> list:
         """Fetches messages from the server of a given type (all/unread).
@@ -109,35 +469,65 @@ class DirectMessenger:
         Args:
             fetch_type (str): Type of messages to fetch ("all" or "unread").
 
+        Unread fetches pass the mailbox version of the previous one, so an
+        unchanged mailbox is answered without the server reading it.
+
+        Returns:
+            list: List of DirectMessage objects.
+        """
+        since = self.versions.get(fetch_type) if fetch_type == 'unread' else None
+        messages = self._retrieve_messages(
+            lambda token: create_fetch_message(token, fetch_type, since))
+        if self.version is not None:
+            self.versions[fetch_type] = self.version
+        return messages
+
+    def _retrieve_messages(self, build_command) -> list:
+        """Authenticates and sends one command whose response carries messages.
+
+        Args:
+            build_command (Callable): Returns the JSON command for a session token.
+
         Returns:
             list: List of DirectMessage objects.
         """
         if not self.authenticated:
+            self.error = "Not authenticated"
             return []  # Offline mode: no messages to retrieve
 
         messages = []
+        self.retry_after = None
+        self.cursor = None
+        self.version = None
+        self.error = None
 
         try:
-            client = socket.create_connection((self.dsuserver, self.port))
-            send = client.makefile('w')
-            recv = client.makefile('r')
+            client = self._connect()
+            log = RequestLogger(logger, server=f"{self.dsuserver}:{self.port}")
+            send = client.makefile('wb')
+            recv = client.makefile('rb')
 
             # Authenticate and get a fresh token
-            auth_msg = create_auth_message(self.username, self.password)
-            send.write(auth_msg + '\r\n')
-            send.flush()
-            auth_resp = extract_json(recv.readline())
+            auth_resp = self._request(send, recv, self._auth_message(), log)
             if auth_resp.type != 'ok':
+                self._record_retry_hint(auth_resp)
+                self.error = auth_resp.message or "Authentication failed"
                 return messages
             token = auth_resp.token
 
-            # Send fetch request
-            fetch_msg = create_fetch_message(token, fetch_type)
-            send.write(fetch_msg + '\r\n')
-            send.flush()
-            resp = extract_json(recv.readline())
+            resp = self._request(send, recv, build_command(token), log, auth_resp)
             client.close()
 
+            self._record_retry_hint(resp)
+            if resp.type not in ('ok', 'not_modified'):
+                self.error = resp.message or "Request failed"
+            cursor = getattr(resp, 'cursor', None)
+            if resp.type == 'ok' and isinstance(cursor, int) and not isinstance(cursor, bool):
+                self.cursor = cursor
+            version = getattr(resp, 'version', None)
+            if resp.type in ('ok', 'not_modified') and isinstance(version, int) \
+                    and not isinstance(version, bool):
+                self.version = version
             if resp.type == 'ok' and resp.messages:
                 for msg in resp.messages:
                     dm = DirectMessage()
@@ -145,11 +535,13 @@ class DirectMessenger:
                     dm.timestamp = msg.get("timestamp")
                     dm.sender = msg.get("from")
                     dm.recipient = msg.get("recipient")
+                    dm.id = msg.get("id")
                     messages.append(dm)
 
             return messages
         except (OSError, socket.error) as e:
-            print(f"Retrieve failed: {e}")
+            self.error = str(e)
+            logger.warning(f"Retrieve failed: {e}")
             return []
 
     def retrieve_new(self) -> list:
@@ -159,3 +551,32 @@ class DirectMessenger:
     def retrieve_all(self) -> list:
         """Fetches all available messages."""
         return self._retrieve("all")
+
+    def retrieve_conversation(self, peer: str, limit: int = 50, before: int = None) -> list:
+        """Fetches one page of the conversation with a peer, oldest message first.
+
+        Afterwards self.cursor holds the value to pass as before for the next
+        older page, or None once the start of the conversation is reached.
+
+        Args:
+            peer (str): The other user in the conversation.
+            limit (int): Maximum number of messages in the page.
+            before (int): Cursor from the previous page, or None for the newest page.
+
+        Returns:
+            list: List of DirectMessage objects.
+        """
+        return self._retrieve_messages(
+            lambda token: create_conversation_message(token, peer, limit, before))
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """Searches this user's sent and received messages on the server.
+
+        Args:
+            query (str): Words that must all appear; a word ending in "*" matches as a prefix.
+            limit (int): Maximum number of messages to return.
+
+        Returns:
+            list: Matching DirectMessage objects, newest first.
+        """
+        return self._retrieve_messages(lambda token: create_search_message(token, query, limit))
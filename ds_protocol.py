@@ -5,63 +5,154 @@
 """DSP protocol utilities for parsing and creating JSON messages.
 
 Supports authentication, messaging, and message retrieval.
+
+Besides newline-terminated JSON, a client may negotiate the compact binary
+"dspb1" encoding by listing it under "accept" in its authenticate command.
+A binary message is a frame: one flags byte with the high bit set (so it
+can never be mistaken for JSON text), a 4-byte big-endian payload length
+and the payload. The payload is a length-prefixed JSON header followed by
+length-prefixed sections. A "messages" list in a response is moved out of
+the header into columns, one per key of each distinct message shape:
+numbers are packed as float64/int64 arrays, repetitive strings are stored
+once in a table and referenced by index, and the remaining values are a
+single JSON array. Timestamp columns travel as float64.
+
+A client may also list "zlib" under "accept". Responses larger than the
+server's threshold are then sent as chunked frames: the flags byte followed
+by length-prefixed chunks of one zlib stream and a zero-length terminator,
+so the server can compress while it is still encoding. The FRAME_JSON flag
+marks a frame whose payload is JSON text instead of dspb1. Only responses
+are compressed; a server refuses compressed request frames.
+
+Fetch responses carry the mailbox "version", which changes with every
+write to the mailbox. A fetch command may pass it back as "if_newer_than";
+if the mailbox is unchanged the server answers {"type": "not_modified"}.
 """
 
 import json
+import struct
+import sys
+import zlib
+from array import array
+from itertools import chain, repeat
 from typing import Any
 from collections import namedtuple
 
-DSPResponse = namedtuple("DSPResponse", ["type", "message", "token", "messages"])
+DSPResponse = namedtuple(
+    "DSPResponse",
+    ["type", "message", "token", "messages", "retry_after", "cursor", "encoding", "compression",
+     "version", "id", "timestamp"],
+    defaults=(None, None, None, None, None, None, None)
+)
+
+BINARY_ENCODING = "dspb1"
+FRAME_FLAG = 0x80
+FRAME_HEADER = struct.Struct(">BI")
+FRAME_ZLIB = 0x01
+FRAME_JSON = 0x02
+FRAME_CHUNKED = 0x04
+NUMERIC_COLUMNS = ("timestamp",)
+ZLIB_ENCODING = "zlib"
+COMPRESS_THRESHOLD = 16 * 1024  # Smallest response, in bytes, worth compressing
+COMPRESS_LEVEL = 6
+STREAM_CHUNK = 64 * 1024  # Compressed bytes gathered before a chunk is emitted
+MAX_DECOMPRESSED = 256 << 20  # Largest payload a compressed frame may expand to
+
+_SECTION = struct.Struct(">I")
+_UINT32 = next(code for code in "IL" if array(code).itemsize == 4)
 
 
 def extract_json(json_msg: str) -> DSPResponse:
     """
-    Parses a JSON string from the DSP server and extracts response fields.
+    Parses a JSON string or binary frame from the DSP server and extracts response fields.
 
     Args:
-        json_msg (str): The JSON string received from the server.
+        json_msg (str | bytes): The JSON line or dspb1 frame received from the server.
 
     Returns:
-        DSPResponse: A namedtuple with fields for type, message, token, and messages.
+        DSPResponse: A namedtuple with fields for type, message, token, messages,
+        the server-suggested retry_after delay in seconds (or None), the
+        cursor of the next conversation page (or None), the encoding and
+        compression the server agreed to (or None), the mailbox version
+        of a fetch response (or None), and the id and timestamp the server
+        stored a sent direct message with (or None).
     """
     try:
-        json_obj: dict[str, Any] = json.loads(json_msg)
+        if isinstance(json_msg, (bytes, bytearray)) and json_msg[:1] and json_msg[0] & FRAME_FLAG:
+            json_obj: dict[str, Any] = decode_frame(bytes(json_msg))
+        else:
+            json_obj = json.loads(json_msg)
         response = json_obj.get("response")
 
         if not isinstance(response, dict):
             return DSPResponse("error", "Malformed response structure", None, [])
 
+        retry_after = response.get("retry_after")
+        if not isinstance(retry_after, (int, float)) or isinstance(retry_after, bool):
+            retry_after = None
+
+        cursor = response.get("cursor")
+        if not isinstance(cursor, int) or isinstance(cursor, bool):
+            cursor = None
+
+        version = response.get("version")
+        if not isinstance(version, int) or isinstance(version, bool):
+            version = None
+
+        message_id = response.get("id")
+        if not isinstance(message_id, int) or isinstance(message_id, bool):
+            message_id = None
+
+        timestamp = response.get("timestamp")
+        if not isinstance(timestamp, (int, float)) or isinstance(timestamp, bool):
+            timestamp = None
+
         return DSPResponse(
             response.get("type", "error"),
             response.get("message"),
             response.get("token"),
-            response.get("messages", [])
+            response.get("messages", []),
+            retry_after,
+            cursor,
+            response.get("encoding") if isinstance(response.get("encoding"), str) else None,
+            response.get("compression") if isinstance(response.get("compression"), str) else None,
+            version,
+            message_id,
+            timestamp
         )
 
     except json.JSONDecodeError:
         return DSPResponse("error", "Invalid JSON", None, [])
 
+    except ValueError:
+        return DSPResponse("error", "Invalid frame", None, [])
+
     except TypeError:
         return DSPResponse("error", "Input must be a string", None, [])
 
 
-def create_auth_message(username: str, password: str) -> str:
+def create_auth_message(username: str, password: str, accept: list = None) -> str:
     """
     Creates a JSON string for user authentication.
 
     Args:
         username (str): The username of the user.
         password (str): The password of the user.
+        accept (list): Optional encodings the client supports, e.g.
+            [BINARY_ENCODING, ZLIB_ENCODING].
 
     Returns:
         str: A JSON string for the authentication message.
     """
-    return json.dumps({
+    command = {
         "authenticate": {
             "username": username,
             "password": password
         }
-    })
+    }
+    if accept:
+        command["accept"] = list(accept)
+    return json.dumps(command)
 
 
 def create_direct_message(token: str, message: str, recipient: str, timestamp: float) -> str:
@@ -87,18 +178,399 @@ def create_direct_message(token: str, message: str, recipient: str, timestamp: f
     })
 
 
-def create_fetch_message(token: str, fetch_type: str) -> str:
+def create_fetch_message(token: str, fetch_type: str, if_newer_than: int = None) -> str:
     """
     Creates a JSON string to fetch messages.
 
     Args:
         token (str): The user's authentication token.
         fetch_type (str): Type of messages to fetch ("all" or "unread").
+        if_newer_than (int): Mailbox version from an earlier fetch; the server
+            answers "not_modified" if the mailbox has not changed since.
 
     Returns:
         str: A JSON string representing the fetch request.
     """
-    return json.dumps({
+    command = {
         "token": token,
         "fetch": fetch_type
+    }
+    if if_newer_than is not None:
+        command["if_newer_than"] = if_newer_than
+    return json.dumps(command)
+
+
+def create_search_message(token: str, query: str, limit: int = 20) -> str:
+    """
+    Creates a JSON string to search the user's messages on the server.
+
+    Args:
+        token (str): The user's authentication token.
+        query (str): Words that must all appear; a word ending in "*" matches as a prefix.
+        limit (int): Maximum number of messages to return, newest first.
+
+    Returns:
+        str: A JSON string representing the search request.
+    """
+    return json.dumps({
+        "token": token,
+        "search": {
+            "query": query,
+            "limit": limit
+        }
     })
+
+
+def create_conversation_message(token: str, peer: str, limit: int = 50, before: int = None) -> str:
+    """
+    Creates a JSON string to fetch one page of the conversation with a peer.
+
+    Args:
+        token (str): The user's authentication token.
+        peer (str): The other user in the conversation.
+        limit (int): Maximum number of messages in the page.
+        before (int): Cursor from the previous page, or None for the newest page.
+
+    Returns:
+        str: A JSON string representing the conversation fetch request.
+    """
+    fetch = {"conversation": peer, "limit": limit}
+    if before is not None:
+        fetch["before"] = before
+    return json.dumps({
+        "token": token,
+        "fetch": fetch
+    })
+
+
+def _pack_array(typecode: str, values) -> bytes:
+    """Packs numbers into a little-endian array section."""
+    packed = array(typecode, values)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack_array(typecode: str, data: bytes) -> list:
+    """Unpacks a little-endian array section into a list."""
+    unpacked = array(typecode)
+    unpacked.frombytes(data)
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+def _encode_column(values: list, numeric: bool, sections: list) -> list:
+    """Appends the section for one column and returns its spec."""
+    kinds = set(map(type, values))
+    if kinds == {float} or numeric and kinds <= {float, int, str}:
+        try:
+            sections.append(_pack_array("d", map(float, values)))
+            return ["f"]
+        except ValueError:
+            pass
+    if kinds == {int}:
+        try:
+            sections.append(_pack_array("q", values))
+            return ["i"]
+        except OverflowError:
+            pass
+    if kinds == {str}:
+        table = {}
+        indexes = [table.setdefault(value, len(table)) for value in values]
+        if 2 * len(table) <= len(values):
+            sections.append(_pack_array(_UINT32, indexes))
+            return ["s", list(table)]
+    sections.append(json.dumps(values).encode())
+    return ["j"]
+
+
+def _decode_column(spec: list, data: bytes) -> list:
+    """Returns the values of one column from its spec and section."""
+    kind = spec[0]
+    if kind == "f":
+        return _unpack_array("d", data)
+    if kind == "i":
+        return _unpack_array("q", data)
+    if kind == "s":
+        return list(map(spec[1].__getitem__, _unpack_array(_UINT32, data)))
+    if kind == "j":
+        return json.loads(data)
+    raise ValueError(f"Unknown column kind {kind!r}")
+
+
+def encode_binary(obj: dict, numeric=NUMERIC_COLUMNS) -> bytes:
+    """
+    Encodes a command or response as a dspb1 payload.
+
+    Args:
+        obj (dict): The JSON-compatible command or response.
+        numeric (tuple): Message keys sent as float64 when every value parses.
+
+    Returns:
+        bytes: The payload, without the frame header.
+    """
+    header = obj
+    sections = []
+    response = obj.get("response") if isinstance(obj, dict) else None
+    rows = response.get("messages") if isinstance(response, dict) else None
+    if isinstance(rows, list) and rows and all(isinstance(row, dict) and row for row in rows):
+        shapes = {}
+        order = [shapes.setdefault(tuple(row), len(shapes)) for row in rows]
+        groups = [[] for _ in shapes]
+        for row, shape in zip(rows, order):
+            groups[shape].append(row)
+        if len(shapes) > 1:
+            sections.append(_pack_array(_UINT32, order))
+        specs = [[list(keys), len(group),
+                  [_encode_column([row[key] for row in group], key in numeric, sections) for key in keys]]
+                 for keys, group in zip(shapes, groups)]
+        header = dict(obj)
+        header["response"] = {k: v for k, v in response.items() if k != "messages"}
+        header["_rows"] = specs
+    head = json.dumps(header).encode()
+    parts = [_SECTION.pack(len(head)), head]
+    for section in sections:
+        parts.append(_SECTION.pack(len(section)))
+        parts.append(section)
+    return b"".join(parts)
+
+
+def decode_binary(payload: bytes, rows: bool = True) -> dict:
+    """
+    Decodes a dspb1 payload back into a command or response dict.
+
+    Args:
+        payload (bytes): The payload, without the frame header.
+        rows (bool): Whether message columns are allowed. Only responses carry
+            them, so a server decoding requests passes False.
+
+    Raises:
+        ValueError: If the payload is malformed.
+    """
+    try:
+        sections = []
+        pos = 0
+        while pos < len(payload):
+            (size,) = _SECTION.unpack_from(payload, pos)
+            pos += _SECTION.size
+            if pos + size > len(payload):
+                raise ValueError("Truncated section")
+            sections.append(payload[pos:pos + size])
+            pos += size
+        obj = json.loads(sections[0])
+        specs = obj.pop("_rows", None) if isinstance(obj, dict) else None
+        if specs is not None:
+            if not rows:
+                raise ValueError("Message columns are only valid in responses")
+            columns = iter(sections[1:])
+            order = _unpack_array(_UINT32, next(columns)) if len(specs) > 1 else None
+            groups = []
+            for keys, count, column_specs in specs:
+                # Row counts come from the columns, so a header cannot make the decoder build rows it was not sent
+                if not keys or len(column_specs) != len(keys):
+                    raise ValueError("Bad row group")
+                values = [_decode_column(spec, next(columns)) for spec in column_specs]
+                if any(len(column) != count for column in values):
+                    raise ValueError("Column length mismatch")
+                pairs = [zip(repeat(key), column) for key, column in zip(keys, values)]
+                groups.append(list(map(dict, zip(*pairs))))
+            if order is None:
+                messages = groups[0]
+            else:
+                iters = [iter(group) for group in groups]
+                messages = list(map(next, map(iters.__getitem__, order)))
+                # map stops quietly when a group runs out, so a short result means the order was inconsistent
+                if len(messages) != len(order) or len(messages) != sum(map(len, groups)):
+                    raise ValueError("Row order mismatch")
+            obj["response"]["messages"] = messages
+        return obj
+    except (struct.error, IndexError, KeyError, TypeError, StopIteration, AttributeError) as e:
+        raise ValueError(f"Malformed dspb1 payload: {e}") from e
+
+
+def encode_frame(obj: dict, flags: int = 0) -> bytes:
+    """
+    Encodes a command or response as a complete dspb1 frame.
+
+    Args:
+        obj (dict): The JSON-compatible command or response.
+        flags (int): Extra flag bits for the frame header.
+
+    Returns:
+        bytes: Frame header and payload.
+    """
+    payload = encode_binary(obj)
+    return FRAME_HEADER.pack(FRAME_FLAG | flags, len(payload)) + payload
+
+
+def _join_chunks(frame: bytes) -> bytes:
+    """Returns the payload of a chunked frame."""
+    chunks = []
+    pos = 1
+    while True:
+        (size,) = _SECTION.unpack_from(frame, pos)
+        pos += _SECTION.size
+        if not size:
+            break
+        if pos + size > len(frame):
+            raise ValueError("Truncated chunk")
+        chunks.append(frame[pos:pos + size])
+        pos += size
+    if pos != len(frame):
+        raise ValueError("Bad chunked frame")
+    return b"".join(chunks)
+
+
+def decode_frame(frame: bytes, request: bool = False, max_size: int = MAX_DECOMPRESSED) -> dict:
+    """
+    Decodes a complete frame, decompressing it if needed.
+
+    Args:
+        frame (bytes): The frame, header included.
+        request (bool): Decode a client request, which is never compressed and
+            never carries message columns.
+        max_size (int): Largest payload a compressed frame may expand to.
+
+    Raises:
+        ValueError: If the frame header or payload is malformed.
+    """
+    if len(frame) < FRAME_HEADER.size:
+        raise ValueError("Truncated frame header")
+    flags, length = FRAME_HEADER.unpack_from(frame)
+    if not flags & FRAME_FLAG:
+        raise ValueError("Bad frame header")
+    if request and flags & (FRAME_ZLIB | FRAME_CHUNKED):
+        raise ValueError("Compressed requests are not accepted")
+    try:
+        if flags & FRAME_CHUNKED:
+            payload = _join_chunks(frame)
+        elif len(frame) == FRAME_HEADER.size + length:
+            payload = frame[FRAME_HEADER.size:]
+        else:
+            raise ValueError("Bad frame length")
+        if flags & FRAME_ZLIB:
+            decompressor = zlib.decompressobj()
+            payload = decompressor.decompress(payload, max_size)
+            if decompressor.unconsumed_tail:
+                raise ValueError(f"Frame expands beyond {max_size} bytes")
+            if not decompressor.eof:
+                raise ValueError("Truncated zlib stream")
+    except (struct.error, zlib.error) as e:
+        raise ValueError(f"Malformed frame: {e}") from e
+    if flags & FRAME_JSON:
+        return json.loads(payload)
+    return decode_binary(payload, rows=not request)
+
+
+def iter_compressed_frame(pieces, level: int = COMPRESS_LEVEL, flags: int = 0):
+    """
+    Compresses a stream of byte pieces into a chunked zlib frame.
+
+    Args:
+        pieces (Iterable[bytes]): The uncompressed payload, in order.
+        level (int): zlib compression level.
+        flags (int): Extra flag bits, e.g. FRAME_JSON.
+
+    Yields:
+        bytes: Parts of the frame, ready to send as they are produced.
+    """
+    compressor = zlib.compressobj(level)
+    yield bytes([FRAME_FLAG | FRAME_ZLIB | FRAME_CHUNKED | flags])
+    pending = []
+    size = 0
+    for piece in pieces:
+        out = compressor.compress(piece)
+        if out:
+            pending.append(out)
+            size += len(out)
+        if size >= STREAM_CHUNK:
+            chunk = b"".join(pending)
+            yield _SECTION.pack(len(chunk)) + chunk
+            pending = []
+            size = 0
+    pending.append(compressor.flush())
+    chunk = b"".join(pending)
+    if chunk:
+        yield _SECTION.pack(len(chunk)) + chunk
+    yield _SECTION.pack(0)
+
+
+def _json_pieces(obj, batch: int = 1000):
+    """Yields the JSON encoding of obj as bytes, a slice of its messages at a time."""
+    response = obj.get("response") if isinstance(obj, dict) and len(obj) == 1 else None
+    rows = response.get("messages") if isinstance(response, dict) else None
+    if not isinstance(rows, list) or len(rows) <= batch:
+        yield json.dumps(obj).encode()
+        return
+    rest = {key: value for key, value in response.items() if key != "messages"}
+    head = json.dumps({"response": rest})[:-2]
+    yield (head + (', "messages": [' if rest else '"messages": [')).encode()
+    for i in range(0, len(rows), batch):
+        text = json.dumps(rows[i:i + batch])[1:-1]
+        yield (", " + text if i else text).encode()
+    yield b"]}}"
+
+
+def iter_encoded(obj: dict, binary: bool = False, compress_threshold: int = None,
+                 level: int = COMPRESS_LEVEL):
+    """
+    Encodes a response for sending, compressing it when it is large enough.
+
+    Args:
+        obj (dict): The response.
+        binary (bool): Use a dspb1 frame instead of a JSON line.
+        compress_threshold (int): Compress responses of at least this many bytes,
+            or None if the client did not accept compression.
+        level (int): zlib compression level.
+
+    Yields:
+        bytes: The encoded response in one or more parts.
+    """
+    if binary:
+        payload = encode_binary(obj)
+        if compress_threshold is None or len(payload) < compress_threshold:
+            yield FRAME_HEADER.pack(FRAME_FLAG, len(payload)) + payload
+            return
+        view = memoryview(payload)
+        yield from iter_compressed_frame(
+            (view[i:i + STREAM_CHUNK] for i in range(0, len(view), STREAM_CHUNK)), level)
+        return
+    pieces = _json_pieces(obj)
+    head = []
+    size = 0
+    for piece in pieces:
+        head.append(piece)
+        size += len(piece)
+        if compress_threshold is not None and size >= compress_threshold:
+            yield from iter_compressed_frame(chain(head, pieces), level, FRAME_JSON)
+            return
+    yield b"".join(head) + b"\r\n"
+
+
+def read_message(stream) -> bytes:
+    """
+    Reads one JSON line or one binary frame from a binary file object.
+
+    Returns:
+        bytes: The raw message, or b"" at end of stream.
+    """
+    first = stream.read(1)
+    if not first or not first[0] & FRAME_FLAG:
+        return first + stream.readline() if first else b""
+    if first[0] & FRAME_CHUNKED:
+        parts = [first]
+        while True:
+            header = stream.read(_SECTION.size)
+            parts.append(header)
+            if len(header) < _SECTION.size:
+                return b"".join(parts)
+            (size,) = _SECTION.unpack(header)
+            if not size:
+                return b"".join(parts)
+            parts.append(stream.read(size))
+    rest = stream.read(FRAME_HEADER.size - 1)
+    if len(rest) < FRAME_HEADER.size - 1:
+        return first + rest
+    _, length = FRAME_HEADER.unpack(first + rest)
+    return first + rest + stream.read(length)
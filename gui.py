@@ -5,12 +5,114 @@
 """GUI for ICS32 Social Messenger App."""
 
 import os
+import queue
+import threading
 import time
 from datetime import datetime
 import tkinter as tk
 from tkinter import ttk, simpledialog, messagebox
-from notebook import Notebook, Diary
-from ds_messenger import DirectMessenger
+from notebook import Notebook, Diary, split_entry, SELF_NAME
+from ds_messenger import DirectMessenger, LatencyAggregator, PollScheduler, StartupTimer
+from ds_logging import get_logger
+
+RENDER_WINDOW = 200  # Messages rendered when a conversation is opened
+RENDER_PAGE = 100  # Older messages loaded each time the view hits the top
+MAX_RENDERED = 1000  # Rendered messages kept while new ones arrive at the bottom
+WORKER_POLL_MS = 100  # How often the Tk thread collects background results
+RECONNECT_MIN = 2.0  # Seconds before the first reconnect attempt while offline
+RECONNECT_MAX = 60.0  # Longest wait between reconnect attempts
+
+logger = get_logger("gui")
+
+
+class ConversationCache:
+    """Groups notebook diaries by contact and caches their rendered text."""
+
+    def __init__(self, notebook):
+        """Create an empty cache over the given notebook."""
+        self.notebook = notebook
+        self._indexed = 0
+        self._generation = notebook.generation
+        self._threads = {}
+
+    def refresh(self):
+        """Index diaries added to the notebook since the last refresh."""
+        diaries = self.notebook.get_diaries()
+        if self.notebook.generation != self._generation or len(diaries) < self._indexed:
+            self.reset()  # Diaries were removed or replaced, so rebuild from scratch
+            self._generation = self.notebook.generation
+        for d in diaries[self._indexed:]:
+            peer, direction, text = split_entry(d.entry)
+            if peer is None:
+                continue
+            sender = SELF_NAME if direction == "out" else peer
+            ts = datetime.fromtimestamp(d.timestamp).strftime('%H:%M')
+            self._threads.setdefault(peer, []).append(
+                (f"{ts} ", "timestamp", f"{sender}: ", "name", f"{text}\n", ())
+            )
+        self._indexed = len(diaries)
+
+    def reset(self):
+        """Forget all cached messages so the next refresh rebuilds them."""
+        self._indexed = 0
+        self._threads = {}
+
+    def count(self, contact):
+        """Return the number of cached messages with a contact."""
+        return len(self._threads.get(contact, ()))
+
+    def segments(self, contact, start, end):
+        """Return flattened (text, tags) insert arguments for a slice of messages."""
+        args = []
+        for rendered in self._threads.get(contact, [])[start:end]:
+            args.extend(rendered)
+        return args
+
+
+class MessengerWorker:
+    """Runs blocking network calls on a background thread.
+
+    Tasks run one at a time in submission order. Their results are queued
+    and handed back to callbacks by poll(), which the Tk thread calls.
+    """
+
+    def __init__(self):
+        """Start the worker thread."""
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, func, *args, on_done=None):
+        """Queue func(*args); on_done(result, error) is called from poll()."""
+        self._tasks.put((func, args, on_done))
+
+    def _run(self):
+        """Execute queued tasks until stop() is called."""
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                break
+            func, args, on_done = task
+            try:
+                result, error = func(*args), None
+            except Exception as e:  # pylint: disable=broad-except
+                result, error = None, e
+            self._results.put((on_done, result, error))
+
+    def poll(self):
+        """Run callbacks for every finished task. Never blocks."""
+        while True:
+            try:
+                on_done, result, error = self._results.get_nowait()
+            except queue.Empty:
+                return
+            if on_done:
+                on_done(result, error)
+
+    def stop(self):
+        """Ask the worker thread to exit after the queued tasks."""
+        self._tasks.put(None)
 
 
 class SocialMessengerApp:
@@ -30,6 +132,7 @@ class SocialMessengerApp:
             self.root.destroy()
             return
 
+        self.startup = StartupTimer()  # Cold start is timed from the end of the login prompt
         self.root.deiconify()  # Show main window again AFTER login
         self.root.title("ICS32 Social Messenger")
         self.root.geometry("800x500")
@@ -37,21 +140,13 @@ class SocialMessengerApp:
         self.notebook_path = f"{self.username}.json"
         self.notebook = Notebook(self.username, self.password, "GUI user")
 
-        # Try to connect to the server
-        try:
-            self.messenger = DirectMessenger(
-                dsuserver='127.0.0.1',
-                username=self.username,
-                password=self.password
-            )
-            if not self.messenger.authenticated:
-                raise OSError("Authentication failed")
-        except OSError as auth_error:
-            messagebox.showwarning(
-                "Offline Mode",
-                f"Unable to connect or authenticate. Entering Offline mode.\n{auth_error}"
-            )
-            self.messenger = None
+        self.messenger = None
+        self.retrieve_pending = False
+        self.poller = PollScheduler()
+        self.latency = LatencyAggregator()
+        self.poll_job = None
+        self.reconnect_attempts = 0
+        self.worker = MessengerWorker()
 
         # Try to load existing notebook if not create a new one
         if os.path.exists(self.notebook_path):
@@ -59,23 +154,84 @@ class SocialMessengerApp:
                 self.notebook.load(self.notebook_path)
             except OSError as e:
                 messagebox.showwarning("Notebook", f"Failed to load previous notebook. Error: {e}")
-        else:
-            self.notebook.save(self.notebook_path)  # Save new notebook on first run
+        self.notebook.enable_autosave(self.notebook_path)
+        if not os.path.exists(self.notebook_path):
+            self.notebook.mark_dirty()  # Save new notebook on first run
+        self.startup.mark("notebook")
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
 
+        # Render the cached history offline first and authenticate in the background
         self.setup_ui()
-        self.update_messages_loop()
+        self.startup.mark("ui")
+        self.root.after_idle(self.on_first_paint)
+        self.start_connect()
+        self.poll_worker()
+
+    def on_first_paint(self):
+        """Record when the window first had a chance to draw."""
+        self.root.update_idletasks()
+        self.startup.mark("first_paint")
+        logger.info("First paint.", extra={"startup_ms": 1000 * self.startup.phases["first_paint"]})
+
+    def start_connect(self):
+        """Try to go online on the worker thread."""
+        self.set_status("Offline, connecting...", online=False)
+        self.worker.submit(self.connect, on_done=self.on_connected)
+
+    def connect(self):
+        """Create and authenticate the messenger. Runs on the worker thread."""
+        messenger = DirectMessenger(
+            dsuserver='127.0.0.1',
+            username=self.username,
+            password=self.password,
+            hooks=[self.latency],
+            autoconnect=False
+        )
+        if not messenger.connect():
+            raise OSError(messenger.error or "Authentication failed")
+        return messenger
+
+    def on_connected(self, messenger, error):
+        """Switch to online mode, or stay offline and retry with backoff."""
+        if error is not None:
+            delay = min(RECONNECT_MAX, RECONNECT_MIN * 2 ** self.reconnect_attempts)
+            self.reconnect_attempts += 1
+            self.set_status(f"Offline ({error}), retrying in {delay:.0f}s", online=False)
+            self.root.after(int(delay * 1000), self.start_connect)
+            return
+        self.reconnect_attempts = 0
+        self.messenger = messenger
+        self.set_status("Online", online=True)
+        self.startup.mark("online")
+        logger.info("Online.", extra={"startup_ms": 1000 * self.startup.phases["online"]})
+        self.schedule_poll(self.poller.initial_delay())
+
+    def set_status(self, text, online):
+        """Show the connection state in the header."""
+        self.status_label.config(text=text, fg="green" if online else "gray")
+
+    def poll_worker(self):
+        """Collect finished background tasks on the Tk thread."""
+        self.worker.poll()
+        self.root.after(WORKER_POLL_MS, self.poll_worker)
 
     def setup_ui(self):
         """Create UI elements."""
         self.container = tk.Frame(self.root)
         self.container.pack(fill="both", expand=True)
 
+        self.header = tk.Frame(self.container)
+        self.header.pack(side="top", fill="x")
+
         self.user_label = tk.Label(
-            self.container,
+            self.header,
             text=f"Logged in as: {self.username}",
             font=("Arial", 10, "italic")
         )
-        self.user_label.pack(side="top", anchor="w", padx=10, pady=2)
+        self.user_label.pack(side="left", padx=10, pady=2)
+
+        self.status_label = tk.Label(self.header, text="Offline", fg="gray")
+        self.status_label.pack(side="right", padx=10, pady=2)
 
         self.contact_list = ttk.Treeview(self.container)
         self.contact_list.heading("#0", text="Contacts")
@@ -85,8 +241,27 @@ class SocialMessengerApp:
         self.right_frame = tk.Frame(self.container)
         self.right_frame.pack(side="right", fill="both", expand=True)
 
-        self.message_display = tk.Text(self.right_frame, state="disabled", wrap="word")
-        self.message_display.pack(fill="both", expand=True)
+        self.conversations = ConversationCache(self.notebook)
+        self.shown_user = None
+        self.shown_start = 0
+        self.shown_end = 0
+
+        self.message_frame = tk.Frame(self.right_frame)
+        self.message_frame.pack(fill="both", expand=True)
+
+        self.message_scrollbar = tk.Scrollbar(self.message_frame)
+        self.message_scrollbar.pack(side="right", fill="y")
+
+        self.message_display = tk.Text(
+            self.message_frame,
+            state="disabled",
+            wrap="word",
+            yscrollcommand=self.on_message_scroll
+        )
+        self.message_display.pack(side="left", fill="both", expand=True)
+        self.message_scrollbar.config(command=self.message_display.yview)
+        self.message_display.tag_config("name", font=("Arial", 10, "bold"))
+        self.message_display.tag_config("timestamp", foreground="gray")
 
         self.message_input = tk.Entry(self.right_frame)
         self.message_input.pack(fill="x", padx=5, pady=5)
@@ -100,8 +275,15 @@ class SocialMessengerApp:
         self.add_user_button = tk.Button(self.button_frame, text="Add User", command=self.add_user)
         self.add_user_button.pack(side="left", padx=5)
 
+        self.latency_button = tk.Button(self.button_frame, text="Latency", command=self.show_latency)
+        self.latency_button.pack(side="left", padx=5)
+
         self.load_contacts()
 
+    def show_latency(self):
+        """Show the client latency summary of this session."""
+        messagebox.showinfo("Latency", f"{self.startup.summary()}\n\n{self.latency.summary()}")
+
     def load_contacts(self):
         """Load contacts from notebook into the contact list UI."""
         for contact in self.notebook.contacts:
@@ -110,10 +292,9 @@ class SocialMessengerApp:
     def add_user(self):
         """Prompt to add a new contact and save to notebook."""
         new_user = simpledialog.askstring("Add Contact", "Enter username:")
-        if new_user and new_user not in self.notebook.contacts:
-            self.notebook.contacts.append(new_user)
+        if new_user and self.notebook.add_contact(new_user):
             self.contact_list.insert("", "end", iid=new_user, text=new_user)
-            self.notebook.save(self.notebook_path)
+            self.notebook.mark_dirty()
 
     def send_message(self):
         """Send a message to the selected contact."""
@@ -127,60 +308,151 @@ class SocialMessengerApp:
         if not message:
             return
 
-        success = self.messenger.send(message, recipient) if self.messenger else False
-        if success:
-            entry = f"You → {recipient}: {message}"
-            diary = Diary(entry=entry, timestamp=time.time())
-            self.notebook.add_diary(diary)
-            self.notebook.save(self.notebook_path)
-            self.message_input.delete(0, tk.END)
-            self.display_conversation()
-        else:
+        if not self.messenger:
             messagebox.showerror("Send Failed", "Offline... could not send the message.")
+            return
 
-    def display_conversation(self, _event=None):
-        """Display conversation with the selected contact."""
+        # Show the message right away and send it in the background
+        entry = f"You → {recipient}: {message}"
+        diary = Diary(entry=entry, timestamp=time.time())
+        self.notebook.add_diary(diary)
+        self.notebook.mark_dirty()
+        self.message_input.delete(0, tk.END)
+        self.display_conversation()
+
+        def on_sent(stored, _error):
+            if stored is None:
+                self.remove_diary(diary)
+                messagebox.showerror("Send Failed", "Offline... could not send the message.")
+            elif float(stored.timestamp) != diary.timestamp:
+                # Keep the server's timestamp so a later sync of the same message is a duplicate
+                self.remove_diary(diary, Diary(entry=entry, timestamp=float(stored.timestamp)))
+
+        self.worker.submit(self.messenger.send_message, message, recipient, on_done=on_sent)
+        self.poke_poller()
+
+    def remove_diary(self, diary, replacement=None):
+        """Remove an optimistically added diary, or swap in its stored copy, and re-render."""
+        diaries = self.notebook.get_diaries()
+        for index in range(len(diaries) - 1, -1, -1):
+            if diaries[index] is diary:
+                self.notebook.del_diary(index)
+                if replacement is not None:
+                    self.notebook.add_diary(replacement)
+                self.notebook.mark_dirty()
+                break
+        self.conversations.reset()
+        self.shown_user = None
+        self.display_conversation()
+
+    def display_conversation(self, event=None):
+        """Display conversation with the selected contact.
+
+        Only messages added since the last render are appended. Switching
+        contacts renders the most recent RENDER_WINDOW messages; older ones
+        are loaded as the view is scrolled to the top.
+        """
         selected = self.contact_list.selection()
         if not selected:
             return
 
         user = selected[0]
-        self.message_display.config(state="normal")
-        self.message_display.delete(1.0, tk.END)
+        if event is not None:
+            self.poke_poller()
+        self.conversations.refresh()
+        total = self.conversations.count(user)
+
+        if user != self.shown_user:
+            self.shown_user = user
+            self.shown_start = max(0, total - RENDER_WINDOW)
+            self.shown_end = total
+            self.message_display.config(state="normal")
+            self.message_display.delete(1.0, tk.END)
+            self._insert_messages(tk.END, self.shown_start, self.shown_end)
+            self.message_display.config(state="disabled")
+            self.message_display.see(tk.END)
+        elif total > self.shown_end:
+            at_bottom = self.message_display.yview()[1] >= 1.0
+            self.message_display.config(state="normal")
+            self._insert_messages(tk.END, self.shown_end, total)
+            self.shown_end = total
+            if at_bottom and self.shown_end - self.shown_start > MAX_RENDERED:
+                self._trim_top(self.shown_end - MAX_RENDERED)
+            self.message_display.config(state="disabled")
+            if at_bottom:
+                self.message_display.see(tk.END)
+
+    def _insert_messages(self, index, start, end):
+        """Insert cached messages [start, end) of the shown conversation at index."""
+        args = self.conversations.segments(self.shown_user, start, end)
+        if args:
+            self.message_display.insert(index, *args)
+
+    def _trim_top(self, new_start):
+        """Drop rendered messages above new_start from the text widget."""
+        lines = sum(
+            segment.count("\n")
+            for segment in self.conversations.segments(self.shown_user, self.shown_start, new_start)[::2]
+        )
+        self.message_display.delete("1.0", f"{lines + 1}.0")
+        self.shown_start = new_start
 
-        self.message_display.tag_config("name", font=("Arial", 10, "bold"))
-        self.message_display.tag_config("timestamp", foreground="gray")
+    def on_message_scroll(self, first, last):
+        """Update the scrollbar and load older messages when the top is reached."""
+        self.message_scrollbar.set(first, last)
+        if float(first) > 0.0 or self.shown_start == 0 or self.shown_user is None:
+            return
 
-        for d in self.notebook.get_diaries():
-            if f"→ {user}:" in d.entry or f"{user} →" in d.entry:
-                ts = datetime.fromtimestamp(d.timestamp).strftime('%H:%M')
-                self.message_display.insert(tk.END, f"{ts} ", "timestamp")
+        new_start = max(0, self.shown_start - RENDER_PAGE)
+        args = self.conversations.segments(self.shown_user, new_start, self.shown_start)
+        self.shown_start = new_start
+        self.message_display.config(state="normal")
+        self.message_display.insert("1.0", *args)
+        self.message_display.config(state="disabled")
+        lines = sum(segment.count("\n") for segment in args[::2])
+        self.message_display.yview(f"{lines + 1}.0")
 
-                if "→" in d.entry:
-                    sender = d.entry.split("→")[0].strip()
-                    msg = d.entry.split(":", 1)[1].strip()
-                    self.message_display.insert(tk.END, f"{sender}: ", "name")
-                    self.message_display.insert(tk.END, f"{msg}\n")
-                else:
-                    self.message_display.insert(tk.END, f"{d.entry}\n")
+    def schedule_poll(self, delay):
+        """Run the next poll after delay seconds, replacing any pending one."""
+        if self.poll_job is not None:
+            self.root.after_cancel(self.poll_job)
+        self.poll_job = self.root.after(int(delay * 1000), self.update_messages_loop)
 
-        self.message_display.config(state="disabled")
+    def poke_poller(self):
+        """Switch to fast polling because the user is active in a conversation."""
+        self.poller.mark_activity()
+        if self.messenger and not self.retrieve_pending:
+            self.schedule_poll(self.poller.active_interval)
 
     def update_messages_loop(self):
-        """Periodically check and retrieve new messages."""
-        if self.messenger:
-            new_messages = self.messenger.retrieve_new()
-            for m in new_messages:
-                entry = f"{m.sender} → You: {m.message}"
-                diary = Diary(entry=entry, timestamp=float(m.timestamp))
-                self.notebook.add_diary(diary)
-                if m.sender not in self.notebook.contacts:
-                    self.notebook.contacts.append(m.sender)
-                    self.contact_list.insert("", "end", iid=m.sender, text=m.sender)
-            self.notebook.save(self.notebook_path)
+        """Request new messages from the background worker."""
+        self.poll_job = None
+        if self.messenger and not self.retrieve_pending:
+            self.retrieve_pending = True
+            self.worker.submit(self.messenger.retrieve_new, on_done=self.on_messages_received)
+        elif not self.retrieve_pending:
+            self.schedule_poll(self.poller.next_delay())
+
+    def on_messages_received(self, new_messages, _error):
+        """Store messages fetched by the worker, refresh the view and schedule the next poll."""
+        self.retrieve_pending = False
+        diaries = []
+        for m in new_messages or []:
+            if not self.contact_list.exists(m.sender):
+                self.contact_list.insert("", "end", iid=m.sender, text=m.sender)
+            entry = f"{m.sender} → You: {m.message}"
+            diaries.append(Diary(entry=entry, timestamp=float(m.timestamp)))
+        if self.notebook.merge_diaries(diaries).inserted:
+            self.notebook.mark_dirty()
+            self.display_conversation()
 
-        self.display_conversation()
-        self.root.after(5000, self.update_messages_loop)  # Check every 5 seconds
+        self.schedule_poll(self.poller.next_delay(bool(diaries), self.messenger.retry_after))
+
+    def on_close(self):
+        """Flush pending notebook changes and close the window."""
+        self.worker.stop()
+        self.notebook.flush()
+        self.root.destroy()
 
 
 if __name__ == '__main__':
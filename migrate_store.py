@@ -0,0 +1,390 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Offline migration and inspection tool for a DSUServer store.
+
+users.json is parsed one user at a time with json.JSONDecoder.raw_decode
+over fixed-size chunks, so memory is bounded by the largest single user
+record rather than the whole file. Each user can be written to one of
+two target layouts, and the target is read back to verify per-user message
+counts:
+
+    shards  one store directory per hash partition (shard-0, shard-1, ...)
+            with its own users.json and archive, as served by
+            server.py --processes N
+    sqlite  a SQLite database with a users table and a messages table,
+            archived messages included
+
+Without --to the store is only inspected. Per-user size statistics are
+printed in every mode:
+
+    python migrate_store.py store
+    python migrate_store.py store --to shards --out store-sharded --partitions 4
+    python migrate_store.py store --to sqlite --out store.db
+
+Exits with status 1 if verification finds a mismatch.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+from pathlib import Path
+
+from server import ARCHIVE_DIR_PATH, SHARD_DIR_PATTERN, USERS_PATH, archive_dir_name, partition_of
+
+CHUNK_SIZE = 1 << 20
+TARGETS = ("shards", "sqlite")
+DEFAULT_TOP = 20
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_SCHEMA = """
+CREATE TABLE users (
+    username TEXT PRIMARY KEY,
+    password TEXT,
+    bio TEXT,
+    posts TEXT,
+    version INTEGER,
+    next_id INTEGER
+);
+CREATE TABLE messages (
+    username TEXT NOT NULL,
+    id INTEGER,
+    peer TEXT,
+    direction TEXT,
+    message TEXT,
+    timestamp REAL,
+    status TEXT,
+    archived INTEGER NOT NULL
+);
+CREATE INDEX messages_by_user ON messages (username, id);
+"""
+
+
+class _ChunkReader:
+    """Reads JSON tokens and values from a text stream a chunk at a time."""
+
+    def __init__(self, stream, chunk_size: int):
+        """Wraps stream; chunk_size is the number of characters read at once."""
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size: int) -> bool:
+        """Drops the consumed part of the buffer and appends up to size characters.
+
+        Returns:
+            bool: False once the end of the stream is reached.
+        """
+        data = self.stream.read(size)
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        self.eof = not data
+        return bool(data)
+
+    def _skip_whitespace(self):
+        """Moves past whitespace, reading more of the stream as needed."""
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self._fill(self.chunk_size):
+                return
+
+    def token(self) -> str:
+        """Returns the next non-whitespace character.
+
+        Raises:
+            ValueError: At the end of the stream.
+        """
+        self._skip_whitespace()
+        if self.pos >= len(self.buffer):
+            raise ValueError("Unexpected end of users.json")
+        char = self.buffer[self.pos]
+        self.pos += 1
+        return char
+
+    def peek(self) -> str:
+        """Returns the next non-whitespace character without consuming it."""
+        self._skip_whitespace()
+        return self.buffer[self.pos:self.pos + 1]
+
+    def value(self, decoder: json.JSONDecoder):
+        """Decodes the next JSON value.
+
+        A value cut off at the end of the buffer fails to decode, so the
+        buffer grows (doubling, to keep huge records linear) and decoding is
+        retried. Only strings and objects are read, which cannot decode
+        successfully while truncated.
+
+        Raises:
+            json.JSONDecodeError: If the value is invalid.
+        """
+        self._skip_whitespace()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill(max(self.chunk_size, len(self.buffer) - self.pos)):
+                    raise
+                continue
+            self.pos = end
+            return value
+
+
+def iter_users(path, chunk_size: int = CHUNK_SIZE):
+    """
+    Streams (username, record) pairs from a users.json file.
+
+    Args:
+        path: Path of users.json.
+        chunk_size (int): Characters read from the file at a time.
+
+    Yields:
+        tuple: The username and its decoded record.
+
+    Raises:
+        ValueError: If the file is not a JSON object of user records.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as users_file:
+        reader = _ChunkReader(users_file, chunk_size)
+        if reader.token() != "{":
+            raise ValueError("users.json is not a JSON object")
+        if reader.peek() == "}":
+            return
+        while True:
+            username = reader.value(decoder)
+            if not isinstance(username, str) or reader.token() != ":":
+                raise ValueError("Malformed user entry in users.json")
+            yield username, reader.value(decoder)
+            separator = reader.token()
+            if separator == "}":
+                return
+            if separator != ",":
+                raise ValueError("Malformed user entry in users.json")
+
+
+def archive_segments(store_dir, username: str) -> list:
+    """Returns the archive segment paths of a user, oldest first."""
+    return sorted((Path(store_dir) / ARCHIVE_DIR_PATH / archive_dir_name(username)).glob("*.jsonl.gz"))
+
+
+def iter_archived(segments):
+    """Streams the messages stored in archive segments."""
+    for path in segments:
+        with gzip.open(path, "rb") as segment:
+            for line in segment:
+                yield json.loads(line)
+
+
+def user_stats(username: str, record: dict, archived: int) -> dict:
+    """
+    Returns size statistics for one user record.
+
+    Args:
+        username (str): The user's name.
+        record (dict): The user's record from users.json.
+        archived (int): Number of the user's archived messages.
+    """
+    messages = record.get("messages", [])
+    return {
+        "user": username,
+        "messages": len(messages),
+        "unread": sum(1 for m in messages if m.get("status") == "unread"),
+        "archived": archived,
+        "bytes": len(json.dumps(record)),
+    }
+
+
+class ShardWriter:
+    """Writes users into one store directory per partition, as server.py --processes expects."""
+
+    def __init__(self, out_dir, partitions: int):
+        """Creates the shard directories and starts each shard's users.json."""
+        self.out_dir = Path(out_dir)
+        self.partitions = partitions
+        self.files = []
+        self.counts = [0] * partitions
+        for index in range(partitions):
+            shard = self.out_dir / SHARD_DIR_PATTERN.format(index)
+            shard.mkdir(parents=True)
+            users_file = open(shard / (USERS_PATH + ".tmp"), "w", encoding="utf-8")  # pylint: disable=consider-using-with
+            users_file.write("{")
+            self.files.append(users_file)
+
+    def add(self, username: str, record: dict, segments: list) -> int:
+        """Appends a user to its shard and copies its archive; returns its message count."""
+        index = partition_of(username, self.partitions)
+        users_file = self.files[index]
+        if self.counts[index]:
+            users_file.write(", ")
+        users_file.write(f"{json.dumps(username)}: {json.dumps(record)}")
+        self.counts[index] += 1
+        if segments:
+            shutil.copytree(segments[0].parent, self.out_dir / SHARD_DIR_PATTERN.format(index)
+                            / ARCHIVE_DIR_PATH / segments[0].parent.name)
+        return len(record.get("messages", [])) + sum(1 for _ in iter_archived(segments))
+
+    def close(self):
+        """Finishes every shard's users.json and moves it into place."""
+        for index, users_file in enumerate(self.files):
+            users_file.write("}")
+            users_file.close()
+            shard = self.out_dir / SHARD_DIR_PATTERN.format(index)
+            os.replace(shard / (USERS_PATH + ".tmp"), shard / USERS_PATH)
+
+    def count_messages(self, chunk_size: int = CHUNK_SIZE) -> dict:
+        """Reads the shards back and returns the message count of every user."""
+        counts = {}
+        for index in range(self.partitions):
+            shard = self.out_dir / SHARD_DIR_PATTERN.format(index)
+            for username, record in iter_users(shard / USERS_PATH, chunk_size):
+                archived = sum(1 for _ in iter_archived(archive_segments(shard, username)))
+                counts[username] = len(record.get("messages", [])) + archived
+        return counts
+
+
+class SqliteWriter:
+    """Writes users and their hot and archived messages into a SQLite database."""
+
+    def __init__(self, db_path):
+        """Creates the database and its tables."""
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(_SCHEMA)
+
+    def add(self, username: str, record: dict, segments: list) -> int:
+        """Inserts a user and its messages; returns its message count."""
+        self.conn.execute(
+            "INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)",
+            (username, record.get("password"), json.dumps(record.get("bio")),
+             json.dumps(record.get("posts", [])), record.get("version", 0), record.get("next_id")))
+        rows = [self._row(username, m, 0) for m in record.get("messages", [])]
+        rows.extend(self._row(username, m, 1) for m in iter_archived(segments))
+        self.conn.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    @staticmethod
+    def _row(username: str, message: dict, archived: int) -> tuple:
+        """Returns the messages table row of a stored message."""
+        incoming = "from" in message
+        timestamp = message.get("timestamp")
+        try:
+            timestamp = float(timestamp)
+        except (TypeError, ValueError):
+            timestamp = None
+        return (username, message.get("id"), message.get("from" if incoming else "recipient"),
+                "in" if incoming else "out", message.get("message"), timestamp,
+                message.get("status"), archived)
+
+    def close(self):
+        """Commits the database."""
+        self.conn.commit()
+
+    def count_messages(self, chunk_size: int = CHUNK_SIZE) -> dict:  # pylint: disable=unused-argument
+        """Returns the message count of every user in the database."""
+        counts = {username: 0 for (username,) in self.conn.execute("SELECT username FROM users")}
+        counts.update(self.conn.execute("SELECT username, COUNT(*) FROM messages GROUP BY username"))
+        self.conn.close()
+        return counts
+
+
+def migrate(store_dir, target: str = None, out=None, partitions: int = 2,
+            chunk_size: int = CHUNK_SIZE) -> tuple:
+    """
+    Streams a store into a target layout, or only inspects it if target is None.
+
+    Args:
+        store_dir: The store directory holding users.json and the archive.
+        target (str): "shards", "sqlite" or None.
+        out: Output directory for shards or database path for sqlite.
+        partitions (int): Number of shards.
+        chunk_size (int): Characters of users.json read at a time.
+
+    Returns:
+        tuple: Per-user statistics and a list of (user, expected, written)
+        verification mismatches.
+
+    Raises:
+        FileExistsError: If out already exists.
+    """
+    if target is not None and Path(out).exists():
+        raise FileExistsError(f"{out} already exists")
+    if target == "shards":
+        writer = ShardWriter(out, partitions)
+    elif target == "sqlite":
+        writer = SqliteWriter(out)
+    else:
+        writer = None
+
+    stats = []
+    expected = {}
+    for username, record in iter_users(Path(store_dir) / USERS_PATH, chunk_size):
+        segments = archive_segments(store_dir, username)
+        if writer is not None:
+            expected[username] = writer.add(username, record, segments)
+            archived = expected[username] - len(record.get("messages", []))
+        else:
+            archived = sum(1 for _ in iter_archived(segments))
+        stats.append(user_stats(username, record, archived))
+
+    mismatches = []
+    if writer is not None:
+        writer.close()
+        written = writer.count_messages(chunk_size)
+        mismatches = [(user, expected.get(user), written.get(user))
+                      for user in sorted(expected.keys() | written.keys())
+                      if expected.get(user) != written.get(user)]
+    return stats, mismatches
+
+
+def print_stats(stats: list, top: int = DEFAULT_TOP, out=None):
+    """Prints totals and the largest users by record size."""
+    out = out or sys.stdout
+    totals = {key: sum(s[key] for s in stats) for key in ("messages", "unread", "archived", "bytes")}
+    print(f"{len(stats)} users, {totals['messages']} hot messages ({totals['unread']} unread), "
+          f"{totals['archived']} archived, {totals['bytes']} bytes", file=out)
+    print(f"{'user':24} {'messages':>10} {'unread':>8} {'archived':>10} {'bytes':>12}", file=out)
+    for s in sorted(stats, key=lambda s: s["bytes"], reverse=True)[:top]:
+        print(f"{s['user']:24} {s['messages']:10} {s['unread']:8} {s['archived']:10} {s['bytes']:12}",
+              file=out)
+
+
+def main(argv=None) -> int:
+    """Command line entry point."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("store", help="store directory containing users.json")
+    parser.add_argument("--to", choices=TARGETS, help="target layout; only inspect if omitted")
+    parser.add_argument("--out", help="output directory (shards) or database file (sqlite)")
+    parser.add_argument("--partitions", type=int, default=2, help="number of shards")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="characters of users.json read at a time")
+    parser.add_argument("--top", type=int, default=DEFAULT_TOP, help="largest users to list")
+    args = parser.parse_args(argv)
+    if args.to and not args.out:
+        parser.error("--out is required with --to")
+    if args.partitions < 1:
+        parser.error("--partitions must be at least 1")
+
+    try:
+        stats, mismatches = migrate(args.store, args.to, args.out, args.partitions, args.chunk_size)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(f"Migration failed: {e}", file=sys.stderr)
+        return 1
+    print_stats(stats, args.top)
+    for user, expected, written in mismatches:
+        print(f"MISMATCH {user}: expected {expected} messages, target has {written}", file=sys.stderr)
+    if mismatches:
+        return 1
+    if args.to:
+        print(f"Verified {len(stats)} users in {args.out}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,10 +15,26 @@
 # camermc3@uci.edu
 # 49753193
 
+import atexit
+import gzip
+import hashlib
 import json
+import os
+import tempfile
+import threading
 import time
+from collections import namedtuple
 from pathlib import Path
 
+MergeResult = namedtuple("MergeResult", ["inserted", "skipped"])
+
+ARROW = "→"
+SELF_NAME = "You"
+
+ARCHIVE_FORMAT = "ds-notebook-archive"
+ARCHIVE_VERSION = 1
+ARCHIVE_BATCH_SIZE = 1000
+
 
 class NotebookFileError(Exception):
     """Raised when there is an error saving or loading a notebook file."""
@@ -75,6 +91,37 @@ class Diary(dict):
     timestamp = property(get_time, set_time)
 
 
+def split_entry(entry: str) -> tuple:
+    """
+    Splits a message entry of the form "sender → recipient: text".
+
+    Args:
+        entry (str): The diary entry string.
+
+    Returns:
+        tuple: (peer, direction, text) where direction is "out" for messages
+        sent by the user, "in" for received ones, or (None, None, entry) if
+        the entry is not a message.
+    """
+    head, colon, text = (entry or "").partition(":")
+    if not colon or ARROW not in head:
+        return None, None, entry
+    sender, recipient = (part.strip() for part in head.split(ARROW, 1))
+    text = text.strip()
+    if sender == SELF_NAME:
+        return recipient, "out", text
+    return sender, "in", text
+
+
+def diary_key(diary: Diary) -> tuple:
+    """
+    Returns the dedup key of a diary: (timestamp, peer, direction, body digest).
+    """
+    peer, direction, text = split_entry(diary.entry)
+    digest = hashlib.sha1((text or "").encode("utf-8")).digest()
+    return float(diary.timestamp), peer, direction, digest
+
+
 class Notebook:
     """
     The Notebook class stores user profile info and diary entries.
@@ -93,13 +140,95 @@ class Notebook:
         self.password = password
         self.bio = bio
         self._diaries = []
-        self.contacts = []
+        self._index = {}
+        self._contacts = {}
+        self._generation = 0
+        self._autosaver = None
+
+    @property
+    def contacts(self):
+        """
+        Returns the contacts as an insertion-ordered, set-like view.
+
+        Membership tests are O(1). Use add_contact() to add a contact.
+        """
+        return self._contacts.keys()
+
+    @property
+    def generation(self) -> int:
+        """
+        Returns a counter that changes whenever diaries are removed or replaced.
+
+        Adding diaries only appends to the list and leaves it unchanged, so a
+        view built from a prefix of the diaries stays valid while it holds.
+        """
+        return self._generation
+
+    @contacts.setter
+    def contacts(self, names) -> None:
+        """
+        Replaces the contacts, dropping duplicates and keeping first-seen order.
+        """
+        self._contacts = dict.fromkeys(names)
+
+    def add_contact(self, name: str) -> bool:
+        """
+        Adds a contact if it is not already present.
+
+        Returns:
+            bool: True if the contact was added, False if it already existed.
+        """
+        if not name or name in self._contacts:
+            return False
+        self._contacts[name] = None
+        return True
+
+    def _index_diary(self, diary: Diary) -> None:
+        """
+        Counts a diary in the dedup index.
+        """
+        key = diary_key(diary)
+        self._index[key] = self._index.get(key, 0) + 1
 
     def add_diary(self, diary: Diary) -> None:
         """
         Adds a Diary object to the list of diaries.
         """
         self._diaries.append(diary)
+        self._index_diary(diary)
+
+    def has_diary(self, diary: Diary) -> bool:
+        """
+        Returns True if an equivalent diary is already in the notebook.
+        """
+        return diary_key(diary) in self._index
+
+    def merge_diaries(self, diaries) -> MergeResult:
+        """
+        Adds a batch of message diaries, skipping ones already present.
+
+        Duplicates are detected by (timestamp, peer, direction, body digest),
+        both against the notebook and within the batch. The peer of every
+        inserted message is added to the contacts.
+
+        Args:
+            diaries (Iterable[Diary]): The diaries to merge.
+
+        Returns:
+            MergeResult: Counts of inserted and skipped diaries.
+        """
+        inserted = skipped = 0
+        for diary in diaries:
+            key = diary_key(diary)
+            if key in self._index:
+                skipped += 1
+                continue
+            self._diaries.append(diary)
+            self._index[key] = 1
+            if key[1]:
+                self.add_contact(key[1])
+            inserted += 1
+        return MergeResult(inserted, skipped)
 
     def del_diary(self, index: int) -> bool:
         """
@@ -109,10 +238,16 @@ class Notebook:
             bool: True if deletion was successful, False otherwise.
         """
         try:
-            del self._diaries[index]
-            return True
+            diary = self._diaries.pop(index)
         except IndexError:
             return False
+        self._generation += 1
+        key = diary_key(diary)
+        if self._index.get(key, 0) > 1:
+            self._index[key] -= 1
+        else:
+            self._index.pop(key, None)
+        return True
 
     def get_diaries(self) -> list[Diary]:
         """
@@ -123,10 +258,48 @@ class Notebook:
         """
         return self._diaries
 
+    def enable_autosave(self, path: str, delay: float = 1.0) -> 'NotebookAutosaver':
+        """
+        Turns on debounced background saving to the given path.
+
+        After this call, mark_dirty() schedules a save instead of writing
+        immediately. Any pending changes are also flushed at interpreter exit.
+
+        Args:
+            path (str): Path of the JSON file to save to.
+            delay (float): Seconds to wait and coalesce changes before saving.
+
+        Returns:
+            NotebookAutosaver: The autosave manager attached to this notebook.
+        """
+        if self._autosaver is not None:
+            self._autosaver.close()
+        self._autosaver = NotebookAutosaver(self, path, delay)
+        return self._autosaver
+
+    def mark_dirty(self) -> None:
+        """
+        Records that the notebook changed and schedules a background save.
+
+        Does nothing if autosave has not been enabled.
+        """
+        if self._autosaver is not None:
+            self._autosaver.mark_dirty()
+
+    def flush(self) -> None:
+        """
+        Writes any pending autosave changes to disk right away.
+        """
+        if self._autosaver is not None:
+            self._autosaver.flush()
+
     def save(self, path: str) -> None:
         """
         Saves the Notebook instance to a JSON file.
 
+        The data is written to a temporary file in the same directory and
+        then renamed over the target, so a crash never leaves a partial file.
+
         Args:
             path (str): Path to save the JSON file.
 
@@ -135,18 +308,31 @@ class Notebook:
         """
         p = Path(path)
 
-        if p.suffix == '.json':
-            with open(p, 'w', encoding='utf-8') as f:
-                json.dump({
-                    'username': self.username,
-                    'password': self.password,
-                    'bio': self.bio,
-                    'contacts': self.contacts,
-                    '_diaries': [d.__dict__ for d in self._diaries]
-                }, f, indent=4)
-        else:
+        if p.suffix != '.json':
             raise NotebookFileError("Invalid notebook file path or type")
 
+        data = {
+            'username': self.username,
+            'password': self.password,
+            'bio': self.bio,
+            'contacts': list(self.contacts),
+            '_diaries': [d.__dict__ for d in list(self._diaries)]
+        }
+        fd, tmp_path = tempfile.mkstemp(prefix=f'.{p.name}.', suffix='.tmp',
+                                        dir=p.parent)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, p)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
     def load(self, filepath: str):
         """
         Loads the Notebook data from JSON file.
@@ -165,9 +351,220 @@ class Notebook:
                 self.bio = data['bio']
                 self.contacts = data['contacts']
                 self._diaries = []
+                self._index = {}
+                self._generation += 1
 
                 for diary in data.get('_diaries', []):
-                    self._diaries.append(Diary(diary['_entry'], diary['_timestamp']))
+                    self.add_diary(Diary(diary['_entry'], diary['_timestamp']))
         except Exception as e:
             print("Error loading notebook:", e)
             raise IncorrectNotebookError("Failed to load notebook.") from e
+
+    def export_archive(self, path: str, compresslevel: int = 6) -> int:
+        """
+        Writes the notebook to a gzip-compressed JSON-lines archive.
+
+        The first line holds the profile, followed by one line per contact
+        and one line per diary. Records are written one at a time, so no
+        serialized copy of the whole notebook is ever built in memory.
+
+        Args:
+            path (str): Path of the archive to write.
+            compresslevel (int): gzip compression level from 1 to 9.
+
+        Returns:
+            int: The number of diaries written.
+
+        Raises:
+            NotebookFileError: If the archive cannot be written.
+        """
+        header = {
+            'format': ARCHIVE_FORMAT,
+            'version': ARCHIVE_VERSION,
+            'profile': {'username': self.username, 'password': self.password, 'bio': self.bio}
+        }
+        count = 0
+        p = Path(path)
+        try:
+            # Written beside the target and moved into place, so a failed export never leaves a truncated archive
+            fd, tmp_path = tempfile.mkstemp(prefix=f'.{p.name}.', suffix='.tmp', dir=p.parent)
+        except OSError as e:
+            raise NotebookFileError("Failed to write notebook archive.") from e
+        try:
+            with os.fdopen(fd, 'wb') as raw, \
+                    gzip.open(raw, 'wt', encoding='utf-8', compresslevel=compresslevel) as f:
+                f.write(json.dumps(header, separators=(',', ':')) + '\n')
+                for contact in list(self.contacts):
+                    f.write(json.dumps({'contact': contact}, separators=(',', ':')) + '\n')
+                for diary in list(self._diaries):
+                    f.write(json.dumps({'entry': diary.entry, 'timestamp': diary.timestamp},
+                                       separators=(',', ':')) + '\n')
+                    count += 1
+            os.replace(tmp_path, p)
+        except BaseException as e:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            if not isinstance(e, OSError):
+                raise
+            raise NotebookFileError("Failed to write notebook archive.") from e
+        return count
+
+    def import_archive(self, path: str) -> MergeResult:
+        """
+        Reads a notebook archive and merges it into this notebook.
+
+        The profile replaces the current one, contacts are added and diaries
+        are merged in batches, so importing the same archive twice is a no-op.
+
+        Args:
+            path (str): Path of the archive to read.
+
+        Returns:
+            MergeResult: Counts of inserted and skipped diaries.
+
+        Raises:
+            IncorrectNotebookError: If the archive is corrupted or invalid.
+        """
+        inserted = skipped = 0
+        batch = []
+        for kind, record in iter_archive(path):
+            if kind == 'profile':
+                self.username = record['username']
+                self.password = record['password']
+                self.bio = record['bio']
+            elif kind == 'contact':
+                self.add_contact(record)
+            else:
+                batch.append(record)
+                if len(batch) >= ARCHIVE_BATCH_SIZE:
+                    result = self.merge_diaries(batch)
+                    inserted += result.inserted
+                    skipped += result.skipped
+                    batch = []
+        result = self.merge_diaries(batch)
+        return MergeResult(inserted + result.inserted, skipped + result.skipped)
+
+
+def iter_archive(path: str):
+    """
+    Streams the records of a notebook archive one line at a time.
+
+    Args:
+        path (str): Path of the archive to read.
+
+    Yields:
+        tuple: ("profile", dict), then ("contact", str) and ("diary", Diary)
+        records in the order they were written.
+
+    Raises:
+        IncorrectNotebookError: If the archive is corrupted or invalid.
+    """
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            if header.get('format') != ARCHIVE_FORMAT or header.get('version') != ARCHIVE_VERSION:
+                raise IncorrectNotebookError("Unsupported notebook archive.")
+            yield 'profile', header['profile']
+
+            for line in f:
+                record = json.loads(line)
+                if 'contact' in record:
+                    yield 'contact', record['contact']
+                else:
+                    yield 'diary', Diary(record['entry'], record['timestamp'])
+    except IncorrectNotebookError:
+        raise
+    except (OSError, EOFError, ValueError, KeyError, AttributeError, TypeError) as e:
+        raise IncorrectNotebookError("Failed to read notebook archive.") from e
+
+
+class NotebookAutosaver:
+    """
+    Coalesces notebook saves and performs them on a background thread.
+
+    The first mark_dirty() in a quiet period starts a timer; further changes
+    made before it fires are written by the same save. A save that fails
+    starts the timer again, so the changes are retried without a new edit.
+    """
+
+    def __init__(self, notebook: Notebook, path: str, delay: float = 1.0):
+        """
+        Creates an autosave manager for a notebook.
+
+        Args:
+            notebook (Notebook): The notebook to save.
+            path (str): Path of the JSON file to save to.
+            delay (float): Seconds to wait and coalesce changes before saving.
+        """
+        self.notebook = notebook
+        self.path = path
+        self.delay = delay
+        self._dirty = False
+        self._timer = None
+        self._closed = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        atexit.register(self.flush)
+
+    @property
+    def dirty(self) -> bool:
+        """
+        Returns True if there are changes that have not been saved yet.
+        """
+        return self._dirty
+
+    def mark_dirty(self) -> None:
+        """
+        Flags the notebook as changed and starts the save timer if needed.
+        """
+        with self._lock:
+            self._dirty = True
+            self._schedule()
+
+    def _schedule(self) -> None:
+        """
+        Starts the save timer unless one is pending. Must be called with the lock held.
+        """
+        if self._timer is None and not self._closed:
+            self._timer = threading.Timer(self.delay, self._on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _on_timer(self) -> None:
+        """
+        Timer callback that runs the coalesced save.
+        """
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Saves the notebook now if it has unsaved changes.
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                self._dirty = False
+            try:
+                self.notebook.save(self.path)
+            except (OSError, NotebookFileError) as e:
+                print("Error saving notebook:", e)
+                with self._lock:
+                    self._dirty = True
+                    self._schedule()
+
+    def close(self) -> None:
+        """
+        Cancels the pending timer, flushes changes and detaches the exit hook.
+        """
+        with self._lock:
+            self._closed = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        self.flush()
+        atexit.unregister(self.flush)
@@ -6,21 +6,77 @@ import socket
 import threading
 import json
 from pathlib import Path
-import sys
 from datetime import datetime
 import string
 import secrets
+import time
+import os
+import queue
+import selectors
+import argparse
+import logging
+import zlib
+import shutil
+import tempfile
+import multiprocessing
+import gzip
+from urllib.parse import quote
+from multiprocessing.connection import Listener, Client
+from multiprocessing.reduction import send_handle, recv_handle
+import re
+import heapq
+from itertools import chain, islice
+from collections import OrderedDict, deque
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from ds_logging import PAYLOAD_SAMPLE_RATE, get_logger, setup_logging, RequestLogger
+from ds_protocol import (BINARY_ENCODING, ZLIB_ENCODING, FRAME_FLAG, FRAME_HEADER, COMPRESS_THRESHOLD, COMPRESS_LEVEL,
+                         decode_frame, iter_encoded)
 
 USERS_PATH = 'users.json'
 STORE_DIR_PATH = 'store'
+STATS_PATH = 'stats.json'
+ARCHIVE_DIR_PATH = 'archive' ##per-user compressed segments of old read messages, inside the store directory
+ARCHIVE_AFTER = 7 * 24 * 3600 ##seconds after which read and sent messages leave the hot store, 0 disables archiving
+ARCHIVE_INTERVAL = 3600 ##seconds between archival passes
+STATS_INTERVAL = 10 ##seconds between stats snapshots written to the store directory, 0 disables them
+MAX_WORKERS = 32 ##threads serving connections
+ACCEPT_QUEUE_SIZE = 64 ##accepted connections waiting for a free worker before new ones are rejected
+LISTEN_BACKLOG = 128
+IDLE_TIMEOUT = 300 ##seconds a connection may wait between requests
+READ_TIMEOUT = 10 ##seconds a client has to finish sending a request once it started
+DRAIN_TIMEOUT = 5 ##seconds to let in-flight requests finish on shutdown
+MAX_LINE_BYTES = 1 << 20
+BUSY_RETRY_AFTER = 1 ##seconds suggested to clients rejected because the server is busy
+USER_LIMIT = (20, 40) ##(requests per second, burst) allowed per authenticated user, rate 0 disables
+ADDRESS_LIMIT = (100, 200) ##(requests per second, burst) allowed per client address
+FETCH_ALL_LIMIT = (0.5, 5) ##(requests per second, burst) of 'fetch all' per user, on top of USER_LIMIT
+MAX_LIMITED_KEYS = 10000 ##buckets kept per limiter before idle ones are pruned
+SEARCH_LIMIT = 20 ##results returned by search when the client does not ask for a limit
+MAX_SEARCH_LIMIT = 200
+MAX_INDEXED_USERS = 1000 ##search and thread indexes kept in memory, least recently used users are dropped first
+CONVERSATION_PAGE = 50 ##messages per 'fetch conversation' page when the client does not ask for a limit
+MAX_CONVERSATION_PAGE = 500
+RESPONSE_CACHE_BYTES = 64 << 20 ##encoded 'fetch all' responses kept for repeated fetches of unchanged mailboxes
+SHARD_DIR_PATTERN = 'shard-{}' ##per-partition store directory inside the store when running multiple processes
+IPC_CONNECT_TIMEOUT = 5 ##seconds to keep retrying a partition that is still starting up
+ROUTER_POLL_INTERVAL = 0.5 ##seconds between the cluster front end's checks for shutdown and first requests that timed out
+REPLICATION_BACKLOG = 10000 ##store mutations kept in memory so a follower that reconnects can catch up without a snapshot
+REPLICATION_HEARTBEAT = 1 ##seconds between heartbeats to a follower while there are no mutations
+REPLICATION_TIMEOUT = 5 ##seconds a follower waits to hear from the primary before reconnecting
+REPLICATION_RETRY = 1 ##seconds between a follower's attempts to reach the primary
+READ_ONLY_MESSAGE = 'Read-only replica, send this command to the primary.'
 DEBUG = True ##SET THIS TO FALSE IF YOU DONT WANT DEBUGGING OUTPUT
 
+logger = get_logger('server')
+
 ##The server uses a json files to store data:
 ##users - bio's, posts
 
 ##user schema:
-#{user_name: {'password', messages[{'entry','from/recipient', 'timestamp','status'}]
+#{user_name: {'password', 'version', 'next_id', messages[{'id', 'entry','from/recipient', 'timestamp','status'}]
 #status can be "unread" or "read"
+#ids count up from 1 in every mailbox, so a mailbox is in id order and timestamps are seconds since the epoch
 #"from" denotes the user recieved the message and "recipient" denotes that they sent it
 
 def generate_token():
@@ -32,43 +88,484 @@ def _generate_random_string(n:int) -> str:
     alphanums = string.ascii_letters + string.digits
     return ''.join(secrets.choice(alphanums) for _ in range(n))
 
+def command_name(command):
+    '''Classify a parsed command for metrics: authenticate, directmessage, fetch_all, fetch_unread, fetch_conversation, search, stats,
+    promote or invalid'''
+    if not isinstance(command, dict):
+        return 'invalid'
+    if 'authenticate' in command:
+        return 'authenticate'
+    if 'directmessage' in command:
+        return 'directmessage'
+    if 'fetch' in command:
+        if isinstance(command['fetch'], dict):
+            return 'fetch_conversation'
+        return f"fetch_{command['fetch']}" if command['fetch'] in ('all', 'unread') else 'fetch_invalid'
+    if 'search' in command:
+        return 'search'
+    if 'stats' in command:
+        return 'stats'
+    if 'promote' in command:
+        return 'promote'
+    return 'invalid'
+
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+class Histogram:
+    '''Fixed-bucket latency histogram in milliseconds. Not thread safe on its own, ServerMetrics locks around it'''
+    def __init__(self, buckets = LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) ##last bucket is everything above the largest bound
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, pct):
+        '''Upper bound of the bucket holding the given percentile'''
+        if not self.count:
+            return 0.0
+        rank = pct / 100 * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        buckets = {f'le_{bound}': n for bound, n in zip(self.buckets, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {
+            'count': self.count,
+            'sum_ms': round(self.total, 3),
+            'max_ms': round(self.max, 3),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+            'p99_ms': self.percentile(99),
+            'buckets': buckets
+        }
+
+class ServerMetrics:
+    '''Thread safe counters and histograms describing what the server is doing'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.commands = {} ##command name -> {'count', 'errors', 'latency'}
+        self.lock_wait = Histogram()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.active_connections = 0
+        self.total_connections = 0
+        self.throttled = {} ##command name -> requests rejected by rate limits
+
+    def observe_command(self, name, seconds, ok = True):
+        with self._lock:
+            stats = self.commands.get(name)
+            if stats is None:
+                stats = self.commands[name] = {'count': 0, 'errors': 0, 'latency': Histogram()}
+            stats['count'] += 1
+            if not ok:
+                stats['errors'] += 1
+            stats['latency'].observe(seconds * 1000)
+
+    def observe_throttled(self, name):
+        with self._lock:
+            self.throttled[name] = self.throttled.get(name, 0) + 1
+
+    def observe_lock_wait(self, seconds):
+        with self._lock:
+            self.lock_wait.observe(seconds * 1000)
+
+    def add_store_io(self, read = 0, written = 0):
+        with self._lock:
+            self.bytes_read += read
+            self.bytes_written += written
+
+    def connection_opened(self):
+        with self._lock:
+            self.active_connections += 1
+            self.total_connections += 1
+
+    def connection_closed(self):
+        with self._lock:
+            self.active_connections -= 1
+
+    def snapshot(self, sessions = 0):
+        '''Return all metrics as a JSON serializable dict'''
+        with self._lock:
+            return {
+                'time': time.time(),
+                'uptime': time.time() - self.started,
+                'active_connections': self.active_connections,
+                'total_connections': self.total_connections,
+                'sessions': sessions,
+                'store_bytes_read': self.bytes_read,
+                'store_bytes_written': self.bytes_written,
+                'lock_wait': self.lock_wait.snapshot(),
+                'throttled': dict(self.throttled),
+                'commands': {name: {'count': c['count'], 'errors': c['errors'], 'latency': c['latency'].snapshot()}
+                             for name, c in self.commands.items()}
+            }
+
+class RateLimiter:
+    '''Token buckets keyed by user or address. Each bucket refills at rate tokens per second up to burst'''
+    def __init__(self, rate, burst, max_keys = MAX_LIMITED_KEYS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.buckets = {} ##key -> [tokens, last refill time]
+        self._lock = threading.Lock()
+
+    def acquire(self, key, now = None):
+        '''Take one token for key. Returns 0 if allowed, otherwise the seconds until a token is available'''
+        if not self.rate:
+            return 0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                if len(self.buckets) >= self.max_keys:
+                    self._prune(now)
+                bucket = self.buckets[key] = [self.burst, now]
+            else:
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / self.rate
+
+    def _prune(self, now):
+        '''Forget buckets that have refilled completely, they behave exactly like new ones'''
+        full = [key for key, (tokens, last) in self.buckets.items() if tokens + (now - last) * self.rate >= self.burst]
+        for key in full:
+            del self.buckets[key]
+
+def message_time(message):
+    '''Numeric timestamp of a stored message, messages with a bad timestamp never look old'''
+    try:
+        return float(message['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        return float('inf')
+
+def message_id(message):
+    return message['id']
+
+def thread_key(message):
+    '''Position of a message in its thread: by time, messages sent at the same time by id'''
+    return message_time(message), message.get('id') or 0
+
+def archive_dir_name(username):
+    '''Directory of a user\'s archive inside the archive directory. Characters unsafe in a path are percent-encoded,
+    and so are the dots of "." and "..", which would otherwise name the archive directory or the store itself. quote
+    never yields a bare "%", so it stands for the empty username'''
+    name = quote(username, safe = '')
+    if name in ('.', '..'):
+        return name.replace('.', '%2E')
+    return name or '%'
+
+def public_message(message):
+    '''The fields of a stored message that are sent to clients'''
+    if 'from' in message:
+        return {'id': message.get('id'), 'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
+    return {'id': message.get('id'), 'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp']}
+
+WORD_PATTERN = re.compile(r'\w+')
+
+def tokenize(text):
+    '''Lowercase words of a message, as indexed and searched'''
+    return WORD_PATTERN.findall(str(text).lower())
+
+class SearchIndex:
+    '''Inverted index over one user\'s messages. Documents are numbered in id order and every posting list is
+    kept sorted, so the newest matches are at the end of the lists'''
+    def __init__(self):
+        self.docs = [] ##doc id -> message as returned to clients
+        self.postings = {} ##term -> ascending doc ids
+        self.terms = [] ##sorted vocabulary for prefix queries
+
+    def add(self, message):
+        doc_id = len(self.docs)
+        self.docs.append(public_message(message))
+        for term in set(tokenize(message['message'])):
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = []
+                insort(self.terms, term)
+            posting.append(doc_id)
+
+    def _postings(self, term, prefix):
+        '''Posting lists of term, or of every word starting with it for a prefix query'''
+        if not prefix:
+            return [self.postings[term]] if term in self.postings else []
+        lists = []
+        i = bisect_left(self.terms, term)
+        while i < len(self.terms) and self.terms[i].startswith(term):
+            lists.append(self.postings[self.terms[i]])
+            i += 1
+        return lists
+
+    def search(self, query, limit = SEARCH_LIMIT):
+        '''Newest messages matching every word of query, a word ending in * matches as a prefix'''
+        words = [(word.rstrip('*'), word.endswith('*')) for word in str(query).lower().split()]
+        terms = [(term, prefix) for word, prefix in words for term in (tokenize(word) or [''])]
+        if not terms or any(not term for term, _ in terms):
+            return []
+        ##walk the smallest term's matches newest first and check the other terms against each message
+        lists = {query_term: self._postings(*query_term) for query_term in terms}
+        driver = min(terms, key = lambda query_term: sum(map(len, lists[query_term])))
+        others = [query_term for query_term in terms if query_term != driver]
+        result = []
+        last = None
+        for doc_id in heapq.merge(*(reversed(posting) for posting in lists[driver]), reverse = True):
+            if doc_id == last:
+                continue ##a message matching several words of a prefix
+            last = doc_id
+            if others:
+                doc_terms = set(tokenize(self.docs[doc_id]['message']))
+                if not all(term in doc_terms if not prefix else any(t.startswith(term) for t in doc_terms)
+                           for term, prefix in others):
+                    continue
+            result.append(self.docs[doc_id])
+            if len(result) >= limit:
+                break
+        return result
+
+class ThreadIndex:
+    '''One user\'s messages grouped into a thread per peer, each thread ordered by time. The cursor for paging
+    backwards is the id of the oldest message of a page, so pages stay put when a late message is inserted'''
+    def __init__(self):
+        self.threads = {} ##peer -> messages as returned to clients, oldest first
+        self.cursors = {} ##message id -> (peer, thread key), to find where a cursor is in its thread
+
+    def add(self, message):
+        doc = public_message(message)
+        peer = message.get('from', message.get('recipient'))
+        thread = self.threads.setdefault(peer, [])
+        key = thread_key(doc)
+        if thread and thread_key(thread[-1]) > key:
+            insort(thread, doc, key = thread_key) ##a forwarded message that arrived late
+        else:
+            thread.append(doc)
+        if doc['id'] is not None:
+            self.cursors[doc['id']] = (peer, key)
+
+    def page(self, peer, limit = CONVERSATION_PAGE, before = None):
+        '''Up to limit messages with peer that come before the message with id before (the newest ones if it is
+        None), oldest first, and the cursor of the next older page or None if this page reaches the start of the
+        thread. A cursor that names no message of the thread gives an empty page'''
+        thread = self.threads.get(peer, [])
+        if before is None:
+            end = len(thread)
+        else:
+            cursor_peer, key = self.cursors.get(before, (None, None))
+            if cursor_peer != peer:
+                return [], None
+            end = bisect_left(thread, key, key = thread_key)
+        start = max(0, end - limit)
+        return thread[start:end], (thread[start]['id'] if start else None)
+
+def partition_of(username, partitions):
+    '''Stable hash partition that owns a user'''
+    return zlib.crc32(str(username).encode()) % partitions
+
+class LineReader:
+    '''Reads newline terminated requests, or length prefixed binary frames, from a socket. Waiting for a request to
+    start is bounded by idle_timeout, receiving the rest of it by read_timeout. Raises socket.timeout when either runs out'''
+    def __init__(self, sock, idle_timeout = IDLE_TIMEOUT, read_timeout = READ_TIMEOUT, max_line = MAX_LINE_BYTES, initial = b''):
+        self.sock = sock
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.max_line = max_line
+        self.buffer = bytearray(initial) ##bytes already read from the socket, e.g. by the cluster front end
+
+    def _request_end(self):
+        '''Length of the complete request at the start of the buffer, or None if more bytes are needed'''
+        if self.buffer and self.buffer[0] & FRAME_FLAG:
+            if len(self.buffer) < FRAME_HEADER.size:
+                return None
+            _, length = FRAME_HEADER.unpack_from(self.buffer)
+            if length > self.max_line:
+                raise ValueError('Request frame too long.')
+            end = FRAME_HEADER.size + length
+            return end if len(self.buffer) >= end else None
+        end = self.buffer.find(b'\n')
+        return end + 1 if end >= 0 else None
+
+    def pop_request(self):
+        '''Remove and return the complete request at the start of the buffer, or None if more bytes are needed'''
+        end = self._request_end()
+        if end is None:
+            if len(self.buffer) > self.max_line + FRAME_HEADER.size:
+                raise ValueError('Request line too long.')
+            return None
+        line = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return line
+
+    def readline(self):
+        '''Return the next line including its terminator or the next whole frame, or whatever is left (possibly b'')
+        at end of stream'''
+        deadline = time.monotonic() + self.read_timeout if self.buffer else None
+        while True:
+            line = self.pop_request()
+            if line is not None:
+                return line
+            if deadline is None:
+                self.sock.settimeout(self.idle_timeout)
+            else:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('Timed out reading request.')
+                self.sock.settimeout(remaining)
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                line = bytes(self.buffer)
+                self.buffer.clear()
+                return line
+            if deadline is None:
+                deadline = time.monotonic() + self.read_timeout
+            self.buffer += chunk
+
 users_file_lock = threading.Lock()
 class DSUServer:
-    def __init__(self, host = '127.0.0.1', port = 3001):
+    def __init__(self, host = '127.0.0.1', port = 3001, store_dir = STORE_DIR_PATH, stats_interval = STATS_INTERVAL,
+                 max_workers = MAX_WORKERS, accept_queue_size = ACCEPT_QUEUE_SIZE, idle_timeout = IDLE_TIMEOUT,
+                 read_timeout = READ_TIMEOUT, drain_timeout = DRAIN_TIMEOUT, partition = 0, partitions = 1,
+                 peer_addresses = None, authkey = None, user_limit = USER_LIMIT, address_limit = ADDRESS_LIMIT,
+                 fetch_all_limit = FETCH_ALL_LIMIT, archive_after = ARCHIVE_AFTER, archive_interval = ARCHIVE_INTERVAL,
+                 compress_threshold = COMPRESS_THRESHOLD, compress_level = COMPRESS_LEVEL, replication_address = None,
+                 follow_address = None, replication_key = None):
         self.host = host
         self.port = port
+        self.store_path = Path(store_dir)
+        self.users_path = self.store_path / USERS_PATH
+        self.stats_path = self.store_path / STATS_PATH
+        self.archive_path = self.store_path / ARCHIVE_DIR_PATH
+        self.archive_after = archive_after
+        self.archive_interval = archive_interval
+        self.compress_threshold = compress_threshold ##responses of at least this many bytes are compressed for clients that accept zlib
+        self.compress_level = compress_level
+        self.stats_interval = stats_interval
+        self.max_workers = max_workers
+        self.accept_queue = queue.Queue(maxsize = accept_queue_size)
+        self.idle_timeout = idle_timeout
+        self.read_timeout = read_timeout
+        self.drain_timeout = drain_timeout
+        self.workers = []
+        self.partition = partition ##index of the user partition this server owns when running as a cluster worker
+        self.partitions = partitions
+        self.peer_addresses = peer_addresses or [] ##IPC address of every partition, indexed by partition
+        self.authkey = authkey
+        self.peer_conns = {} ##partition -> open IPC connection
+        self.peer_locks = [threading.Lock() for _ in self.peer_addresses]
+        self.ipc_listener = None
         self.sessions = {} ##token -> user
-        self.clients = []
+        self.clients = {} ##socket -> True while a request is being processed
+        self.clients_lock = threading.Lock()
+        self.server_socket = None
+        self.ready = threading.Event() ##set once the server is listening
+        self.stopping = threading.Event()
+        self.metrics = ServerMetrics()
+        self.user_limiter = RateLimiter(*user_limit)
+        self.address_limiter = RateLimiter(*address_limit)
+        self.fetch_all_limiter = RateLimiter(*fetch_all_limit)
+        self.search_indexes = OrderedDict() ##username -> SearchIndex, built on first search and kept up to date
+        self.thread_indexes = OrderedDict() ##username -> ThreadIndex, built on first conversation fetch
+        self.mailbox_versions = {} ##username -> version, bumped by every change to the user's messages
+        self.response_cache = OrderedDict() ##(username, binary, compressed) -> (version, encoded 'fetch all' response)
+        self.response_cache_bytes = 0
+        self.response_cache_lock = threading.Lock()
+        self.archive_lock = threading.Lock()
+        self.role = 'follower' if follow_address else 'primary'
+        self.replication_address = replication_address ##where a primary accepts followers, None disables replication
+        self.follow_address = follow_address ##replication address of the primary this server follows
+        self.replication_key = replication_key
+        self.replication_listener = None
+        self.replication_cond = threading.Condition() ##notified whenever a mutation is logged
+        self.replication_log = deque(maxlen = REPLICATION_BACKLOG) ##(seq, time logged, mutation) of the latest mutations
+        self.replication_epoch = generate_token() ##names this primary's log, a follower of any other log needs a snapshot
+        self.replication_seq = 0 ##last mutation logged by a primary or applied by a follower
+        self.followers = 0
+        self.primary_seq = 0 ##last mutation the primary reported to this follower
+        self.apply_delay = 0.0 ##seconds between the primary logging and this follower applying the last batch
+        self.last_contact = None ##monotonic time this follower last heard from the primary
+
+    def _throttle(self, address, username, name):
+        '''Seconds the client should wait before retrying this command, or 0 if it is admitted'''
+        wait = self.address_limiter.acquire(address)
+        if not wait and username is not None:
+            wait = self.user_limiter.acquire(username)
+            if not wait and name == 'fetch_all':
+                wait = self.fetch_all_limiter.acquire(username)
+        return wait
     
-    def handle_client(self, client_socket, client_address):
+    def owns(self, username):
+        '''True if this server stores the given user\'s mailbox'''
+        return self.partitions == 1 or partition_of(username, self.partitions) == self.partition
+
+    def handle_client(self, client_socket, client_address, initial = b''):
 
         '''Handle requests from a single client'''
         current_user_token = None   
-        self.clients.append(client_socket)
+        compress = False ##client accepted zlib when it authenticated
+        with self.clients_lock:
+            self.clients[client_socket] = False
+        self.metrics.connection_opened()
+        log = RequestLogger(logger, peer = f'{client_address[0]}:{client_address[1]}')
+        log.debug('Connection opened.')
+        reader = LineReader(client_socket, self.idle_timeout, self.read_timeout, initial = initial)
         try:
-            while True:
-                data = client_socket.recv(4096)
-                if DEBUG:
-                    print(f"Message received by server: {repr(data)}")
+            while not self.stopping.is_set():
+                data = reader.readline()
+                log.next_request()
+                log.payload('in', data)
                 direct_message_read = False
                 direct_message_sent = False
-                msg = data.decode().strip() 
-                if not msg:
-                    if DEBUG:
-                        print("Connection closed.")
+                sent_id = sent_timestamp = None
+                conversation_fetched = False
+                stats_requested = False
+                mailbox_version = None ##version of the mailbox a fetch response reflects
+                cache_key = None
+                cached = None
+                if not data:
+                    log.debug('Connection closed.')
                     break
+                binary = bool(data[0] & FRAME_FLAG) ##binary requests are answered with binary frames
+                msg = None if binary else data.decode().strip()
+                if not binary and not msg:
+                    continue ##ignore blank lines
+                with self.clients_lock:
+                    self.clients[client_socket] = True
+                started = time.perf_counter()
+                name = 'invalid'
+                retry_after = None
+                encoding = None
+                compression = None
                 try:
-                    command = json.loads(msg.strip())
-                except json.JSONDecodeError:
+                    command = decode_frame(data, request = True) if binary else json.loads(msg)
+                except ValueError:
                     message = 'Incorrectly formatted JSON message.'
                     status = 'error'
                 else: 
                     message = ""
                     status = "error"
-                    
-                    if 'authenticate' in command:
+                    name = command_name(command)
+                    wait = self._throttle(client_address[0], self.sessions.get(current_user_token), name)
+                    if wait:
+                        message = 'Rate limit exceeded, slow down.'
+                        retry_after = round(wait, 3)
+                        self.metrics.observe_throttled(name)
+
+                    elif 'authenticate' in command:
                         
-                        if len(command) != 1: 
+                        if len([key for key in command if key != 'accept']) != 1 or not isinstance(command.get('accept', []), list):
                             status = "error"
                             message = "Incorrectly formatted authenticate command."
                         elif len(command['authenticate']) > 2:
@@ -80,6 +577,12 @@ class DSUServer:
                         elif current_user_token:
                             status = "error"
                             message = "User already authenticated on the active session."
+                        elif not self.owns(command['authenticate']['username']):
+                            status = "error"
+                            message = "User is served by another partition, reconnect and authenticate first."
+                        elif self.role == 'follower' and self._get_user(command['authenticate']['username']) is None:
+                            status = "error"
+                            message = READ_ONLY_MESSAGE ##new users are created by the primary
                         else:
                             ##execute authenticate command
                             
@@ -87,7 +590,10 @@ class DSUServer:
                             password = command['authenticate']['password']
                             
                             
-                            fetched_user = self._get_or_create_new_user(uname, password)
+                            if self.role == 'follower':
+                                fetched_user = self._get_user(uname)
+                            else:
+                                fetched_user = self._get_or_create_new_user(uname, password)
 
                             current_user_token = generate_token()
                             if not fetched_user:
@@ -106,6 +612,10 @@ class DSUServer:
                                     status = "ok"
                                     message = f'Welcome back, {uname}!'
                                     self.sessions[current_user_token] = uname
+                            if status == 'ok' and BINARY_ENCODING in command.get('accept', []):
+                                encoding = BINARY_ENCODING ##the client may send binary frames from now on
+                            if status == 'ok' and ZLIB_ENCODING in command.get('accept', []):
+                                compression = ZLIB_ENCODING ##responses after this one are compressed when large
                     
                     ###direct message handling
                     elif 'directmessage' in command:
@@ -115,6 +625,9 @@ class DSUServer:
                         if 'token' not in command:
                             message = 'Missing token.'
                             status = 'error'
+                        elif self.role == 'follower':
+                            message = READ_ONLY_MESSAGE
+                            status = 'error'
                         elif len(command) != 2:
                             message = "Incorrectly formatted directmessage command."
                             status = 'error'
@@ -128,15 +641,18 @@ class DSUServer:
                             token = command['token']
                             recipient = args['recipient']
                             #timestamp = args['timestamp']
-                            timestamp = str((datetime.now().timestamp()))
+                            timestamp = datetime.now().timestamp()
                             entry = args['entry']
                             if token == current_user_token and token in self.sessions:
                                 current_user = self.sessions[token]
                                 direct_message_sent = True
                                     
-                                if self._send_message(entry,current_user, recipient, timestamp):
+                                stored = self._send_message(entry,current_user, recipient, timestamp)
+                                if stored:
                                     message = f'Direct message sent'
                                     status = 'ok'
+                                    sent_id = stored['id'] ##lets the client match the copy it fetches later
+                                    sent_timestamp = stored['timestamp']
                                 else:
                                     message = f'Unable to send direct message'
                                     status = 'error'
@@ -147,59 +663,209 @@ class DSUServer:
                     elif 'fetch' in command:
                         args = command['fetch']
                         token = command['token']
+                        since = command.get('if_newer_than')
                         if args == 'all':
                             if token == current_user_token and token in self.sessions:
                                 current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_all_messages(current_user)
-                                status = 'ok'
+                                version = self._mailbox_version(current_user)
+                                cache_key = (current_user, binary, compress)
+                                if since is not None and since == version:
+                                    status = 'not_modified'
+                                    mailbox_version = version
+                                    name += '_not_modified'
+                                else:
+                                    ##a fetch all leaves nothing unread, so until the next write the same bytes are the answer
+                                    cached = self._cached_response(cache_key, version)
+                                    if cached is None:
+                                        direct_message_read = True
+                                        message, mailbox_version = self._read_all_messages(current_user,
+                                                                                           mark_read = self.role == 'primary')
+                                    else:
+                                        name += '_cached'
+                                    status = 'ok'
                             else:
                                 message = f'Invalid user token.'
                                 status = 'error'
                         elif args == 'unread':
-                            if token == current_user_token and token in self.sessions:
+                            if self.role == 'follower': ##marking messages read is a write
+                                message = READ_ONLY_MESSAGE
+                                status = 'error'
+                            elif token == current_user_token and token in self.sessions:
                                 current_user = self.sessions[token]
-                                direct_message_read = True
-                                message = self._read_unread_messages(current_user)
-                                status = 'ok'
+                                version = self._mailbox_version(current_user)
+                                if since is not None and since == version:
+                                    status = 'not_modified'
+                                    mailbox_version = version
+                                    name += '_not_modified'
+                                else:
+                                    direct_message_read = True
+                                    message, mailbox_version = self._read_unread_messages(current_user)
+                                    status = 'ok'
                             else:
                                 message = f'Invalid user token.'
                                 status = 'error'
+                        elif isinstance(args, dict):
+                            limit = args.get('limit', CONVERSATION_PAGE)
+                            before = args.get('before')
+                            if not isinstance(args.get('conversation'), str):
+                                message = 'Missing peer for conversation fetch.'
+                                status = 'error'
+                            elif not isinstance(limit, int) or isinstance(limit, bool) or limit < 1 \
+                                    or not (before is None or isinstance(before, int) and not isinstance(before, bool) and before >= 0):
+                                message = 'Conversation limit must be a positive integer and before a message id.'
+                                status = 'error'
+                            elif token == current_user_token and token in self.sessions:
+                                direct_message_read = conversation_fetched = True
+                                message, cursor = self._read_conversation(self.sessions[token], args['conversation'],
+                                                                          min(limit, MAX_CONVERSATION_PAGE), before)
+                                status = 'ok'
+                            else:
+                                message = 'Invalid user token.'
+                                status = 'error'
 
                         else:
                             message = 'Invalid argument for fetch field.'
                             status = 'error'
 
+                    elif 'search' in command:
+                        args = command['search']
+                        token = command.get('token')
+                        if not isinstance(args, dict) or not isinstance(args.get('query'), str):
+                            message = 'Missing query for search command.'
+                            status = 'error'
+                        elif not isinstance(args.get('limit', SEARCH_LIMIT), int) or isinstance(args.get('limit'), bool) \
+                                or args.get('limit', SEARCH_LIMIT) < 1:
+                            message = 'Search limit must be a positive integer.'
+                            status = 'error'
+                        elif token == current_user_token and token in self.sessions:
+                            direct_message_read = True
+                            message = self._search_messages(self.sessions[token], args['query'],
+                                                            min(args.get('limit', SEARCH_LIMIT), MAX_SEARCH_LIMIT))
+                            status = 'ok'
+                        else:
+                            message = 'Invalid user token.'
+                            status = 'error'
+
+                    elif 'stats' in command:
+                        if client_address[0] in ('127.0.0.1', '::1'): ##admin command, local clients only
+                            stats_requested = True
+                            message = self.metrics.snapshot(len(self.sessions))
+                            message['replication'] = self.replication_status()
+                            status = 'ok'
+                        else:
+                            message = 'Stats are only available to local clients.'
+                            status = 'error'
+
+                    elif 'promote' in command:
+                        if client_address[0] not in ('127.0.0.1', '::1'): ##admin command, local clients only
+                            message = 'Promotion is only available to local clients.'
+                            status = 'error'
+                        elif self.promote():
+                            message = 'Promoted to primary.'
+                            status = 'ok'
+                        else:
+                            message = 'Server is already a primary.'
+                            status = 'error'
+
                     else:
                         message = 'Invalid command.'
                         status = 'error'
-                if DEBUG:
-                    print(f'Server sending the following message: "{message}"')
-                if direct_message_read:
+                if stats_requested:
+                    resp = {'response': {'type':status, 'stats': message} }
+                elif direct_message_read:
                     resp = {'response': {'type':status, 'messages': message} }
                 elif direct_message_sent:
                     resp = {'response': {'type':status, 'message': message} }
+                    if sent_id is not None:
+                        resp['response'].update({'id': sent_id, 'timestamp': sent_timestamp})
+                elif status == 'not_modified':
+                    resp = {'response': {'type':status} }
                 elif status == 'ok':
                     resp = {'response': {'type':status, 'message': message, 'token': current_user_token} }
                 else:
                     resp = {'response': {'type':status, 'message': message}}
-                json_response = json.dumps(resp).encode()
-                client_socket.sendall(json_response + b'\r\n')
-            if current_user_token and current_user_token in self.sessions:
-                del self.sessions[current_user_token]
+                if retry_after is not None:
+                    resp['response']['retry_after'] = retry_after
+                if conversation_fetched:
+                    resp['response']['cursor'] = cursor
+                if mailbox_version is not None:
+                    resp['response']['version'] = mailbox_version
+                if encoding:
+                    resp['response']['encoding'] = encoding
+                if compression:
+                    resp['response']['compression'] = compression
+                ##large responses are compressed and sent chunk by chunk while they are being encoded
+                if cached is None:
+                    chunks = iter_encoded(resp, binary, self.compress_threshold if compress else None, self.compress_level)
+                else:
+                    chunks = cached
+                encoded = [] if cache_key is not None and direct_message_read and status == 'ok' else None
+                for json_response in chunks:
+                    log.payload('out', json_response)
+                    client_socket.sendall(json_response)
+                    if encoded is not None:
+                        encoded.append(json_response)
+                if encoded is not None:
+                    self._cache_response(cache_key, mailbox_version, encoded)
+                if compression:
+                    compress = True
+                elapsed = time.perf_counter() - started
+                self.metrics.observe_command(name, elapsed, status == 'ok')
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug('Request handled.', extra = {'command': name, 'status': status, 'ms': round(elapsed * 1000, 3)})
+                with self.clients_lock:
+                    self.clients[client_socket] = False
+        except socket.timeout:
+            log.info('Connection timed out.')
         except Exception as e:
-            print(f"Error handling client {client_address}: {e}")
+            log.warning(f'Error handling client: {e}', exc_info = DEBUG)
         finally:
+            if current_user_token and current_user_token in self.sessions:
+                del self.sessions[current_user_token]
+            self.metrics.connection_closed()
+            with self.clients_lock:
+                self.clients.pop(client_socket, None)
             client_socket.close()
-            self.clients.remove(client_socket)
             
-    def _send_message(self, entry, username, recipient, timestamp = ''):
-        '''Sends a message from one user (username) to another (recipient). Creates the message in the user's associated object'''
+    @contextmanager
+    def _store_lock(self):
+        '''Holds users_file_lock, recording how long it took to acquire'''
+        start = time.perf_counter()
         with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+            self.metrics.observe_lock_wait(time.perf_counter() - start)
+            yield
+
+    def _load_users(self):
+        '''Reads the whole user store. Must be called with the store lock held'''
+        with self.users_path.open('rb') as user_file:
+            data = user_file.read()
+        self.metrics.add_store_io(read = len(data))
+        return json.loads(data)
+
+    def _save_users(self, existing_users):
+        '''Writes the whole user store. Must be called with the store lock held'''
+        data = json.dumps(existing_users).encode()
+        with self.users_path.open('wb') as user_file:
+            user_file.write(data)
+        self.metrics.add_store_io(written = len(data))
+
+    @staticmethod
+    def _append_message(user, message):
+        '''Number a new message with the next id of the user\'s mailbox and append it. Must be called with the store
+        lock held'''
+        message['id'] = user.get('next_id', 1)
+        user['next_id'] = message['id'] + 1
+        user['messages'].append(message)
+
+    def _send_message(self, entry, username, recipient, timestamp = None):
+        '''Sends a message from one user (username) to another (recipient). Creates the message in the user's associated object
+        and returns the sender\'s stored copy, or False if either user does not exist'''
+        if timestamp is None:
+            timestamp = time.time()
+        if not self.owns(recipient):
+            return self._send_remote_message(entry, username, recipient, timestamp)
+        with self._store_lock():
+            existing_users = self._load_users()
             
             fetched_sender = existing_users.get(username, None)
             fetched_user = existing_users.get(recipient, None)
@@ -208,152 +874,980 @@ class DSUServer:
             if not fetched_user:
                 return False
             
-            else:
-                with users_path.open('w') as user_file:
-                    fetched_sender['messages'].append({'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'})
-                    fetched_user['messages'].append({'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'unread'})
-                    existing_users[recipient] = fetched_user
-                    existing_users[username] = fetched_sender
-                    json.dump(existing_users, user_file)
-        return True
+            sent = {'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'}
+            received = {'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'unread'}
+            self._append_message(fetched_sender, sent)
+            self._append_message(fetched_user, received)
+            self._touch(username, fetched_sender)
+            self._touch(recipient, fetched_user)
+            self._save_users(existing_users)
+            self._index_message(username, sent)
+            self._index_message(recipient, received)
+            self._replicate('append', username, sent, fetched_sender['version'])
+            self._replicate('append', recipient, received, fetched_user['version'])
+        return sent
 
-    def _read_all_messages(self, username):
-        '''Retrieves all messages associated with a user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+    def _send_remote_message(self, entry, username, recipient, timestamp):
+        '''Delivers a message to a recipient owned by another partition, then stores and returns the sender\'s copy'''
+        with self._store_lock():
+            if username not in self._load_users():
+                return False
+        if not self._call_partition(partition_of(recipient, self.partitions), ('deliver', entry, username, recipient, timestamp)):
+            return False
+        with self._store_lock():
+            existing_users = self._load_users()
+            sent = {'message': entry, 'recipient': recipient, 'timestamp': timestamp, 'status': 'sent'}
+            self._append_message(existing_users[username], sent)
+            self._touch(username, existing_users[username])
+            self._save_users(existing_users)
+            self._index_message(username, sent)
+            self._replicate('append', username, sent, existing_users[username]['version'])
+        return sent
 
-            fetched_user = existing_users.get(username, None)
+    def _deliver_message(self, entry, username, recipient, timestamp):
+        '''Stores a message forwarded by another partition in a local recipient\'s mailbox'''
+        with self._store_lock():
+            existing_users = self._load_users()
+            fetched_user = existing_users.get(recipient, None)
             if not fetched_user:
-                return False ##double check that user exists
-            result = []
-            for message in fetched_user['messages']:
-                if 'from' in message:
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
+                return False
+            received = {'message': entry, 'from': username, 'timestamp': timestamp, 'status': 'unread'}
+            self._append_message(fetched_user, received)
+            self._touch(recipient, fetched_user)
+            self._save_users(existing_users)
+            self._index_message(recipient, received)
+            self._replicate('append', recipient, received, fetched_user['version'])
+        return True
+
+    def _index_message(self, username, message):
+        '''Add a new message to the user\'s indexes that are loaded. Must be called with the store lock held'''
+        for cache in (self.search_indexes, self.thread_indexes):
+            index = cache.get(username)
+            if index is not None:
+                index.add(message)
+
+    def _cached_index(self, cache, username, factory):
+        '''The user\'s index from cache, built from the hot and archived messages on first use, or None if the user
+        does not exist. Must be called with the store lock held'''
+        index = cache.get(username)
+        if index is None:
+            users = self._load_users()
+            if username not in users:
+                return None
+            index = factory()
+            ##unread messages stay hot while newer ones are archived, so the tiers are merged back into id order
+            archived = (self._iter_archive([segment]) for segment in self._segment_paths(username))
+            for message in heapq.merge(users[username]['messages'], *archived, key = message_id):
+                index.add(message)
+            cache[username] = index
+            if len(cache) > MAX_INDEXED_USERS:
+                cache.popitem(last = False)
+        cache.move_to_end(username)
+        return index
+
+    def _search_messages(self, username, query, limit):
+        '''Search a user\'s hot and archived messages'''
+        with self._store_lock():
+            index = self._cached_index(self.search_indexes, username, SearchIndex)
+            return index.search(query, limit) if index else []
+
+    def _read_conversation(self, username, peer, limit, before = None):
+        '''One page of the messages between a user and a peer, and the cursor of the next older page'''
+        with self._store_lock():
+            index = self._cached_index(self.thread_indexes, username, ThreadIndex)
+            return index.page(peer, limit, before) if index else ([], None)
+
+    def _call_partition(self, index, request):
+        '''Send a request to another partition over local IPC and return its reply, or False if it is unreachable'''
+        with self.peer_locks[index]:
+            deadline = time.monotonic() + IPC_CONNECT_TIMEOUT
+            while True:
+                conn = self.peer_conns.get(index)
+                try:
+                    if conn is None:
+                        conn = self.peer_conns[index] = Client(self.peer_addresses[index], authkey = self.authkey)
+                    conn.send(request)
+                    return conn.recv()
+                except (OSError, EOFError) as e:
+                    self.peer_conns.pop(index, None)
+                    if time.monotonic() >= deadline:
+                        logger.warning(f'Partition {index} unreachable: {e}')
+                        return False
+                    time.sleep(0.05)
+
+    def _serve_ipc(self):
+        '''Accept IPC connections from other partitions'''
+        while not self.stopping.is_set():
+            try:
+                conn = self.ipc_listener.accept()
+            except (OSError, EOFError):
+                break
+            threading.Thread(target = self._serve_ipc_connection, args = (conn,), daemon = True).start()
+
+    def _serve_ipc_connection(self, conn):
+        '''Answer requests from another partition until it disconnects'''
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (OSError, EOFError):
+                    return
+                if request[0] == 'deliver':
+                    result = self._deliver_message(*request[1:])
                 else:
-                    mod_message = {'recipient': message['recipient'], 'message': message['message'], 'timestamp': message['timestamp']}
-                result.append(mod_message)
-                if message['status'] == 'unread':
-                    message['status'] = 'read'
+                    result = False
+                conn.send(result)
 
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    existing_users[username] = fetched_user
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+    def _replicate(self, *mutation):
+        '''Log a store mutation for the followers. Must be called with the store lock held, so the log is in the order
+        the mutations were saved'''
+        if self.role != 'primary' or self.replication_address is None:
+            return
+        with self.replication_cond:
+            self.replication_seq += 1
+            self.replication_log.append((self.replication_seq, time.time(), mutation))
+            self.replication_cond.notify_all()
+
+    def _start_replication_listener(self):
+        '''Accept followers on the replication address'''
+        self.replication_listener = Listener(self.replication_address, authkey = self.replication_key)
+        self.replication_address = self.replication_listener.address ##the real port when 0 was asked for
+        threading.Thread(target = self._serve_replication, daemon = True).start()
+        logger.info('Accepting followers.', extra = {'address': f'{self.replication_address[0]}:{self.replication_address[1]}'})
+
+    def _serve_replication(self):
+        '''Accept follower connections until the listener is closed'''
+        while not self.stopping.is_set():
+            try:
+                conn = self.replication_listener.accept()
+            except multiprocessing.AuthenticationError as e:
+                logger.warning(f'Rejected follower: {e}')
+                continue
+            except (OSError, EOFError):
+                break
+            threading.Thread(target = self._serve_follower, args = (conn,), daemon = True).start()
+
+    def _snapshot(self):
+        '''The whole store as bytes: the seq it reflects, users.json and every archive segment by relative path.
+        Segments are never rewritten or removed once in place, so only listing them needs the store lock'''
+        with self._store_lock():
+            seq = self.replication_seq
+            users = self.users_path.read_bytes()
+            paths = list(self.archive_path.glob('*/*.jsonl.gz'))
+        archive = {path.relative_to(self.archive_path).as_posix(): path.read_bytes() for path in paths}
+        return seq, users, archive
+
+    def _serve_follower(self, conn):
+        '''Stream mutations to one follower. A follower that comes from another primary, or whose position has left
+        the backlog, gets a snapshot of the store first'''
+        with conn:
+            try:
+                _, epoch, position = conn.recv()
+            except (OSError, EOFError, ValueError, TypeError):
+                return
+            if epoch != self.replication_epoch:
+                position = None
+            with self.replication_cond:
+                self.followers += 1
+            try:
+                while not self.stopping.is_set() and self.role == 'primary':
+                    with self.replication_cond:
+                        if position is not None:
+                            self.replication_cond.wait_for(lambda: self.replication_seq > position or self.stopping.is_set(),
+                                                           REPLICATION_HEARTBEAT)
+                        seq = self.replication_seq
+                        first = self.replication_log[0][0] if self.replication_log else seq + 1
+                        if position is None or position > seq or position + 1 < first:
+                            entries = None
+                        else:
+                            entries = list(islice(self.replication_log, position + 1 - first, None))
+                    if entries is None:
+                        position, users, archive = self._snapshot()
+                        conn.send(('snapshot', self.replication_epoch, position, users, archive))
+                        logger.info('Sent a snapshot to a follower.', extra = {'seq': position, 'bytes': len(users)})
+                    elif entries:
+                        conn.send(('mutations', seq, entries))
+                        position = entries[-1][0]
+                    else:
+                        conn.send(('heartbeat', seq))
+            except (OSError, EOFError):
+                pass ##the follower went away, it resumes from its own position when it reconnects
+            finally:
+                with self.replication_cond:
+                    self.followers -= 1
+
+    def _follow_loop(self):
+        '''Keep this follower's store in step with the primary, reconnecting until it is promoted or stopped'''
+        while not self.stopping.is_set() and self.role == 'follower':
+            try:
+                with Client(self.follow_address, authkey = self.replication_key) as conn:
+                    conn.send(('subscribe', self.replication_epoch, self.replication_seq))
+                    while not self.stopping.is_set() and self.role == 'follower':
+                        if not conn.poll(REPLICATION_TIMEOUT):
+                            logger.warning('Primary went quiet, reconnecting.')
+                            break
+                        update = conn.recv()
+                        self.last_contact = time.monotonic()
+                        try:
+                            self._apply_update(update)
+                        except Exception as e:
+                            ## the local store may be half updated, so resubscribe under an epoch no primary has
+                            ## and start over from a snapshot
+                            logger.warning(f'Could not apply an update from the primary: {e}', exc_info = DEBUG)
+                            self.replication_epoch = generate_token()
+                            break
+            except (OSError, EOFError, multiprocessing.AuthenticationError) as e:
+                logger.debug(f'Primary unreachable: {e}')
+            self.stopping.wait(REPLICATION_RETRY)
+
+    def _apply_update(self, update):
+        '''Apply one message from the primary: a snapshot, a batch of mutations or a heartbeat'''
+        if update[0] == 'snapshot':
+            self._load_snapshot(*update[1:])
+            self.primary_seq = update[2]
+        elif update[0] == 'mutations':
+            self.primary_seq = update[1]
+            self._apply_mutations(update[2])
+        else:
+            self.primary_seq = update[1]
+
+    def _load_snapshot(self, epoch, seq, users, archive):
+        '''Replace the local store with a snapshot from the primary. The new archive is written beside the current one
+        and renamed into place, so the archive directory always holds a complete set of segments'''
+        staging = self.archive_path.with_name(self.archive_path.name + '.loading')
+        retired = self.archive_path.with_name(self.archive_path.name + '.old')
+        shutil.rmtree(staging, ignore_errors = True)
+        staging.mkdir(parents = True)
+        for name, data in archive.items():
+            path = staging / name
+            path.parent.mkdir(parents = True, exist_ok = True)
+            path.write_bytes(data)
+        with self._store_lock():
+            if self.role != 'follower':
+                shutil.rmtree(staging, ignore_errors = True)
+                return
+            shutil.rmtree(retired, ignore_errors = True)
+            if self.archive_path.exists():
+                os.replace(self.archive_path, retired)
+            os.replace(staging, self.archive_path)
+            tmp_path = self.users_path.with_suffix('.tmp')
+            tmp_path.write_bytes(users)
+            os.replace(tmp_path, self.users_path)
+            self.metrics.add_store_io(written = len(users) + sum(map(len, archive.values())))
+            self.search_indexes.clear()
+            self.thread_indexes.clear()
+            self.mailbox_versions.clear()
+            with self.response_cache_lock:
+                self.response_cache.clear()
+                self.response_cache_bytes = 0
+            self.replication_epoch = epoch
+            self.replication_seq = seq
+        shutil.rmtree(retired, ignore_errors = True) ##readers that listed its segments list them again
+        logger.info('Loaded a snapshot from the primary.', extra = {'seq': seq, 'bytes': len(users)})
+
+    def _apply_mutations(self, entries):
+        '''Apply a batch of the primary's mutations to the local store with a single write'''
+        with self._store_lock():
+            if self.role != 'follower':
+                return ##promoted while the batch was in flight
+            existing_users = self._load_users()
+            for _, _, mutation in entries:
+                kind = mutation[0]
+                if kind == 'user':
+                    _, username, record = mutation
+                    existing_users[username] = record
+                    self.mailbox_versions[username] = record.get('version', 0)
+                elif kind == 'append':
+                    _, username, message, version = mutation
+                    user = existing_users[username]
+                    user['messages'].append(message)
+                    user['next_id'] = message['id'] + 1
+                    user['version'] = self.mailbox_versions[username] = version
+                    self._index_message(username, message)
+                elif kind == 'read':
+                    _, username, version = mutation
+                    user = existing_users[username]
+                    for message in user['messages']:
+                        if message['status'] == 'unread':
+                            message['status'] = 'read'
+                    user['version'] = self.mailbox_versions[username] = version
+                elif kind == 'archive':
+                    for username, ids in mutation[1].items():
+                        archived = set(ids)
+                        user = existing_users[username]
+                        self._write_segment(username, [m for m in user['messages'] if message_id(m) in archived])
+                        self._drop_hot(user, archived)
+            self._save_users(existing_users)
+            self.replication_seq = entries[-1][0]
+            self.apply_delay = max(0.0, time.time() - entries[-1][1])
+
+    def replication_status(self):
+        '''Role, position and lag of replication, as reported by the stats command'''
+        status = {'role': self.role, 'seq': self.replication_seq}
+        if self.role == 'primary':
+            status['followers'] = self.followers
+            return status
+        since_contact = None if self.last_contact is None else time.monotonic() - self.last_contact
+        status.update({
+            'connected': since_contact is not None and since_contact < REPLICATION_TIMEOUT,
+            'primary_seq': self.primary_seq,
+            'lag_mutations': max(0, self.primary_seq - self.replication_seq),
+            'lag_seconds': round(self.apply_delay, 6),
+            'last_contact_seconds': None if since_contact is None else round(since_contact, 3),
+        })
+        return status
+
+    def promote(self):
+        '''Turn a follower into a primary that accepts writes and, given a replication address, followers of its own.
+        Returns False if the server already is a primary'''
+        with self._store_lock():
+            if self.role != 'follower':
+                return False
+            self.role = 'primary' ##the follow loop drops its connection and applies nothing more
+            with self.replication_cond:
+                self.replication_epoch = generate_token()
+                self.replication_log.clear()
+        logger.info('Promoted to primary.', extra = {'seq': self.replication_seq})
+        if self.archive_after and self.archive_interval:
+            threading.Thread(target = self._archive_loop, daemon = True).start()
+        if self.replication_address is not None:
+            self._start_replication_listener()
+        return True
+
+    def _mailbox_version(self, username):
+        '''Current version of a user\'s mailbox. Versions are mirrored in memory, so checking whether a mailbox
+        changed does not touch the store'''
+        version = self.mailbox_versions.get(username)
+        if version is None:
+            with self._store_lock():
+                for name, user in self._load_users().items():
+                    self.mailbox_versions[name] = user.get('version', 0)
+            version = self.mailbox_versions.get(username, 0)
+        return version
+
+    def _touch(self, username, user):
+        '''Bump the version of a mailbox that is about to be saved. Must be called with the store lock held'''
+        user['version'] = user.get('version', 0) + 1
+        self.mailbox_versions[username] = user['version']
+
+    def _cached_response(self, key, version):
+        '''Encoded response cached for key if it is still for the given mailbox version'''
+        with self.response_cache_lock:
+            entry = self.response_cache.get(key)
+            if entry is None or entry[0] != version:
+                return None
+            self.response_cache.move_to_end(key)
+            return entry[1]
+
+    def _cache_response(self, key, version, chunks):
+        '''Remember an encoded response, evicting the least recently used ones beyond RESPONSE_CACHE_BYTES'''
+        size = sum(map(len, chunks))
+        if size > RESPONSE_CACHE_BYTES // 4:
+            return
+        with self.response_cache_lock:
+            old = self.response_cache.pop(key, None)
+            if old is not None:
+                self.response_cache_bytes -= sum(map(len, old[1]))
+            self.response_cache[key] = (version, chunks)
+            self.response_cache_bytes += size
+            while self.response_cache_bytes > RESPONSE_CACHE_BYTES:
+                _, (_, evicted) = self.response_cache.popitem(last = False)
+                self.response_cache_bytes -= sum(map(len, evicted))
+
+    def _read_all_messages(self, username, mark_read = True):
+        '''Retrieves all messages associated with a user and the mailbox version they reflect. Unread messages are
+        marked read unless mark_read is False'''
+        while True:
+            with self._store_lock():
+                existing_users = self._load_users()
+
+                fetched_user = existing_users.get(username, None)
+                if not fetched_user:
+                    return [], None ##double check that user exists
+                result = []
+                changed = False
+                for message in fetched_user['messages']:
+                    result.append(public_message(message))
+                    if mark_read and message['status'] == 'unread':
+                        message['status'] = 'read'
+                        changed = True
+
+                if changed: ##nothing to write when every message was already read
+                    self._touch(username, fetched_user)
+                    self._save_users(existing_users)
+                    self._replicate('read', username, fetched_user['version'])
+                version = fetched_user.get('version', 0)
+                segments = self._segment_paths(username) ##listed under the lock so no message is in both tiers or neither
+            ##segments are immutable, so the cold tier is read without holding the store lock. The hot messages and
+            ##every segment are each in id order, so merging them is enough
+            archived = (map(public_message, self._iter_archive([segment])) for segment in segments)
+            try:
+                return list(heapq.merge(result, *archived, key = message_id)), version
+            except FileNotFoundError:
+                continue ##a follower swapped in the archive of a snapshot after the segments were listed, list them again
 
     
     def _read_unread_messages(self, username):
-        '''Retrieves unread messages associated with the user'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+        '''Retrieves unread messages associated with the user and the mailbox version after they were marked read'''
+        with self._store_lock():
+            existing_users = self._load_users()
 
             fetched_user = existing_users.get(username, None)
             if not fetched_user:
-                return False ##double check that user exists
+                return [], None ##double check that user exists
             result = []
             for message in fetched_user['messages']:
                 if message['status'] == 'unread':
-                    mod_message = {'from': message['from'], 'message': message['message'], 'timestamp': message['timestamp']}
-                    result.append(mod_message)
+                    result.append(public_message(message))
                     message['status'] = 'read'
             
+            if result: ##nothing to write when there was no unread message
+                self._touch(username, fetched_user)
+                self._save_users(existing_users)
+                self._replicate('read', username, fetched_user['version'])
             
-            else:
-                with users_path.open('w') as user_file:
-                    existing_users[username] = fetched_user
-                    
-                    json.dump(existing_users, user_file)
-            
-            return sorted(result, key=lambda x: float(x["timestamp"]))
+            return result, fetched_user.get('version', 0)
 
-    def _get_user(self, username):
+    def _user_archive(self, username):
+        return self.archive_path / archive_dir_name(username)
+
+    def _segment_paths(self, username):
+        '''Archive segments of a user, oldest first'''
+        return sorted(self._user_archive(username).glob('*.jsonl.gz'))
+
+    def _iter_archive(self, segments):
+        '''Stream the stored messages of archive segments one at a time'''
+        for path in segments:
+            with gzip.open(path, 'rb') as segment:
+                for line in segment:
+                    yield json.loads(line)
+            self.metrics.add_store_io(read = path.stat().st_size)
+
+    def _next_segment_path(self, username):
+        '''Path of the user\'s next archive segment'''
+        user_archive = self._user_archive(username)
+        user_archive.mkdir(parents = True, exist_ok = True)
+        return user_archive / f'{len(self._segment_paths(username)):06d}.jsonl.gz'
+
+    def _write_segment(self, username, messages):
+        '''Write messages to a new compressed segment of the user\'s archive. Must be called with the store lock held'''
+        self._write_segment_file(self._next_segment_path(username), messages)
 
-        '''Gets the user object associated with the username. This function is never called.'''
+    def _write_segment_file(self, path, messages):
+        tmp_path = path.with_name(path.name + '.tmp')
+        with gzip.open(tmp_path, 'wb') as segment:
+            for message in messages:
+                segment.write(json.dumps(message).encode() + b'\n')
+        os.replace(tmp_path, path) ##segments appear complete or not at all
+        self.metrics.add_store_io(written = path.stat().st_size)
+
+    def archive_messages(self, now = None):
+        '''Move read and sent messages older than archive_after seconds from the hot store into a new archive
+        segment per user. Unread messages always stay hot. The segments are compressed without holding the store lock,
+        which is only taken to pick the messages and then to swap them out of the hot store. Returns how many messages
+        were moved'''
+        if not self.archive_after:
+            return 0
+        cutoff = (time.time() if now is None else now) - self.archive_after
+        staged = {} ##username -> (staged segment, final segment)
+        with self.archive_lock: ##one pass at a time, so no segment number is taken twice
+            with self._store_lock():
+                cold = {}
+                for username, user in self._load_users().items():
+                    messages = [m for m in user['messages'] if m['status'] != 'unread' and message_time(m) < cutoff]
+                    if messages:
+                        cold[username] = messages
+            if not cold:
+                return 0
+            try:
+                ##read and sent messages never change again, so the ones picked are still hot and unchanged below
+                for username, messages in cold.items():
+                    path = self._next_segment_path(username)
+                    staged[username] = (path.with_name(path.name + '.staged'), path) ##not a segment until renamed
+                    self._write_segment_file(staged[username][0], messages)
+                with self._store_lock():
+                    existing_users = self._load_users()
+                    moved = {username: [message_id(m) for m in messages] for username, messages in cold.items()}
+                    for username, ids in moved.items():
+                        self._drop_hot(existing_users[username], ids)
+                        os.replace(*staged[username])
+                    self._save_users(existing_users)
+                    self._replicate('archive', moved)
+            finally:
+                for staged_path, _ in staged.values():
+                    if staged_path.exists():
+                        staged_path.unlink()
+        count = sum(map(len, cold.values()))
+        logger.info('Archived old messages.', extra = {'messages': count})
+        return count
+
+    @staticmethod
+    def _drop_hot(user, ids):
+        '''Remove the messages with the given ids from a user\'s hot store. Must be called with the store lock held'''
+        ids = set(ids)
+        user['messages'] = [message for message in user['messages'] if message_id(message) not in ids]
+
+    def _archive_loop(self):
+        '''Runs an archival pass every archive_interval seconds until the server stops'''
+        while not self.stopping.wait(self.archive_interval):
+            try:
+                self.archive_messages()
+            except OSError as e:
+                logger.warning(f'Unable to archive messages: {e}')
+
+    def _upgrade_store(self):
+        '''Number the messages of mailboxes stored before messages had ids, oldest first, and turn their timestamps
+        into numbers. Archive segments are rewritten with the ids. Runs once per mailbox at startup, before any request
+        is served, so it takes the store lock without counting it as a wait'''
         with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
-                fetched_user = existing_users.get(username, None)
-                return fetched_user
+            existing_users = self._load_users()
+            upgraded = [username for username, user in existing_users.items() if 'next_id' not in user]
+            for username in upgraded:
+                user = existing_users[username]
+                segments = [(path, list(self._iter_archive([path]))) for path in self._segment_paths(username)]
+                messages = sorted(chain(user['messages'], *(archived for _, archived in segments)), key = message_time)
+                for number, message in enumerate(messages, 1):
+                    message['id'] = number
+                    if message_time(message) != float('inf'):
+                        message['timestamp'] = message_time(message)
+                user['next_id'] = len(messages) + 1
+                user['messages'].sort(key = message_id)
+                for path, archived in segments:
+                    self._write_segment_file(path, sorted(archived, key = message_id))
+            if upgraded:
+                self._save_users(existing_users)
+                logger.info('Numbered the messages of existing mailboxes.', extra = {'users': len(upgraded)})
+
+    def _get_user(self, username):
+
+        '''Gets the user object associated with the username, or None. Followers authenticate with it since they
+        cannot create users'''
+        with self._store_lock():
+            return self._load_users().get(username, None)
     
 
 
     def _get_or_create_new_user(self, username, password):
 
         '''Read from the user file and get the username associated with the username. If it doesnt exist, create a new user.'''
-        with users_file_lock:
-            users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-            existing_users = None
-            with users_path.open('r') as user_file:
-                existing_users = json.load(user_file)
+        with self._store_lock():
+            existing_users = self._load_users()
 
             fetched_user = existing_users.get(username, None)
             if fetched_user:
                 return fetched_user
-            else:
-                with users_path.open('w') as user_file:
-                    
-                    fetched_user = existing_users.get(username, None)
-                    if fetched_user: ##double check that no user exists
-                        return False
-                    else:
-                        existing_users.update({username: {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[]}})
-                    json.dump(existing_users, user_file)
+            existing_users.update({username: {'password': password, 'bio': {"entry": "", "timestamp": ""}, 'posts': [], 'messages':[], 'version': 0, 'next_id': 1}})
+            self._save_users(existing_users)
+            self.mailbox_versions[username] = 0
+            self._replicate('user', username, existing_users[username])
             
         
     def _create_storage_system(self):
         '''Creates the local storage system if it doesnt already exist. Will create a directory called "store" with two files posts.json and users.json'''
-        users_path = Path('.') / STORE_DIR_PATH / Path(USERS_PATH)
-        store_path = Path('.') / Path(STORE_DIR_PATH)
-        store_path.mkdir(exist_ok=True)
+        users_path = self.users_path
+        store_path = self.store_path
+        store_path.mkdir(parents=True, exist_ok=True)
         if not users_path.exists():
             with users_path.open('w') as json_file:
                 json.dump({}, json_file, indent=4)
 
+    def write_stats_snapshot(self):
+        '''Atomically writes the current metrics to the stats file in the store directory'''
+        tmp_path = self.stats_path.with_suffix('.tmp')
+        snapshot = self.metrics.snapshot(len(self.sessions))
+        snapshot['replication'] = self.replication_status()
+        with tmp_path.open('w') as stats_file:
+            json.dump(snapshot, stats_file, indent=4)
+        os.replace(tmp_path, self.stats_path)
+
+    def _stats_loop(self):
+        '''Writes a stats snapshot every stats_interval seconds until the server stops'''
+        while not self.stopping.wait(self.stats_interval):
+            try:
+                self.write_stats_snapshot()
+            except OSError as e:
+                logger.warning(f'Unable to write stats snapshot: {e}')
+
+    @staticmethod
+    def _reject(connection, message):
+        '''Tell a client the server cannot take its connection right now and close it. Never blocks, since it runs on
+        the accept thread: the short reply fits the empty send buffer of a new connection, or is dropped'''
+        resp = {'response': {'type': 'error', 'message': message, 'retry_after': BUSY_RETRY_AFTER}}
+        try:
+            connection.setblocking(False)
+            connection.send(json.dumps(resp).encode() + b'\r\n')
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    def _worker_loop(self):
+        '''Serve connections from the accept queue until a None sentinel arrives'''
+        while True:
+            item = self.accept_queue.get()
+            if item is None:
+                break
+            connection, address, initial = item
+            if self.stopping.is_set():
+                self._reject(connection, 'Server is shutting down.')
+            else:
+                self.handle_client(connection, address, initial)
+
+    def _enqueue(self, connection, address, initial = b''):
+        '''Hand a new connection to the worker pool, rejecting it if the accept queue is full'''
+        try:
+            self.accept_queue.put_nowait((connection, address, initial))
+        except queue.Full:
+            logger.warning('Accept queue full, rejecting connection.', extra = {'peer': f'{address[0]}:{address[1]}'})
+            self._reject(connection, 'Server busy, try again later.')
+
+    def _start_background(self):
+        '''Create the store and start the stats thread, replication and the worker pool'''
+        self._create_storage_system() #does nothing if the server store files exists already
+        self._upgrade_store()
+        self.stopping.clear()
+        if self.stats_interval:
+            threading.Thread(target = self._stats_loop, daemon = True).start()
+        if self.role == 'follower':
+            threading.Thread(target = self._follow_loop, daemon = True).start() ##archiving is replicated from the primary
+        else:
+            if self.archive_after and self.archive_interval:
+                threading.Thread(target = self._archive_loop, daemon = True).start()
+            if self.replication_address is not None:
+                self._start_replication_listener()
+        self.workers = [threading.Thread(target = self._worker_loop, daemon = True) for _ in range(self.max_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def _drain(self):
+        '''Let in-flight requests finish, close idle connections and stop the workers'''
+        self.stopping.set()
+        if self.replication_listener is not None:
+            self.replication_listener.close()
+            self.replication_listener = None
+        deadline = time.monotonic() + self.drain_timeout
+        while True:
+            with self.clients_lock:
+                idle = [conn for conn, busy in self.clients.items() if not busy]
+                busy = len(self.clients) - len(idle)
+            for conn in idle:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR) ##wakes up the worker blocked waiting for the next request
+                except OSError:
+                    pass
+            if not busy and not idle or time.monotonic() >= deadline:
+                break
+            time.sleep(0.01)
+        with self.clients_lock:
+            for conn in self.clients:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        for _ in self.workers:
+            self.accept_queue.put(None)
+        for worker in self.workers:
+            worker.join(max(0, deadline - time.monotonic()) + 1)
+        self.workers = []
+
     def start_server(self):
         '''Starts the server (hence the name of the method :))'''
-        self._create_storage_system() #does nothing if the server store files exists already
+        self._start_background()
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
+                srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 srv.bind((self.host, self.port))
-                srv.listen(5)
-                if DEBUG:
-                    print("DSUserver is listening on port", self.port)
-                while True:
-                    connection, address = srv.accept()
-                    client_handler = threading.Thread(target = self.handle_client, args = (connection,address))
-                    client_handler.start()
+                srv.listen(LISTEN_BACKLOG)
+                self.server_socket = srv
+                self.port = srv.getsockname()[1]
+                self.ready.set()
+                logger.info('DSUserver is listening.', extra = {'port': self.port, 'workers': self.max_workers})
+                while not self.stopping.is_set():
+                    try:
+                        connection, address = srv.accept()
+                    except OSError:
+                        break ##listening socket was closed by stop()
+                    self._enqueue(connection, address)
         except KeyboardInterrupt as e:
-            if DEBUG:
-                print(f'Server shutting down...')
+            logger.info('Server shutting down...')
         finally:
-            for conn in self.clients:
+            self._drain()
+            logger.info('Disconnected all clients.')
+
+
+    def serve_handoffs(self, pipe):
+        '''Run as one partition of a DSUCluster: serve connections the front end passes through pipe until it closes'''
+        self._start_background()
+        if self.peer_addresses:
+            self.ipc_listener = Listener(self.peer_addresses[self.partition], authkey = self.authkey)
+            threading.Thread(target = self._serve_ipc, daemon = True).start()
+        self.ready.set()
+        logger.info('Partition worker ready.', extra = {'partition': self.partition, 'store': str(self.store_path)})
+        try:
+            while not self.stopping.is_set():
+                try:
+                    address, initial = pipe.recv()
+                    fd = recv_handle(pipe)
+                except (EOFError, OSError):
+                    break ##front end went away
+                self._enqueue(socket.socket(fileno = fd), address, initial)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._drain()
+            if self.ipc_listener is not None:
+                self.ipc_listener.close()
+            for conn in self.peer_conns.values():
                 conn.close()
-            self.clients = []
-            if DEBUG:
-                print('Disconnected all clients.')
+
+    def stop(self):
+        '''Stops accepting new connections, which makes start_server drain the active ones and return'''
+        self.stopping.set()
+        if self.server_socket is not None:
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
+
+
+def run_partition_worker(index, partitions, pipe, peer_addresses, authkey, store_dir, options, log_level):
+    '''Entry point of a cluster worker process'''
+    setup_logging(log_level, sample_rate = PAYLOAD_SAMPLE_RATE)
+    server = DSUServer('127.0.0.1', 0, store_dir, partition = index, partitions = partitions,
+                       peer_addresses = peer_addresses, authkey = authkey, **options)
+    server.serve_handoffs(pipe)
+
+class DSUCluster:
+    '''Multi-process server. A front acceptor reads the first request of each connection and passes the socket to the
+    worker process owning that user\'s hash partition. Each worker is a DSUServer with its own store shard and
+    forwards direct messages for other partitions over local IPC. Needs a Unix platform to pass sockets.'''
+    def __init__(self, host = '127.0.0.1', port = 3001, store_dir = STORE_DIR_PATH, processes = 2, **options):
+        self.host = host
+        self.port = port
+        self.store_path = Path(store_dir)
+        self.processes = processes
+        self.options = options
+        self.read_timeout = options.get('read_timeout', READ_TIMEOUT)
+        self.max_pending = options.get('accept_queue_size', ACCEPT_QUEUE_SIZE) ##connections still sending their first request
+        self.pipes = []
+        self.procs = []
+        self.server_socket = None
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+
+    def shard_path(self, index):
+        return self.store_path / SHARD_DIR_PATTERN.format(index)
+
+    def prepare_shards(self):
+        '''Split a single-process store into one shard per partition the first time the cluster starts on it. The old
+        users.json is kept as users.json.migrated. Refuses a store sharded for another number of processes, or holding
+        both shards and a users.json, since users would be looked up in the wrong place and recreated'''
+        legacy_path = self.store_path / USERS_PATH
+        shards = {path.name for path in self.store_path.glob(SHARD_DIR_PATTERN.format('*'))}
+        if shards and shards != {self.shard_path(i).name for i in range(self.processes)}:
+            raise RuntimeError(f'Store {self.store_path} is sharded for {len(shards)} processes, not {self.processes}.')
+        if not legacy_path.exists():
+            return
+        if shards:
+            raise RuntimeError(f'Store {self.store_path} has both {USERS_PATH} and shards, remove one of them.')
+        from migrate_store import migrate ##imported here since migrate_store imports this module
+        staging = self.store_path / 'sharding.tmp'
+        shutil.rmtree(staging, ignore_errors = True)
+        stats, mismatches = migrate(self.store_path, 'shards', staging, self.processes)
+        if mismatches:
+            shutil.rmtree(staging, ignore_errors = True)
+            raise RuntimeError(f'Sharding {self.store_path} lost messages of {len(mismatches)} users.')
+        for i in range(self.processes):
+            os.replace(staging / self.shard_path(i).name, self.shard_path(i))
+        staging.rmdir()
+        os.replace(legacy_path, legacy_path.with_name(USERS_PATH + '.migrated'))
+        logger.info('Split the store into shards.', extra = {'users': len(stats), 'processes': self.processes})
+
+    def _route(self, connection, address, first, rest):
+        '''Hand a connection and the bytes read from it to the partition that owns the user of its first request'''
+        index = 0 ##connections that do not start with authenticate get their error from partition 0
+        try:
+            index = partition_of(json.loads(first)['authenticate']['username'], self.processes)
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            connection.setblocking(True)
+            self.pipes[index].send((address, first + rest))
+            send_handle(self.pipes[index], connection.fileno(), self.procs[index].pid)
+        except OSError as e:
+            logger.warning(f'Unable to hand connection to partition {index}: {e}')
+        finally:
+            connection.close()
+
+    def _accept(self, srv, selector, pending):
+        '''Start collecting the first request of a new connection. Returns False once the listening socket is closed'''
+        try:
+            connection, address = srv.accept()
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False ##listening socket was closed by stop()
+        if len(pending) >= self.max_pending:
+            DSUServer._reject(connection, 'Server busy, try again later.')
+            return True
+        connection.setblocking(False)
+        pending[connection] = (address, LineReader(connection), time.monotonic() + self.read_timeout)
+        selector.register(connection, selectors.EVENT_READ)
+        return True
+
+    def _receive_first(self, connection, selector, pending):
+        '''Read what a pending connection sent and route it once its first request is complete'''
+        address, reader, _ = pending[connection]
+        try:
+            chunk = connection.recv(65536)
+            reader.buffer += chunk
+            first = reader.pop_request() if chunk else bytes(reader.buffer) ##at end of stream route whatever came
+        except BlockingIOError:
+            return
+        except (OSError, ValueError):
+            first = b''
+        if first is None:
+            return
+        selector.unregister(connection)
+        del pending[connection]
+        if first:
+            self._route(connection, address, first, bytes(reader.buffer))
+        else:
+            connection.close()
+
+    def start_server(self):
+        '''Start the worker processes and accept connections until stop() or Ctrl-C. One selector collects the first
+        request of every connection, so clients that connect and stay silent cannot hold up the others'''
+        self.prepare_shards()
+        ctx = multiprocessing.get_context('spawn')
+        authkey = secrets.token_bytes(16)
+        ipc_dir = tempfile.mkdtemp(prefix = 'dsu-ipc-')
+        addresses = [os.path.join(ipc_dir, f'partition-{i}.sock') for i in range(self.processes)]
+        log_level = logging.getLogger('dsp').getEffectiveLevel()
+        for i in range(self.processes):
+            parent_end, child_end = ctx.Pipe()
+            proc = ctx.Process(target = run_partition_worker, name = f'dsu-partition-{i}',
+                               args = (i, self.processes, child_end, addresses, authkey, str(self.shard_path(i)), self.options, log_level))
+            proc.start()
+            child_end.close()
+            self.pipes.append(parent_end)
+            self.procs.append(proc)
+        selector = selectors.DefaultSelector()
+        pending = {} ##connection -> (address, LineReader, deadline) until its first request has arrived
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as srv:
+                srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                srv.bind((self.host, self.port))
+                srv.listen(LISTEN_BACKLOG)
+                srv.setblocking(False)
+                selector.register(srv, selectors.EVENT_READ)
+                self.server_socket = srv
+                self.port = srv.getsockname()[1]
+                self.ready.set()
+                logger.info('DSUCluster is listening.', extra = {'port': self.port, 'processes': self.processes})
+                accepting = True
+                while accepting and not self.stopping.is_set():
+                    for key, _ in selector.select(ROUTER_POLL_INTERVAL):
+                        if key.fileobj is srv:
+                            accepting = self._accept(srv, selector, pending)
+                        else:
+                            self._receive_first(key.fileobj, selector, pending)
+                    now = time.monotonic()
+                    for connection in [conn for conn, (_, _, deadline) in pending.items() if deadline <= now]:
+                        selector.unregister(connection)
+                        del pending[connection]
+                        connection.close()
+        except KeyboardInterrupt:
+            logger.info('Cluster shutting down...')
+        finally:
+            self.stopping.set()
+            for connection in pending:
+                connection.close()
+            selector.close()
+            for pipe in self.pipes:
+                pipe.close() ##workers see EOF, drain and exit
+            for proc in self.procs:
+                proc.join(self.options.get('drain_timeout', DRAIN_TIMEOUT) + 5)
+                if proc.is_alive():
+                    proc.terminate()
+            shutil.rmtree(ipc_dir, ignore_errors = True)
+            logger.info('All partitions stopped.')
+
+    def stop(self):
+        self.stopping.set()
+        if self.server_socket is not None:
+            try:
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.server_socket.close()
 
         
-def run_server(host = '127.0.0.1', port1 = 3001):
+def run_server(host = '127.0.0.1', port1 = 3001, store_dir = STORE_DIR_PATH, processes = 1, **options):
+    setup_logging(logging.DEBUG if DEBUG else logging.INFO, sample_rate = PAYLOAD_SAMPLE_RATE)
     try:
-        server = DSUServer(host, port1)
+        if processes > 1:
+            server = DSUCluster(host, port1, store_dir, processes, **options)
+        else:
+            server = DSUServer(host, port1, store_dir, **options)
         server.start_server()
     except Exception as e:
-        print(f'Server raised the following error:{e}')
+        logger.error(f'Server raised the following error:{e}')
     
+def parse_limit(text):
+    '''Parse a RATE[,BURST] command line rate limit, the burst defaults to twice the rate'''
+    rate, _, burst = text.partition(',')
+    rate = float(rate)
+    return (rate, float(burst) if burst else max(2 * rate, 1))
+
+def parse_address(text):
+    '''Parse a HOST:PORT command line address'''
+    host, _, port = text.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+def parse_args(argv = None):
+    parser = argparse.ArgumentParser(description = 'ICS32 Distributed Social direct messaging server')
+    parser.add_argument('port', nargs = '?', type = int, default = 3001)
+    parser.add_argument('store_dir', nargs = '?', default = STORE_DIR_PATH)
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--workers', type = int, default = MAX_WORKERS, help = 'threads serving connections')
+    parser.add_argument('--accept-queue', type = int, default = ACCEPT_QUEUE_SIZE, help = 'connections waiting for a worker before rejecting')
+    parser.add_argument('--idle-timeout', type = float, default = IDLE_TIMEOUT, help = 'seconds allowed between requests')
+    parser.add_argument('--read-timeout', type = float, default = READ_TIMEOUT, help = 'seconds allowed to send one request')
+    parser.add_argument('--drain-timeout', type = float, default = DRAIN_TIMEOUT, help = 'seconds to finish requests on shutdown')
+    parser.add_argument('--user-limit', type = parse_limit, default = USER_LIMIT, metavar = 'RATE[,BURST]',
+                        help = 'requests per second allowed per user, 0 disables')
+    parser.add_argument('--address-limit', type = parse_limit, default = ADDRESS_LIMIT, metavar = 'RATE[,BURST]',
+                        help = 'requests per second allowed per client address, 0 disables')
+    parser.add_argument('--fetch-all-limit', type = parse_limit, default = FETCH_ALL_LIMIT, metavar = 'RATE[,BURST]',
+                        help = "'fetch all' requests per second allowed per user, 0 disables")
+    parser.add_argument('--archive-after', type = float, default = ARCHIVE_AFTER,
+                        help = 'seconds after which read messages move to the compressed archive, 0 disables')
+    parser.add_argument('--archive-interval', type = float, default = ARCHIVE_INTERVAL, help = 'seconds between archival passes')
+    parser.add_argument('--compress-threshold', type = int, default = COMPRESS_THRESHOLD,
+                        help = 'bytes from which responses are compressed for clients that accept zlib')
+    parser.add_argument('--compress-level', type = int, default = COMPRESS_LEVEL, choices = range(10), metavar = '0-9',
+                        help = 'zlib level, higher trades CPU for fewer bytes')
+    parser.add_argument('--processes', type = int, default = 1, help = 'worker processes, each owning a hash partition of the users')
+    parser.add_argument('--replication-port', type = int, help = 'port on --host where followers receive the store mutations')
+    parser.add_argument('--follow', type = parse_address, metavar = 'HOST:PORT',
+                        help = 'run as a read-only follower of the primary replicating on this address')
+    parser.add_argument('--replication-key', default = os.environ.get('DSP_REPLICATION_KEY'),
+                        help = 'secret shared by a primary and its followers, defaults to $DSP_REPLICATION_KEY')
+    args = parser.parse_args(argv)
+    if (args.replication_port is not None or args.follow) and not args.replication_key:
+        parser.error('replication needs --replication-key or DSP_REPLICATION_KEY')
+    if (args.replication_port is not None or args.follow) and args.processes > 1:
+        parser.error('replication runs with a single process')
+    return args
+
 if __name__ == '__main__':
-    host = '127.0.0.1'
-    port1 = 3001
-    port2 = 3002
-    if len(sys.argv) >= 2:
-        port1 = int(sys.argv[1])
-   
-    run_server(host,port1)
+    args = parse_args()
+    run_server(args.host, args.port, args.store_dir, args.processes, max_workers = args.workers, accept_queue_size = args.accept_queue,
+               idle_timeout = args.idle_timeout, read_timeout = args.read_timeout, drain_timeout = args.drain_timeout,
+               user_limit = args.user_limit, address_limit = args.address_limit, fetch_all_limit = args.fetch_all_limit,
+               archive_after = args.archive_after, archive_interval = args.archive_interval,
+               compress_threshold = args.compress_threshold, compress_level = args.compress_level,
+               replication_address = None if args.replication_port is None else (args.host, args.replication_port),
+               follow_address = args.follow, replication_key = args.replication_key and args.replication_key.encode())
@@ -0,0 +1,59 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Unit tests for the bulk mode helpers in a3."""
+
+import argparse
+import contextlib
+import io
+import unittest
+
+from a3 import diary_of, parse_since, read_sends
+from ds_messenger import DirectMessage
+from notebook import Notebook
+
+
+class TestBulkHelpers(unittest.TestCase):
+    """Tests for send file parsing and --since values."""
+
+    def test_read_sends(self):
+        """Test valid lines are yielded and bad ones counted and reported."""
+        lines = ['{"to": "bob", "message": "hi"}\n', "\n", "oops\n",
+                 '{"recipient": "carol", "message": "yo"}\n', '{"to": "bob"}\n']
+        counts = {"read": 0, "invalid": 0}
+        errors = io.StringIO()
+        with contextlib.redirect_stderr(errors):
+            sends = list(read_sends(lines, counts))
+        self.assertEqual(sends, [("bob", "hi"), ("carol", "yo")])
+        self.assertEqual(counts, {"read": 4, "invalid": 2})
+        self.assertIn("line 3", errors.getvalue())
+
+    def test_parse_since(self):
+        """Test --since takes epoch seconds or an ISO date."""
+        self.assertEqual(parse_since("1700000000.5"), 1700000000.5)
+        self.assertEqual(parse_since("2024-01-01T00:00:00+00:00"), 1704067200.0)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_since("yesterday")
+
+    def test_sent_diary_matches_synced_copy(self):
+        """Test a sent message recorded with the server's timestamp is not added again by a sync."""
+        stored = DirectMessage()
+        stored.message, stored.recipient, stored.timestamp = "hi", "bob", 42.5
+        notebook = Notebook("alice", "pw", "")
+        notebook.add_diary(diary_of(stored))
+        synced = DirectMessage()
+        synced.message, synced.recipient, synced.timestamp = "hi", "bob", "42.5"
+        self.assertEqual(notebook.merge_diaries([diary_of(synced)]).inserted, 0)
+
+    def test_diary_of_without_timestamp(self):
+        """Test a message with a missing or malformed timestamp has no diary."""
+        message = DirectMessage()
+        message.message, message.sender = "hi", "bob"
+        self.assertIsNone(diary_of(message))
+        message.timestamp = "soon"
+        self.assertIsNone(diary_of(message))
+
+
+if __name__ == '__main__':
+    unittest.main()
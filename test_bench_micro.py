@@ -0,0 +1,29 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Unit tests for the helpers in bench_micro."""
+
+import unittest
+
+from bench_micro import compare, time_call
+
+
+class TestBenchMicro(unittest.TestCase):
+    """Tests for timing and baseline comparison."""
+
+    def test_compare_flags_regressions(self):
+        """Test only cases slower than the threshold are reported."""
+        baseline = {"fast": 1.0, "slow": 1.0, "new_case": None}
+        results = {"fast": 1.2, "slow": 1.5, "new_case": 3.0, "unknown": 9.0}
+        regressions = compare(results, baseline, threshold=0.25)
+        self.assertEqual([r[0] for r in regressions], ["slow"])
+        self.assertAlmostEqual(regressions[0][3], 1.5)
+
+    def test_time_call_positive(self):
+        """Test time_call returns a positive per-call time."""
+        self.assertGreater(time_call(lambda: None, min_time=0.001, repeat=2), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
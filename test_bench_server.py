@@ -0,0 +1,38 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Unit tests for the helpers in bench_server."""
+
+import unittest
+
+from bench_server import parse_mix, percentile
+
+
+class TestBenchHelpers(unittest.TestCase):
+    """Tests for mix parsing and percentile computation."""
+
+    def test_parse_mix(self):
+        """Test a command mix is parsed into weights."""
+        self.assertEqual(parse_mix("auth=1,send=5"), {"auth": 1.0, "send": 5.0})
+
+    def test_parse_mix_unknown_command(self):
+        """Test unknown commands are rejected."""
+        with self.assertRaises(ValueError):
+            parse_mix("auth=1,delete=2")
+
+    def test_parse_mix_needs_positive_weight(self):
+        """Test a mix with no positive weight is rejected."""
+        with self.assertRaises(ValueError):
+            parse_mix("auth=0")
+
+    def test_percentile(self):
+        """Test nearest-rank percentiles."""
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([], 50), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
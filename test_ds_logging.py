@@ -0,0 +1,69 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Unit tests for the ds_logging module."""
+
+import io
+import json
+import logging
+import unittest
+
+from ds_logging import get_logger, setup_logging, shutdown_logging, RequestLogger
+
+
+class TestDSLogging(unittest.TestCase):
+    """Tests for structured queue-based logging."""
+
+    def setUp(self):
+        """Create an output buffer."""
+        self.stream = io.StringIO()
+
+    def tearDown(self):
+        """Stop the listener and detach the queue handler."""
+        shutdown_logging()
+        root = logging.getLogger("dsp")
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.setLevel(logging.NOTSET)
+        root.propagate = True
+
+    def lines(self):
+        """Drain the listener and return the logged JSON objects."""
+        shutdown_logging()
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+
+    def test_records_are_json_with_request_ids(self):
+        """Test records carry level, connection and request IDs."""
+        setup_logging(logging.DEBUG, self.stream)
+        log = RequestLogger(get_logger("test"), peer="1.2.3.4:5")
+        log.next_request()
+        log.info("handled", extra={"command": "fetch_all"})
+        (entry,) = self.lines()
+        self.assertEqual(entry["level"], "INFO")
+        self.assertEqual(entry["logger"], "dsp.test")
+        self.assertEqual(entry["peer"], "1.2.3.4:5")
+        self.assertEqual(entry["command"], "fetch_all")
+        self.assertEqual(entry["request_id"], f"{entry['conn']}-1")
+
+    def test_payload_skipped_below_debug(self):
+        """Test payload dumps are dropped when DEBUG is off."""
+        setup_logging(logging.INFO, self.stream)
+        RequestLogger(get_logger("test")).payload("in", b"secret")
+        self.assertEqual(self.lines(), [])
+
+    def test_payload_sampling(self):
+        """Test a zero sample rate drops every payload and 1.0 keeps them."""
+        setup_logging(logging.DEBUG, self.stream, sample_rate=0.0)
+        RequestLogger(get_logger("test")).payload("in", b"x")
+        self.assertEqual(self.lines(), [])
+
+        self.stream = io.StringIO()
+        setup_logging(logging.DEBUG, self.stream, sample_rate=1.0)
+        RequestLogger(get_logger("test")).payload("out", b"xyz")
+        (entry,) = self.lines()
+        self.assertEqual((entry["direction"], entry["bytes"]), ("out", 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
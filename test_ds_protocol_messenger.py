@@ -4,6 +4,7 @@
 
 """Unit tests for ds_protocol and ds_messenger modules."""
 
+import io
 import unittest
 import json
 from unittest.mock import patch, MagicMock
@@ -12,9 +13,17 @@ from ds_protocol import (
     create_auth_message,
     create_direct_message,
     create_fetch_message,
-    extract_json
+    create_search_message,
+    create_conversation_message,
+    decode_frame,
+    encode_frame,
+    extract_json,
+    iter_encoded,
+    read_message
+)
+from ds_messenger import (
+    DirectMessenger, DirectMessage, LatencyAggregator, PollScheduler, StartupTimer
 )
-from ds_messenger import DirectMessenger, DirectMessage
 
 
 class TestDSPProtocol(unittest.TestCase):
@@ -59,6 +68,29 @@ class TestDSPProtocol(unittest.TestCase):
         expected = json.dumps({"token": "abc123", "fetch": "all"})
         result = create_fetch_message("abc123", "all")
         self.assertEqual(result, expected)
+        self.assertEqual(json.loads(create_fetch_message("abc123", "unread", 7))["if_newer_than"], 7)
+
+    def test_create_conversation_message(self):
+        """Test creation of a conversation page request."""
+        self.assertEqual(json.loads(create_conversation_message("abc", "bob", 10, 40)),
+                         {"token": "abc", "fetch": {"conversation": "bob", "limit": 10, "before": 40}})
+        self.assertNotIn("before", json.loads(create_conversation_message("abc", "bob"))["fetch"])
+
+    def test_extract_json_cursor(self):
+        """Test the conversation cursor is parsed only when it is an integer."""
+        self.assertEqual(extract_json('{"response": {"type": "ok", "cursor": 50}}').cursor, 50)
+        self.assertIsNone(extract_json('{"response": {"type": "ok", "cursor": "x"}}').cursor)
+
+    def test_extract_json_version(self):
+        """Test the mailbox version is parsed only when it is an integer."""
+        resp = extract_json('{"response": {"type": "not_modified", "version": 3}}')
+        self.assertEqual((resp.type, resp.version), ("not_modified", 3))
+        self.assertIsNone(extract_json('{"response": {"type": "ok", "version": true}}').version)
+
+    def test_create_search_message(self):
+        """Test creation of a search message."""
+        expected = json.dumps({"token": "abc123", "search": {"query": "lunch*", "limit": 5}})
+        self.assertEqual(create_search_message("abc123", "lunch*", 5), expected)
 
     def test_extract_json_success(self):
         """Tests successful JSON extraction."""
@@ -98,6 +130,110 @@ class TestDSPProtocol(unittest.TestCase):
         result = extract_json(12345)
         self.assertEqual(result.type, "error")
 
+    def test_extract_json_retry_after(self):
+        """Test extract_json reads a numeric retry_after hint."""
+        result = extract_json(json.dumps({"response": {"type": "error", "retry_after": 2.5}}))
+        self.assertEqual(result.retry_after, 2.5)
+        result = extract_json(json.dumps({"response": {"type": "error", "retry_after": "soon"}}))
+        self.assertIsNone(result.retry_after)
+
+
+class TestBinaryFraming(unittest.TestCase):
+    """Tests for the dspb1 binary encoding."""
+
+    def setUp(self):
+        """Build a fetch response with two message shapes."""
+        self.messages = [
+            {"from": f"user{i % 3}", "message": f"hello {i}", "timestamp": str(1700000000.5 + i)}
+            for i in range(10)
+        ]
+        self.messages.insert(4, {"recipient": "user1", "message": "sent", "timestamp": "1700000003.75"})
+        self.response = {"response": {"type": "ok", "messages": self.messages}}
+
+    def test_roundtrip_preserves_order_and_floats_timestamps(self):
+        """Test messages decode in order with numeric timestamps."""
+        decoded = decode_frame(encode_frame(self.response))["response"]["messages"]
+        self.assertEqual([m["message"] for m in decoded], [m["message"] for m in self.messages])
+        self.assertEqual(decoded[4], {"recipient": "user1", "message": "sent", "timestamp": 1700000003.75})
+        self.assertEqual(decoded[0]["timestamp"], 1700000000.5)
+
+    def test_frame_is_smaller_than_json(self):
+        """Test repeated keys and senders are not repeated on the wire."""
+        self.assertLess(len(encode_frame(self.response)), len(json.dumps(self.response)))
+
+    def test_non_numeric_timestamps_kept(self):
+        """Test a timestamp column that does not parse falls back to JSON values."""
+        response = {"response": {"type": "ok", "messages": [{"from": "a", "message": "m", "timestamp": ""}]}}
+        self.assertEqual(decode_frame(encode_frame(response)), response)
+
+    def test_rejects_hostile_row_groups(self):
+        """Test row counts are never trusted without the columns to back them."""
+        with self.assertRaises(ValueError):
+            decode_frame(encode_frame({"_rows": [[[], 100000000, []]], "response": {}}))
+        with self.assertRaises(ValueError):
+            decode_frame(encode_frame({"_rows": [[["a"], 100000000, []]], "response": {}}))
+        response = {"response": {"type": "ok", "messages": [{}, {}]}}
+        self.assertEqual(decode_frame(encode_frame(response)), response)
+
+    def test_requests_carry_no_rows(self):
+        """Test message columns are refused when decoding a request."""
+        with self.assertRaises(ValueError):
+            decode_frame(encode_frame(self.response), request=True)
+        command = {"token": "t", "fetch": "all"}
+        self.assertEqual(decode_frame(encode_frame(command), request=True), command)
+
+    def test_compressed_frames_are_bounded(self):
+        """Test decompression stops at max_size and requests may not be compressed."""
+        command = {"token": "t", "entry": "x" * 100000}
+        frame = b"".join(iter_encoded(command, compress_threshold=0))
+        self.assertEqual(decode_frame(frame), command)
+        with self.assertRaises(ValueError):
+            decode_frame(frame, max_size=1000)
+        with self.assertRaises(ValueError):
+            decode_frame(frame, request=True)
+        with self.assertRaises(ValueError):
+            decode_frame(frame[:20] + frame[-4:])
+
+    def test_extract_json_accepts_frames(self):
+        """Test extract_json decodes binary frames and rejects broken ones."""
+        resp = extract_json(encode_frame({"response": {"type": "ok", "token": "t", "encoding": "dspb1"}}))
+        self.assertEqual((resp.type, resp.token, resp.encoding), ("ok", "t", "dspb1"))
+        self.assertEqual(extract_json(encode_frame(self.response)[:-3]).type, "error")
+
+    def test_read_message(self):
+        """Test read_message reads either a JSON line or a whole frame."""
+        frame = encode_frame(self.response)
+        stream = io.BytesIO(b'{"a": 1}\r\n' + frame)
+        self.assertEqual(read_message(stream), b'{"a": 1}\r\n')
+        self.assertEqual(read_message(stream), frame)
+        self.assertEqual(read_message(stream), b"")
+
+    def test_compressed_json_roundtrip(self):
+        """Test a large JSON response is streamed as a chunked zlib frame."""
+        parts = list(iter_encoded(self.response, compress_threshold=64))
+        data = b"".join(parts)
+        self.assertGreater(len(parts), 2)
+        self.assertEqual(data[0] & 0x07, 0x07)
+        self.assertEqual(read_message(io.BytesIO(data + b"rest")), data)
+        self.assertEqual(extract_json(data).messages, self.messages)
+
+    def test_compressed_binary_roundtrip(self):
+        """Test a compressed dspb1 frame decodes like an uncompressed one."""
+        data = b"".join(iter_encoded(self.response, binary=True, compress_threshold=64))
+        self.assertEqual(extract_json(data).messages,
+                         extract_json(encode_frame(self.response)).messages)
+
+    def test_small_responses_not_compressed(self):
+        """Test responses under the threshold stay plain JSON lines."""
+        small = {"response": {"type": "ok", "message": "hi"}}
+        self.assertEqual(list(iter_encoded(small, compress_threshold=1024)),
+                         [json.dumps(small).encode() + b"\r\n"])
+
+    def test_auth_message_offers_encoding(self):
+        """Test the accept list is only added when requested."""
+        self.assertEqual(json.loads(create_auth_message("a", "b", ["dspb1"]))["accept"], ["dspb1"])
+        self.assertNotIn("accept", json.loads(create_auth_message("a", "b")))
+
 
 class TestDSMessenger(unittest.TestCase):
     """Tests for DirectMessenger class."""
@@ -177,6 +313,23 @@ class TestDSMessenger(unittest.TestCase):
         result = dm.send("hello", "bob")
         self.assertFalse(result)
 
+    @patch('ds_messenger.extract_json')
+    @patch('socket.create_connection')
+    def test_send_message_returns_stored_copy(self, _, mock_extract):
+        """Test send_message returns the message with the id and timestamp the server stored."""
+        mock_extract.return_value = extract_json(
+            '{"response": {"type": "ok", "message": "Direct message sent", "id": 7, "timestamp": 42.5}}')
+        dm = DirectMessenger()
+        dm.authenticated = True
+        dm.token = "abc123"
+        stored = dm.send_message("hello", "bob")
+        self.assertEqual((stored.id, stored.timestamp, stored.recipient, stored.message),
+                         (7, 42.5, "bob", "hello"))
+        mock_extract.return_value = extract_json('{"response": {"type": "ok", "id": true}}')
+        stored = dm.send_message("hello", "bob")
+        self.assertIsNone(stored.id)
+        self.assertIsInstance(stored.timestamp, float)
+
     @patch('ds_messenger.extract_json')
     @patch('socket.create_connection')
     def test_send_fails_on_bad_token(self, _, mock_extract):
@@ -197,14 +350,14 @@ class TestDSMessenger(unittest.TestCase):
         result = dm.send("Hello", "bob")
         self.assertFalse(result)
 
-    @patch('builtins.print')
     @patch('socket.create_connection', side_effect=OSError("Simulated send failure"))
-    def test_send_print_exception(self, _, mock_print):
-        """Test send prints error on network failure."""
+    def test_send_logs_exception(self, _):
+        """Test send logs the error on network failure."""
         dm = DirectMessenger()
         dm.authenticated = True
-        dm.send("Hello", "bob")
-        mock_print.assert_called_with("Send failed: Simulated send failure")
+        with self.assertLogs("dsp.client", "WARNING") as logs:
+            dm.send("Hello", "bob")
+        self.assertIn("Send failed: Simulated send failure", logs.output[-1])
 
     @patch('ds_messenger.extract_json')
     @patch('socket.create_connection')
@@ -246,6 +399,87 @@ class TestDSMessenger(unittest.TestCase):
         result = dm.retrieve_all()
         self.assertEqual(result, [])
 
+    @patch('ds_messenger.extract_json')
+    @patch('socket.create_connection')
+    def test_search_returns_direct_messages(self, mock_conn, mock_extract):
+        """Test search sends a search command and converts the results."""
+        mock_resp = MagicMock()
+        mock_resp.type = 'ok'
+        mock_resp.token = 'abc123'
+        mock_resp.messages = [{"id": 7, "from": "bob", "message": "lunch?", "timestamp": 1.0}]
+        mock_extract.return_value = mock_resp
+        dm = DirectMessenger()
+        dm.authenticated = True
+        result = dm.search("lunch", 5)
+        self.assertEqual([(m.id, m.sender, m.message) for m in result], [(7, "bob", "lunch?")])
+        written = mock_conn.return_value.makefile.return_value.write.call_args_list
+        self.assertIn(b'"search"', written[-1].args[0])
+
+    @patch('ds_messenger.time.sleep')
+    @patch('ds_messenger.extract_json')
+    @patch('socket.create_connection')
+    def test_send_many_one_connection(self, mock_conn, mock_extract, mock_sleep):
+        """Test send_many authenticates once and retries a throttled message."""
+        ok = MagicMock(type='ok', token='abc123', retry_after=None)
+        throttled = MagicMock(type='error', retry_after=0.5)
+        mock_extract.side_effect = [ok, ok, ok, throttled, ok]
+        dm = DirectMessenger()
+        results = list(dm.send_many(iter([("bob", "one"), ("carol", "two")])))
+        self.assertEqual([(r, m, s is not None) for r, m, s in results],
+                         [("bob", "one", True), ("carol", "two", True)])
+        self.assertEqual(mock_conn.call_count, 2)
+        mock_sleep.assert_called_once_with(0.5)
+        self.assertIsNone(dm.error)
+
+    @patch('socket.create_connection', side_effect=OSError("down"))
+    def test_send_many_stops_on_network_error(self, _):
+        """Test send_many records the error and stops consuming messages."""
+        dm = DirectMessenger()
+        dm.authenticated = True
+        remaining = iter([("bob", "one"), ("bob", "two")])
+        with self.assertLogs("dsp.client", "WARNING"):
+            self.assertEqual(list(dm.send_many(remaining)), [])
+        self.assertEqual(dm.error, "down")
+        self.assertEqual(next(remaining), ("bob", "one"))
+
+    @patch('ds_messenger.extract_json')
+    @patch('socket.create_connection')
+    def test_autoconnect_disabled(self, mock_conn, mock_extract):
+        """Test a messenger created without autoconnect stays offline until connect()."""
+        mock_extract.return_value = MagicMock(type='error', message='Invalid password')
+        dm = DirectMessenger(autoconnect=False)
+        self.assertFalse(dm.authenticated)
+        mock_conn.assert_not_called()
+        self.assertFalse(dm.connect())
+        self.assertEqual(dm.error, 'Invalid password')
+        mock_extract.return_value = MagicMock(type='ok', token='abc123')
+        self.assertTrue(dm.connect())
+        self.assertIsNone(dm.error)
+        self.assertTrue(dm.connect())
+        self.assertEqual(mock_conn.call_count, 2)
+
+    @patch('ds_messenger.extract_json')
+    @patch('socket.create_connection')
+    def test_retrieve_new_sends_last_version(self, mock_conn, mock_extract):
+        """Test unread fetches pass back the mailbox version of the previous one."""
+        mock_resp = MagicMock()
+        mock_resp.type = 'ok'
+        mock_resp.token = 'abc123'
+        mock_resp.messages = []
+        mock_resp.version = 4
+        not_modified = MagicMock()
+        not_modified.type = 'not_modified'
+        not_modified.version = 4
+        mock_extract.side_effect = [mock_resp] * 4 + [not_modified]
+        dm = DirectMessenger()
+        dm.authenticated = True
+        dm.retrieve_new()
+        written = mock_conn.return_value.makefile.return_value.write.call_args_list
+        self.assertNotIn(b'if_newer_than', written[-1].args[0])
+        self.assertEqual(dm.retrieve_new(), [])
+        self.assertIn(b'"if_newer_than": 4', written[-1].args[0])
+        self.assertEqual(dm.versions, {"unread": 4})
+
     @patch('ds_messenger.extract_json')
     @patch('socket.create_connection')
     def test_retrieve_malformed_message_fields(self, _, mock_extract):
@@ -269,14 +503,14 @@ class TestDSMessenger(unittest.TestCase):
         result = dm.retrieve_all()
         self.assertEqual(result, [])
 
-    @patch('builtins.print')
     @patch('socket.create_connection', side_effect=OSError("Simulated retrieve error"))
-    def test_retrieve_print_exception(self, _, mock_print):
-        """Test retrieve prints exception on error."""
+    def test_retrieve_logs_exception(self, _):
+        """Test retrieve logs the error on network failure."""
         dm = DirectMessenger()
         dm.authenticated = True
-        dm.retrieve_all()
-        mock_print.assert_called_with("Retrieve failed: Simulated retrieve error")
+        with self.assertLogs("dsp.client", "WARNING") as logs:
+            dm.retrieve_all()
+        self.assertIn("Retrieve failed: Simulated retrieve error", logs.output[-1])
 
     @patch('socket.create_connection')
     @patch('ds_messenger.extract_json')
@@ -296,5 +530,85 @@ class TestDSMessenger(unittest.TestCase):
         self.assertEqual(dm.token, 'tok123')
 
 
+class TestLatencyAggregator(unittest.TestCase):
+    """Tests for the timing hooks and LatencyAggregator."""
+
+    @patch('ds_messenger.extract_json')
+    @patch('socket.create_connection')
+    def test_hooks_receive_every_phase(self, mock_conn, mock_extract):
+        """Test a retrieve reports connect, auth, command, bytes and decode events."""
+        mock_extract.return_value = MagicMock(type='ok', token='abc123', messages=[])
+        mock_conn.return_value.makefile.return_value.readline.return_value = b'{"response": {}}\r\n'
+        events = []
+        dm = DirectMessenger(hooks=[lambda event, value: events.append(event)])
+        self.assertEqual(events, ["connect", "auth", "bytes_sent", "bytes_received", "decode"])
+        del events[:]
+        dm.retrieve_new()
+        self.assertEqual(events.count("auth"), 1)
+        self.assertEqual(events.count("command"), 1)
+        self.assertEqual(events.count("bytes_received"), 2)
+
+    def test_startup_timer_keeps_first_mark(self):
+        """Test a phase keeps the time it was first reached."""
+        startup = StartupTimer()
+        first = startup.mark("ui")
+        self.assertEqual(startup.mark("ui"), first)
+        startup.mark("online")
+        self.assertEqual(list(startup.phases), ["ui", "online"])
+        self.assertTrue(startup.summary().startswith("startup: ui "))
+
+    def test_summary(self):
+        """Test the aggregator reports percentiles for timings and totals for bytes."""
+        latency = LatencyAggregator(window=10)
+        self.assertEqual(latency.summary(), "No requests timed yet.")
+        for i in range(1, 21):
+            latency("command", i / 1000)
+        latency("bytes_sent", 100)
+        latency("bytes_sent", 50)
+        stats = latency.snapshot()
+        self.assertEqual(stats["command"]["count"], 20)
+        self.assertAlmostEqual(stats["command"]["p50_ms"], 15.0)
+        self.assertAlmostEqual(stats["command"]["max_ms"], 20.0)
+        self.assertEqual(stats["bytes_sent"], {"count": 2, "total": 150})
+        self.assertIn("150 bytes sent", latency.summary())
+
+
+class TestPollScheduler(unittest.TestCase):
+    """Tests for PollScheduler."""
+
+    def test_backs_off_when_idle(self):
+        """Test delays grow exponentially up to the maximum while idle."""
+        poller = PollScheduler(base_interval=5, max_interval=40, jitter=0)
+        delays = [poller.next_delay() for _ in range(6)]
+        self.assertEqual(delays, [5, 10, 20, 40, 40, 40])
+
+    def test_long_idle_stays_at_maximum(self):
+        """Test thousands of idle polls keep returning the maximum without overflowing."""
+        poller = PollScheduler(base_interval=5, max_interval=60, jitter=0)
+        delays = [poller.next_delay() for _ in range(5000)]
+        self.assertEqual(delays[-1], 60)
+        self.assertLess(poller.idle_polls, 10)
+
+    def test_fast_while_active(self):
+        """Test new messages switch to the active interval and reset backoff."""
+        poller = PollScheduler(active_interval=1, base_interval=5, jitter=0)
+        poller.next_delay()
+        poller.next_delay()
+        self.assertEqual(poller.next_delay(got_messages=True), 1)
+        self.assertEqual(poller.idle_polls, 0)
+
+    def test_jitter_bounds(self):
+        """Test jittered delays stay within the configured fraction."""
+        poller = PollScheduler(base_interval=10, backoff=1, jitter=0.2)
+        for _ in range(50):
+            self.assertTrue(8 <= poller.next_delay() <= 12)
+
+    def test_honors_retry_after(self):
+        """Test a server retry hint is never undercut."""
+        poller = PollScheduler(active_interval=1, jitter=0)
+        poller.mark_activity()
+        self.assertEqual(poller.next_delay(retry_after=7.5), 7.5)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,123 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Unit tests for the non-widget helpers in the gui module."""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from notebook import Notebook, Diary
+from gui import ConversationCache, MessengerWorker
+
+
+class TestConversationCache(unittest.TestCase):
+    """Tests for ConversationCache."""
+
+    def setUp(self):
+        """Create a notebook with a short conversation."""
+        self.notebook = Notebook("alice", "pw", "bio")
+        self.notebook.add_diary(Diary("bob → You: hi", 1.0))
+        self.notebook.add_diary(Diary("You → bob: hey", 2.0))
+        self.notebook.add_diary(Diary("carol → You: yo", 3.0))
+        self.cache = ConversationCache(self.notebook)
+        self.cache.refresh()
+
+    def test_groups_by_contact(self):
+        """Test diaries are grouped by peer."""
+        self.assertEqual(self.cache.count("bob"), 2)
+        self.assertEqual(self.cache.count("carol"), 1)
+        self.assertEqual(self.cache.count("dave"), 0)
+
+    def test_segments_are_insert_arguments(self):
+        """Test segments flatten to alternating text and tags."""
+        args = self.cache.segments("bob", 1, 2)
+        self.assertEqual(args[1], "timestamp")
+        self.assertEqual(args[2:6], ["You: ", "name", "hey\n", ()])
+
+    def test_refresh_is_incremental(self):
+        """Test only new diaries are indexed on refresh."""
+        self.notebook.add_diary(Diary("bob → You: again", 4.0))
+        self.cache.refresh()
+        self.assertEqual(self.cache.count("bob"), 3)
+        self.cache.refresh()
+        self.assertEqual(self.cache.count("bob"), 3)
+
+    def test_refresh_rebuilds_after_delete(self):
+        """Test deleting diaries from the notebook rebuilds the cache."""
+        self.notebook.del_diary(0)
+        self.cache.refresh()
+        self.assertEqual(self.cache.count("bob"), 1)
+
+    def test_refresh_rebuilds_after_replace(self):
+        """Test a diary swapped for another keeps no stale row at the same length."""
+        self.notebook.del_diary(2)
+        self.notebook.add_diary(Diary("dave → You: new", 3.0))
+        self.cache.refresh()
+        self.assertEqual((self.cache.count("carol"), self.cache.count("dave")), (0, 1))
+
+    def test_refresh_rebuilds_after_load(self):
+        """Test loading a longer notebook over the current one rebuilds the cache."""
+        other = Notebook("alice", "pw", "bio")
+        for i in range(4):
+            other.add_diary(Diary(f"dave → You: {i}", float(i)))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "alice.json")
+            other.save(path)
+            self.notebook.load(path)
+        self.cache.refresh()
+        self.assertEqual((self.cache.count("bob"), self.cache.count("dave")), (0, 4))
+
+
+class TestMessengerWorker(unittest.TestCase):
+    """Tests for MessengerWorker."""
+
+    def setUp(self):
+        """Start a worker."""
+        self.worker = MessengerWorker()
+
+    def tearDown(self):
+        """Stop the worker."""
+        self.worker.stop()
+
+    def wait_for(self, results, count):
+        """Poll the worker until count callbacks have run."""
+        deadline = time.time() + 2
+        while len(results) < count and time.time() < deadline:
+            self.worker.poll()
+            time.sleep(0.01)
+
+    def test_results_delivered_by_poll(self):
+        """Test callbacks run on the polling thread, not the worker thread."""
+        results = []
+        self.worker.submit(lambda a, b: a + b, 2, 3,
+                           on_done=lambda r, e: results.append((r, e, threading.current_thread())))
+        self.wait_for(results, 1)
+        self.assertEqual(results[0][:2], (5, None))
+        self.assertIs(results[0][2], threading.current_thread())
+
+    def test_errors_are_reported(self):
+        """Test an exception in a task is passed to the callback."""
+        results = []
+
+        def fail():
+            raise OSError("down")
+
+        self.worker.submit(fail, on_done=lambda r, e: results.append(e))
+        self.wait_for(results, 1)
+        self.assertIsInstance(results[0], OSError)
+
+    def test_tasks_run_in_order(self):
+        """Test tasks are executed in submission order."""
+        results = []
+        for i in range(5):
+            self.worker.submit(lambda i=i: i, on_done=lambda r, e: results.append(r))
+        self.wait_for(results, 5)
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+
+
+if __name__ == '__main__':
+    unittest.main()
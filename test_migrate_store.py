@@ -0,0 +1,98 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Unit tests for the migrate_store tool."""
+
+import contextlib
+import gzip
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from migrate_store import iter_users, main, migrate
+from server import partition_of
+
+
+class TestMigrateStore(unittest.TestCase):
+    """Tests for streaming, migrating and verifying a store."""
+
+    def setUp(self):
+        """Write a small store with an archived message."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.store = os.path.join(self.tmpdir.name, "store")
+        self.users = {
+            "alice": {"password": "pw", "version": 2, "next_id": 3, "messages": [
+                {"id": 1, "message": "hi", "recipient": "bob", "timestamp": 1.0, "status": "sent"},
+                {"id": 2, "message": "{\"tricky\": \"}\"}", "from": "bob", "timestamp": 2.0,
+                 "status": "unread"}]},
+            "bob": {"password": "pw", "version": 1, "next_id": 3, "messages": [
+                {"id": 2, "message": "yo", "recipient": "alice", "timestamp": 2.0, "status": "sent"}]},
+            "zoë": {"password": "pw", "messages": []},
+        }
+        os.makedirs(os.path.join(self.store, "archive", "bob"))
+        with gzip.open(os.path.join(self.store, "archive", "bob", "000000.jsonl.gz"), "wb") as segment:
+            segment.write(json.dumps({"id": 1, "message": "hi", "from": "alice", "timestamp": 1.0,
+                                      "status": "read"}).encode() + b"\n")
+        with open(os.path.join(self.store, "users.json"), "w", encoding="utf-8") as f:
+            json.dump(self.users, f, indent=4)
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.tmpdir.cleanup()
+
+    def test_iter_users_small_chunks(self):
+        """Test records split across many tiny chunks are decoded one user at a time."""
+        users = list(iter_users(os.path.join(self.store, "users.json"), chunk_size=7))
+        self.assertEqual(users, list(self.users.items()))
+
+    def test_iter_users_empty_and_invalid(self):
+        """Test an empty store yields nothing and a truncated one raises ValueError."""
+        path = os.path.join(self.tmpdir.name, "users.json")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(" { } ")
+        self.assertEqual(list(iter_users(path)), [])
+        with open(path, "w", encoding="utf-8") as f:
+            f.write('{"alice": {"messages": [')
+        with self.assertRaises(ValueError):
+            list(iter_users(path, chunk_size=4))
+
+    def test_migrate_to_shards(self):
+        """Test users land in their partition's shard with their archives, and counts verify."""
+        out = os.path.join(self.tmpdir.name, "sharded")
+        stats, mismatches = migrate(self.store, "shards", out, partitions=3, chunk_size=16)
+        self.assertEqual(mismatches, [])
+        self.assertEqual({s["user"]: s["archived"] for s in stats}, {"alice": 0, "bob": 1, "zoë": 0})
+        for username, record in self.users.items():
+            shard = os.path.join(out, f"shard-{partition_of(username, 3)}")
+            with open(os.path.join(shard, "users.json"), encoding="utf-8") as f:
+                self.assertEqual(json.load(f)[username], record)
+        bob_shard = os.path.join(out, f"shard-{partition_of('bob', 3)}")
+        self.assertTrue(os.path.exists(os.path.join(bob_shard, "archive", "bob", "000000.jsonl.gz")))
+
+    def test_migrate_to_sqlite(self):
+        """Test hot and archived messages are written to SQLite."""
+        db_path = os.path.join(self.tmpdir.name, "store.db")
+        _, mismatches = migrate(self.store, "sqlite", db_path)
+        self.assertEqual(mismatches, [])
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            rows = conn.execute("SELECT id, peer, direction, archived FROM messages "
+                                "WHERE username = 'bob' ORDER BY id").fetchall()
+            self.assertEqual(rows, [(1, "alice", "in", 1), (2, "alice", "out", 0)])
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM users").fetchone(), (3,))
+
+    def test_main_inspect_and_existing_target(self):
+        """Test inspection prints statistics and an existing target is refused."""
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertEqual(main([self.store]), 0)
+        self.assertIn("3 users, 3 hot messages (1 unread), 1 archived", out.getvalue())
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(main([self.store, "--to", "sqlite", "--out", self.store]), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
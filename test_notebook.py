@@ -0,0 +1,233 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Unit tests for the notebook module."""
+
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from notebook import (
+    Notebook,
+    Diary,
+    NotebookFileError,
+    IncorrectNotebookError,
+    split_entry,
+    iter_archive
+)
+
+
+class TestNotebookSave(unittest.TestCase):
+    """Tests for saving, loading and autosaving notebooks."""
+
+    def setUp(self):
+        """Create a temporary directory and a notebook to work with."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "alice.json")
+        self.notebook = Notebook("alice", "pw", "bio")
+
+    def tearDown(self):
+        """Detach autosave and remove the temporary directory."""
+        if self.notebook._autosaver is not None:
+            self.notebook._autosaver.close()
+        self.tmpdir.cleanup()
+
+    def test_save_and_load_roundtrip(self):
+        """Test a saved notebook loads back with the same data."""
+        self.notebook.add_diary(Diary("You → bob: hi", 100.0))
+        self.notebook.add_contact("bob")
+        self.notebook.save(self.path)
+
+        loaded = Notebook("", "", "")
+        loaded.load(self.path)
+        self.assertEqual(loaded.username, "alice")
+        self.assertEqual(list(loaded.contacts), ["bob"])
+        self.assertEqual(loaded.get_diaries()[0].entry, "You → bob: hi")
+
+    def test_load_note_with_arrow_in_text(self):
+        """Test a note whose arrow follows its first colon loads and merges as a plain note."""
+        self.notebook.add_diary(Diary("todo: a → b", 100.0))
+        self.notebook.save(self.path)
+
+        loaded = Notebook("", "", "")
+        loaded.load(self.path)
+        self.assertEqual(loaded.merge_diaries([Diary("todo: a → b", 100.0)]), (0, 1))
+        self.assertEqual(loaded.merge_diaries([Diary("bob → You: a → b", 100.0)]), (1, 0))
+
+    def test_save_leaves_no_temp_files(self):
+        """Test the atomic save cleans up its temporary file."""
+        self.notebook.save(self.path)
+        self.assertEqual(os.listdir(self.tmpdir.name), ["alice.json"])
+
+    def test_save_invalid_suffix(self):
+        """Test saving to a non-json path raises NotebookFileError."""
+        with self.assertRaises(NotebookFileError):
+            self.notebook.save(os.path.join(self.tmpdir.name, "alice.txt"))
+
+    def test_mark_dirty_without_autosave(self):
+        """Test mark_dirty is a no-op when autosave is not enabled."""
+        self.notebook.mark_dirty()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_autosave_coalesces_changes(self):
+        """Test several changes inside the window produce a single save."""
+        self.notebook.enable_autosave(self.path, delay=0.05)
+        with patch.object(Notebook, "save", wraps=self.notebook.save) as mock_save:
+            for i in range(10):
+                self.notebook.add_diary(Diary(f"You → bob: {i}", float(i + 1)))
+                self.notebook.mark_dirty()
+            time.sleep(0.3)
+        self.assertEqual(mock_save.call_count, 1)
+        loaded = Notebook("", "", "")
+        loaded.load(self.path)
+        self.assertEqual(len(loaded.get_diaries()), 10)
+
+    def test_autosave_retries_failed_save(self):
+        """Test a save that fails is retried by the timer without another change."""
+        self.notebook.enable_autosave(self.path, delay=0.05)
+        save = self.notebook.save
+        failures = []
+
+        def failing_save(path):
+            if not failures:
+                failures.append(path)
+                raise OSError("disk full")
+            save(path)
+
+        with patch.object(self.notebook, "save", side_effect=failing_save), patch("builtins.print"):
+            self.notebook.mark_dirty()
+            deadline = time.time() + 5
+            while not os.path.exists(self.path) and time.time() < deadline:
+                time.sleep(0.02)
+        self.assertEqual(len(failures), 1)
+        self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(self.notebook._autosaver.dirty)
+
+    def test_flush_saves_immediately(self):
+        """Test flush writes pending changes without waiting for the timer."""
+        self.notebook.enable_autosave(self.path, delay=60)
+        self.notebook.mark_dirty()
+        self.notebook.flush()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(self.notebook._autosaver.dirty)
+
+
+class TestNotebookMerge(unittest.TestCase):
+    """Tests for the dedup index, merge API and contacts set."""
+
+    def setUp(self):
+        """Create an empty notebook."""
+        self.notebook = Notebook("alice", "pw", "bio")
+
+    def test_split_entry(self):
+        """Test message entries are split into peer, direction and text."""
+        self.assertEqual(split_entry("You → bob: hi: there"), ("bob", "out", "hi: there"))
+        self.assertEqual(split_entry("bob → You: yo"), ("bob", "in", "yo"))
+        self.assertEqual(split_entry("just a note"), (None, None, "just a note"))
+        self.assertEqual(split_entry("todo: a → b"), (None, None, "todo: a → b"))
+
+    def test_merge_skips_duplicates(self):
+        """Test merging the same batch twice inserts it only once."""
+        batch = [Diary("bob → You: hi", 1.0), Diary("You → bob: hey", 2.0)]
+        self.assertEqual(self.notebook.merge_diaries(batch), (2, 0))
+        again = [Diary("bob → You: hi", 1.0), Diary("You → bob: hey", 2.0)]
+        self.assertEqual(self.notebook.merge_diaries(again), (0, 2))
+        self.assertEqual(len(self.notebook.get_diaries()), 2)
+
+    def test_merge_dedupes_within_batch(self):
+        """Test duplicates inside one batch are skipped."""
+        result = self.notebook.merge_diaries([Diary("bob → You: hi", 1.0)] * 3)
+        self.assertEqual(result.inserted, 1)
+        self.assertEqual(result.skipped, 2)
+
+    def test_merge_distinguishes_direction(self):
+        """Test the same text and time in opposite directions are both kept."""
+        batch = [Diary("bob → You: hi", 1.0), Diary("You → bob: hi", 1.0)]
+        self.assertEqual(self.notebook.merge_diaries(batch).inserted, 2)
+
+    def test_merge_adds_contacts_in_order(self):
+        """Test merged peers become contacts without duplicates."""
+        self.notebook.add_contact("carol")
+        self.notebook.merge_diaries([Diary("bob → You: a", 1.0),
+                                     Diary("carol → You: b", 2.0),
+                                     Diary("You → bob: c", 3.0)])
+        self.assertEqual(list(self.notebook.contacts), ["carol", "bob"])
+        self.assertFalse(self.notebook.add_contact("bob"))
+
+    def test_del_diary_updates_index(self):
+        """Test a deleted diary can be merged back in."""
+        self.notebook.add_diary(Diary("bob → You: hi", 1.0))
+        self.assertTrue(self.notebook.del_diary(0))
+        self.assertEqual(self.notebook.merge_diaries([Diary("bob → You: hi", 1.0)]).inserted, 1)
+
+
+class TestNotebookArchive(unittest.TestCase):
+    """Tests for the compressed notebook archive format."""
+
+    def setUp(self):
+        """Create a temporary directory and a populated notebook."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "alice.dsnb.gz")
+        self.notebook = Notebook("alice", "pw", "bio")
+        self.notebook.add_contact("bob")
+        self.notebook.merge_diaries([Diary(f"bob → You: msg {i}", float(i + 1))
+                                     for i in range(2500)])
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.tmpdir.cleanup()
+
+    def test_export_import_roundtrip(self):
+        """Test an exported archive imports back into an empty notebook."""
+        self.assertEqual(self.notebook.export_archive(self.path), 2500)
+        restored = Notebook("", "", "")
+        result = restored.import_archive(self.path)
+        self.assertEqual(result, (2500, 0))
+        self.assertEqual(restored.username, "alice")
+        self.assertEqual(list(restored.contacts), ["bob"])
+        self.assertEqual(restored.get_diaries()[-1].entry, "bob → You: msg 2499")
+
+    def test_import_is_idempotent(self):
+        """Test importing into a notebook that already has the diaries skips them."""
+        self.notebook.export_archive(self.path)
+        self.assertEqual(self.notebook.import_archive(self.path), (0, 2500))
+
+    def test_iter_archive_streams_records(self):
+        """Test iter_archive yields the profile first and then the records."""
+        self.notebook.export_archive(self.path)
+        records = iter_archive(self.path)
+        kind, profile = next(records)
+        self.assertEqual((kind, profile["username"]), ("profile", "alice"))
+        self.assertEqual(next(records), ("contact", "bob"))
+
+    def test_failed_export_keeps_previous_archive(self):
+        """Test an export that fails midway leaves the previous archive intact and no temp file."""
+        self.notebook.export_archive(self.path)
+        self.notebook.add_diary(Diary("bob → You: unsaved", 9999.0))
+        calls = []
+
+        def failing_dumps(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == 100:
+                raise OSError("disk full")
+            return "{}"
+
+        with patch("notebook.json.dumps", side_effect=failing_dumps):
+            with self.assertRaises(NotebookFileError):
+                self.notebook.export_archive(self.path)
+        self.assertEqual(Notebook("", "", "").import_archive(self.path), (2500, 0))
+        self.assertEqual(os.listdir(self.tmpdir.name), [os.path.basename(self.path)])
+
+    def test_import_corrupted_archive(self):
+        """Test a file that is not an archive raises IncorrectNotebookError."""
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write("not gzip")
+        with self.assertRaises(IncorrectNotebookError):
+            Notebook("", "", "").import_archive(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
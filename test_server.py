@@ -0,0 +1,826 @@
+# NAME: Cameron Chen
+# EMAIL: camerm3@uci.edu
+# STUDENT ID: 49753193
+
+"""Integration tests for DSUServer over real local sockets."""
+
+import gzip
+import json
+import os
+import pathlib
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+
+import server
+from ds_protocol import (
+    create_auth_message,
+    create_direct_message,
+    create_fetch_message,
+    create_search_message,
+    create_conversation_message,
+    encode_frame,
+    extract_json,
+    read_message
+)
+
+
+class ServerTestCase(unittest.TestCase):
+    """Starts a DSUServer on a free port with a temporary store."""
+
+    server_options = {}
+
+    def setUp(self):
+        """Start the server in a background thread."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.debug_patch = patch.object(server, "DEBUG", False)
+        self.debug_patch.start()
+        self.server = server.DSUServer("127.0.0.1", 0, self.tmpdir.name, **self.server_options)
+        self.thread = threading.Thread(target=self.server.start_server, daemon=True)
+        self.thread.start()
+        self.assertTrue(self.server.ready.wait(5))
+        self.connections = []
+
+    def tearDown(self):
+        """Stop the server and remove the store."""
+        for conn in self.connections:
+            conn.close()
+        self.server.stop()
+        self.thread.join(5)
+        self.debug_patch.stop()
+        self.tmpdir.cleanup()
+
+    def raw_request(self, payload):
+        """Send one raw command on a new connection and return the decoded response dict."""
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        self.connections.append(sock)
+        sock.sendall(payload.encode() + b"\r\n")
+        return json.loads(sock.makefile("r").readline())
+
+    def connect(self, port=None):
+        """Open a client connection, to the test server unless another port is given, returning a request function."""
+        sock = socket.create_connection(("127.0.0.1", port or self.server.port), timeout=5)
+        self.connections.append(sock)
+        send = sock.makefile("w")
+        recv = sock.makefile("r")
+
+        def request(payload):
+            send.write(payload + "\r\n")
+            send.flush()
+            return extract_json(recv.readline())
+
+        return request
+
+    def login(self, username, password="pw", port=None):
+        """Open a connection and authenticate, returning (request, token)."""
+        request = self.connect(port)
+        resp = request(create_auth_message(username, password))
+        self.assertEqual(resp.type, "ok")
+        return request, resp.token
+
+
+class TestDSUServer(ServerTestCase):
+    """Tests for the basic DSP commands."""
+
+    def test_store_created_in_store_dir(self):
+        """Test the users file lives in the configured store directory."""
+        self.login("alice")
+        with open(self.server.users_path, encoding="utf-8") as f:
+            self.assertIn("alice", json.load(f))
+
+    def test_wrong_password(self):
+        """Test authenticating with the wrong password fails."""
+        self.login("alice", "pw")
+        resp = self.connect()(create_auth_message("alice", "nope"))
+        self.assertEqual(resp.type, "error")
+
+    def test_send_and_fetch(self):
+        """Test a direct message is delivered unread and then marked read."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        resp = alice(create_direct_message(token, "hi bob", "bob", 1.0))
+        self.assertEqual(resp.type, "ok")
+
+        bob, bob_token = self.login("bob")
+        resp = bob(create_fetch_message(bob_token, "unread"))
+        self.assertEqual([m["message"] for m in resp.messages], ["hi bob"])
+        self.assertEqual(resp.messages[0]["from"], "alice")
+        self.assertEqual(bob(create_fetch_message(bob_token, "unread")).messages, [])
+        self.assertEqual(len(bob(create_fetch_message(bob_token, "all")).messages), 1)
+
+    def test_send_reports_stored_copy(self):
+        """Test a sent direct message reports the id and timestamp of the sender's stored copy."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        resp = alice(create_direct_message(token, "hi bob", "bob", 1.0))
+        stored = alice(create_fetch_message(token, "all")).messages[0]
+        self.assertEqual((resp.id, resp.timestamp), (stored["id"], stored["timestamp"]))
+        resp = alice(create_direct_message(token, "hi nobody", "nobody", 1.0))
+        self.assertEqual((resp.type, resp.id, resp.timestamp), ("error", None, None))
+
+    def test_messages_are_numbered_per_mailbox(self):
+        """Test every mailbox numbers its messages from 1 and stores numeric timestamps."""
+        self.login("bob")
+        self.login("carol")
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "hi bob", "bob", 1.0))
+        alice(create_direct_message(token, "hi carol", "carol", 1.0))
+        alice(create_direct_message(token, "bye bob", "bob", 1.0))
+        messages = alice(create_fetch_message(token, "all")).messages
+        self.assertEqual([m["id"] for m in messages], [1, 2, 3])
+        self.assertTrue(all(isinstance(m["timestamp"], float) for m in messages))
+        bob, bob_token = self.login("bob")
+        self.assertEqual([m["id"] for m in bob(create_fetch_message(bob_token, "unread")).messages], [1, 2])
+
+    def test_upgrade_numbers_existing_messages(self):
+        """Test messages stored without ids are numbered by time, archived ones included."""
+        archive = self.server._user_archive("bob")
+        archive.mkdir(parents=True)
+        with gzip.open(archive / "000000.jsonl.gz", "wb") as segment:
+            segment.write(json.dumps({"message": "old", "from": "alice", "timestamp": "1.0",
+                                      "status": "read"}).encode() + b"\n")
+        with open(self.server.users_path, "w", encoding="utf-8") as f:
+            json.dump({"bob": {"password": "pw", "messages": [
+                {"message": "late", "from": "alice", "timestamp": "3.0", "status": "unread"},
+                {"message": "early", "from": "alice", "timestamp": "2.0", "status": "read"}]}}, f)
+        self.server._upgrade_store()
+
+        with open(self.server.users_path, encoding="utf-8") as f:
+            bob_record = json.load(f)["bob"]
+        self.assertEqual(bob_record["next_id"], 4)
+        self.assertEqual([(m["id"], m["timestamp"]) for m in bob_record["messages"]], [(2, 2.0), (3, 3.0)])
+        bob, bob_token = self.login("bob")
+        self.assertEqual([(m["id"], m["message"]) for m in bob(create_fetch_message(bob_token, "all")).messages],
+                         [(1, "old"), (2, "early"), (3, "late")])
+
+    def test_send_to_unknown_user(self):
+        """Test sending to a user that does not exist fails."""
+        alice, token = self.login("alice")
+        resp = alice(create_direct_message(token, "hello?", "nobody", 1.0))
+        self.assertEqual(resp.type, "error")
+
+    def test_invalid_token(self):
+        """Test fetching with a token from another session fails."""
+        alice, _ = self.login("alice")
+        self.assertEqual(alice(create_fetch_message("bogus", "all")).type, "error")
+
+
+class TestConnectionHandling(ServerTestCase):
+    """Tests for framing, timeouts, backpressure and draining."""
+
+    server_options = {"max_workers": 1, "accept_queue_size": 1,
+                      "idle_timeout": 0.5, "read_timeout": 0.3, "drain_timeout": 1}
+
+    def open_socket(self):
+        """Open a raw socket to the server."""
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        self.connections.append(sock)
+        return sock
+
+    def test_request_split_across_packets(self):
+        """Test a request arriving in pieces is read as one line."""
+        sock = self.open_socket()
+        payload = create_auth_message("alice", "pw").encode() + b"\r\n"
+        sock.sendall(payload[:10])
+        time.sleep(0.05)
+        sock.sendall(payload[10:])
+        self.assertEqual(extract_json(sock.makefile("r").readline()).type, "ok")
+
+    def test_idle_timeout_closes_connection(self):
+        """Test a connection that sends nothing is closed after the idle timeout."""
+        sock = self.open_socket()
+        self.assertEqual(sock.recv(1), b"")
+
+    def test_read_timeout_closes_partial_request(self):
+        """Test a request that never finishes is dropped after the read timeout."""
+        sock = self.open_socket()
+        sock.sendall(b'{"authenticate": ')
+        start = time.monotonic()
+        self.assertEqual(sock.recv(1), b"")
+        self.assertLess(time.monotonic() - start, 0.5)
+
+    def test_rejects_when_queue_full(self):
+        """Test connections beyond the workers and queue get a busy error."""
+        self.open_socket()  # Occupies the only worker
+        time.sleep(0.05)
+        self.open_socket()  # Waits in the accept queue
+        time.sleep(0.05)
+        rejected = self.open_socket()
+        resp = extract_json(rejected.makefile("r").readline())
+        self.assertEqual(resp.type, "error")
+        self.assertEqual(resp.retry_after, server.BUSY_RETRY_AFTER)
+
+    def test_stop_drains_idle_connections(self):
+        """Test stopping the server closes idle connections promptly."""
+        self.login("alice")
+        start = time.monotonic()
+        self.server.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+class TestServerMetrics(ServerTestCase):
+    """Tests for the metrics surface."""
+
+    def test_stats_command(self):
+        """Test the stats command reports per-command counts and store I/O."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "hi", "bob", 1.0))
+        alice(create_fetch_message(token, "all"))
+
+        # Metrics are recorded just after the response is sent
+        deadline = time.time() + 2
+        while True:
+            stats = self.raw_request(json.dumps({"stats": {}}))["response"]["stats"]
+            if "fetch_all" in stats["commands"] or time.time() > deadline:
+                break
+            time.sleep(0.01)
+        self.assertEqual(stats["commands"]["authenticate"]["count"], 2)
+        self.assertEqual(stats["commands"]["directmessage"]["count"], 1)
+        self.assertEqual(stats["commands"]["fetch_all"]["latency"]["count"], 1)
+        self.assertGreater(stats["store_bytes_read"], 0)
+        self.assertGreater(stats["store_bytes_written"], 0)
+        self.assertEqual(stats["lock_wait"]["count"], 4)
+        self.assertGreaterEqual(stats["active_connections"], 1)
+
+    def test_stats_snapshot_file(self):
+        """Test write_stats_snapshot writes a JSON file in the store."""
+        self.login("alice")
+        self.server.write_stats_snapshot()
+        with open(self.server.stats_path, encoding="utf-8") as f:
+            self.assertGreater(json.load(f)["store_bytes_read"], 0)
+
+    def test_histogram_percentiles(self):
+        """Test histogram percentiles report bucket upper bounds."""
+        hist = server.Histogram((1, 10, 100))
+        for ms in (0.5, 0.5, 5, 50):
+            hist.observe(ms)
+        self.assertEqual(hist.percentile(50), 1)
+        self.assertEqual(hist.percentile(99), 100)
+
+
+class TestRateLimiting(ServerTestCase):
+    """Tests for per-user, per-address and fetch all rate limits."""
+
+    server_options = {"user_limit": (1, 3), "address_limit": (0, 0), "fetch_all_limit": (0.01, 1)}
+
+    def test_token_bucket(self):
+        """Test a bucket allows a burst and then refills at its rate."""
+        limiter = server.RateLimiter(2, 2)
+        self.assertEqual(limiter.acquire("a", now=0), 0)
+        self.assertEqual(limiter.acquire("a", now=0), 0)
+        self.assertAlmostEqual(limiter.acquire("a", now=0), 0.5)
+        self.assertEqual(limiter.acquire("a", now=0.5), 0)
+        self.assertEqual(limiter.acquire("b", now=0.5), 0)
+
+    def test_prune_keeps_active_buckets(self):
+        """Test pruning forgets only buckets that have fully refilled."""
+        limiter = server.RateLimiter(1, 1, max_keys=2)
+        limiter.acquire("idle", now=0)
+        limiter.acquire("busy", now=9.5)
+        limiter.acquire("new", now=10)
+        self.assertEqual(set(limiter.buckets), {"busy", "new"})
+
+    def test_fetch_all_budget(self):
+        """Test fetch all is throttled separately with a retry hint."""
+        alice, token = self.login("alice")
+        self.assertEqual(alice(create_fetch_message(token, "all")).type, "ok")
+        resp = alice(create_fetch_message(token, "all"))
+        self.assertEqual(resp.type, "error")
+        self.assertGreater(resp.retry_after, 0)
+        self.assertEqual(alice(create_fetch_message(token, "unread")).type, "ok")
+
+    def test_user_limit(self):
+        """Test a user exceeding its burst is throttled and counted in stats."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        results = [alice(create_direct_message(token, "spam", "bob", 1.0)).type for _ in range(4)]
+        self.assertEqual(results[:2], ["ok", "ok"])
+        self.assertEqual(results[-1], "error")
+        stats = self.raw_request(json.dumps({"stats": {}}))["response"]["stats"]
+        self.assertGreaterEqual(stats["throttled"]["directmessage"], 1)
+
+
+class TestArchival(ServerTestCase):
+    """Tests for moving old read messages to compressed archive segments."""
+
+    server_options = {"archive_after": 60, "archive_interval": 0}
+
+    def test_archive_keeps_unread_hot(self):
+        """Test only read and sent messages are archived and fetch all still returns them."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "one", "bob", 1.0))
+        alice(create_direct_message(token, "two", "bob", 1.0))
+        bob, bob_token = self.login("bob")
+        bob(create_fetch_message(bob_token, "all"))
+        alice(create_direct_message(token, "three", "bob", 1.0))
+
+        self.assertEqual(self.server.archive_messages(now=time.time() + 30), 0)
+        self.assertEqual(self.server.archive_messages(now=time.time() + 120), 5)
+        with open(self.server.users_path, encoding="utf-8") as f:
+            users = json.load(f)
+        self.assertEqual([m["message"] for m in users["bob"]["messages"]], ["three"])
+        self.assertEqual(users["alice"]["messages"], [])
+        self.assertEqual(len(self.server._segment_paths("bob")), 1)
+
+        self.assertEqual([m["message"] for m in bob(create_fetch_message(bob_token, "unread")).messages],
+                         ["three"])
+        self.assertEqual([m["message"] for m in bob(create_fetch_message(bob_token, "all")).messages],
+                         ["one", "two", "three"])
+        self.assertEqual(self.server.archive_messages(now=time.time() + 120), 1)
+        self.assertEqual(len(self.server._segment_paths("bob")), 2)
+        self.assertEqual(len(alice(create_fetch_message(token, "all")).messages), 3)
+
+
+    def test_dot_usernames_stay_inside_archive(self):
+        """Test "." and ".." get their own archive directories instead of the archive or store directory."""
+        for name in (".", "..", ""):
+            self.assertNotIn(server.archive_dir_name(name), (".", "..", ""))
+        self.login(".")
+        dots, token = self.login("..")
+        dots(create_direct_message(token, "hi", ".", 1.0))
+        self.assertEqual(self.server.archive_messages(now=time.time() + 120), 1)
+        self.assertEqual(self.server._user_archive("..").parent, self.server.archive_path)
+        self.assertEqual(len(self.server._segment_paths("..")), 1)
+        self.assertEqual(self.server._segment_paths("."), [])
+
+    def test_segments_written_without_store_lock(self):
+        """Test archive segments are compressed while other requests can still take the store lock."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "one", "bob", 1.0))
+        locked = []
+        write = self.server._write_segment_file
+
+        def checking_write(path, messages):
+            locked.append(server.users_file_lock.locked())
+            write(path, messages)
+
+        with patch.object(self.server, "_write_segment_file", side_effect=checking_write):
+            self.assertEqual(self.server.archive_messages(now=time.time() + 120), 1)
+        self.assertEqual(locked, [False])
+        self.assertEqual([m["message"] for m in alice(create_fetch_message(token, "all")).messages], ["one"])
+        self.assertEqual(list(self.server._user_archive("alice").iterdir()), self.server._segment_paths("alice"))
+
+
+class TestSearch(ServerTestCase):
+    """Tests for the search command and its inverted index."""
+
+    server_options = {"archive_after": 60, "archive_interval": 0}
+
+    def test_search_index(self):
+        """Test term, prefix and multi-word queries return the newest matches first."""
+        index = server.SearchIndex()
+        for i, text in enumerate(["Lunch today?", "lunchtime works", "dinner instead", "lunch and dinner"]):
+            index.add({"from": "bob", "message": text, "timestamp": str(i)})
+        self.assertEqual([m["message"] for m in index.search("lunch")], ["lunch and dinner", "Lunch today?"])
+        self.assertEqual(len(index.search("lunch*")), 3)
+        self.assertEqual([m["message"] for m in index.search("lun* DINNER")], ["lunch and dinner"])
+        self.assertEqual(len(index.search("lunch*", limit=1)), 1)
+        self.assertEqual(index.search("*"), [])
+
+    def test_search_command(self):
+        """Test search covers archived and newly sent messages."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "meet for lunch", "bob", 1.0))
+        self.server.archive_messages(now=time.time() + 120)
+        bob, bob_token = self.login("bob")
+        resp = bob(create_search_message(bob_token, "lunch"))
+        self.assertEqual([m["from"] for m in resp.messages], ["alice"])
+
+        alice(create_direct_message(token, "lunch at noon", "bob", 1.0))
+        resp = bob(create_search_message(bob_token, "lunch", 10))
+        self.assertEqual([m["message"] for m in resp.messages], ["lunch at noon", "meet for lunch"])
+        self.assertEqual(alice(create_search_message(token, "noon")).messages[0]["recipient"], "bob")
+        self.assertEqual(bob(create_search_message("bogus", "lunch")).type, "error")
+        resp = bob(json.dumps({"search": {"query": "lunch", "limit": True}, "token": bob_token}))
+        self.assertEqual(resp.type, "error")
+
+    def test_search_orders_unread_before_newer_archived(self):
+        """Test an old unread message kept hot is still ranked below newer archived ones."""
+        bob, bob_token = self.login("bob")
+        alice, token = self.login("alice")
+        bob(create_direct_message(bob_token, "lunch first", "alice", 1.0))
+        alice(create_direct_message(token, "lunch second", "bob", 1.0))
+        self.assertEqual(self.server.archive_messages(now=time.time() + 120), 2)
+        self.assertEqual(len(self.server._segment_paths("alice")), 1)
+        resp = alice(create_search_message(token, "lunch"))
+        self.assertEqual([m["message"] for m in resp.messages], ["lunch second", "lunch first"])
+
+
+class TestConversation(ServerTestCase):
+    """Tests for the thread index and paged conversation fetch."""
+
+    def test_thread_index_pages(self):
+        """Test pages run backwards through a thread and late messages are ordered by time."""
+        index = server.ThreadIndex()
+        for i in (1, 2, 4, 5, 3):
+            index.add({"id": i, "from": "bob", "message": str(i), "timestamp": str(i), "status": "read"})
+        index.add({"id": 6, "recipient": "carol", "message": "x", "timestamp": "6", "status": "sent"})
+        page, cursor = index.page("bob", 2)
+        self.assertEqual(([m["message"] for m in page], cursor), (["4", "5"], 4))
+        page, cursor = index.page("bob", 2, cursor)
+        self.assertEqual(([m["message"] for m in page], cursor), (["2", "3"], 2))
+        page, cursor = index.page("bob", 2, cursor)
+        self.assertEqual(([m["message"] for m in page], cursor), (["1"], None))
+        self.assertEqual(index.page("dave", 2), ([], None))
+        self.assertEqual(index.page("bob", 2, 6), ([], None))
+        self.assertEqual(index.page("bob", 2, 99), ([], None))
+
+    def test_thread_cursor_survives_late_messages(self):
+        """Test a late message inserted while paging neither repeats nor skips messages."""
+        index = server.ThreadIndex()
+        for i in range(1, 7):
+            index.add({"id": i, "from": "bob", "message": str(i), "timestamp": str(i), "status": "read"})
+        page, cursor = index.page("bob", 2)
+        self.assertEqual([m["message"] for m in page], ["5", "6"])
+        index.add({"id": 7, "from": "bob", "message": "late", "timestamp": "2.5", "status": "read"})
+        index.add({"id": 8, "from": "bob", "message": "tie", "timestamp": "5", "status": "read"})
+        page, cursor = index.page("bob", 3, cursor)
+        self.assertEqual([m["message"] for m in page], ["late", "3", "4"])
+        page, cursor = index.page("bob", 3, cursor)
+        self.assertEqual(([m["message"] for m in page], cursor), (["1", "2"], None))
+
+    def test_fetch_conversation(self):
+        """Test a conversation is paged and picks up new messages in both directions."""
+        self.login("bob")
+        self.login("carol")
+        alice, token = self.login("alice")
+        for i in range(3):
+            alice(create_direct_message(token, f"to bob {i}", "bob", 1.0))
+        alice(create_direct_message(token, "to carol", "carol", 1.0))
+
+        bob, bob_token = self.login("bob")
+        resp = bob(create_conversation_message(bob_token, "alice", 2))
+        self.assertEqual([m["message"] for m in resp.messages], ["to bob 1", "to bob 2"])
+        self.assertEqual(resp.cursor, resp.messages[0]["id"])
+        resp = bob(create_conversation_message(bob_token, "alice", 2, resp.cursor))
+        self.assertEqual(([m["message"] for m in resp.messages], resp.cursor), (["to bob 0"], None))
+
+        bob(create_direct_message(bob_token, "hi alice", "alice", 1.0))
+        resp = alice(create_conversation_message(token, "bob", 10))
+        self.assertEqual([m.get("recipient", m.get("from")) for m in resp.messages], ["bob"] * 4)
+        self.assertEqual(resp.messages[-1]["message"], "hi alice")
+        self.assertEqual(bob(create_fetch_message(bob_token, "unread")).messages[0]["message"], "to bob 0")
+        for args in ({"limit": 0}, {"limit": True}, {"before": False}):
+            resp = bob(json.dumps({"token": bob_token, "fetch": {"conversation": "alice", **args}}))
+            self.assertEqual(resp.type, "error")
+
+
+class TestMailboxVersions(ServerTestCase):
+    """Tests for mailbox versions, not modified answers and the response cache."""
+
+    def test_unread_not_modified(self):
+        """Test an unchanged mailbox is answered not_modified until a message arrives."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        bob, bob_token = self.login("bob")
+        alice(create_direct_message(token, "hi", "bob", 1.0))
+        resp = bob(create_fetch_message(bob_token, "unread"))
+        self.assertEqual((len(resp.messages), resp.version), (1, 2))
+        resp = bob(create_fetch_message(bob_token, "unread", resp.version))
+        self.assertEqual((resp.type, resp.version), ("not_modified", 2))
+        alice(create_direct_message(token, "again", "bob", 2.0))
+        resp = bob(create_fetch_message(bob_token, "unread", 2))
+        self.assertEqual([m["message"] for m in resp.messages], ["again"])
+
+    def test_reads_without_changes_do_not_save(self):
+        """Test fetches of an already read mailbox leave the store untouched."""
+        bob, bob_token = self.login("bob")
+        bob(create_fetch_message(bob_token, "unread"))
+        with patch.object(self.server, "_save_users") as save:
+            bob(create_fetch_message(bob_token, "unread"))
+            bob(create_fetch_message(bob_token, "all"))
+        save.assert_not_called()
+
+    def test_fetch_all_cached_until_write(self):
+        """Test repeated fetch all responses are served from the cache until the mailbox changes."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "hi", "bob", 1.0))
+        bob, bob_token = self.login("bob")
+        first = bob(create_fetch_message(bob_token, "all"))
+        with patch.object(self.server, "_read_all_messages") as read:
+            second = bob(create_fetch_message(bob_token, "all"))
+        read.assert_not_called()
+        self.assertEqual((second.messages, second.version), (first.messages, first.version))
+        alice(create_direct_message(token, "again", "bob", 2.0))
+        resp = bob(create_fetch_message(bob_token, "all"))
+        self.assertEqual(len(resp.messages), 2)
+        self.assertGreater(resp.version, first.version)
+
+
+class TestBinaryFraming(ServerTestCase):
+    """Tests for negotiating and serving the binary encoding."""
+
+    def test_negotiate_and_fetch(self):
+        """Test a client that offers dspb1 can fetch with binary frames."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "hi bob", "bob", 1.0))
+
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        self.connections.append(sock)
+        send = sock.makefile("wb")
+        recv = sock.makefile("rb")
+        send.write(create_auth_message("bob", "pw", ["dspb1"]).encode() + b"\r\n")
+        send.flush()
+        resp = extract_json(read_message(recv))
+        self.assertEqual(resp.encoding, "dspb1")
+
+        send.write(encode_frame(json.loads(create_fetch_message(resp.token, "all"))))
+        send.flush()
+        frame = read_message(recv)
+        self.assertTrue(frame[0] & 0x80)
+        messages = extract_json(frame).messages
+        self.assertEqual(messages[0]["from"], "alice")
+        self.assertIsInstance(messages[0]["timestamp"], float)
+
+    def test_zlib_compresses_large_responses(self):
+        """Test a client that accepts zlib gets large responses compressed."""
+        self.server.compress_threshold = 50
+        self.login("bob")
+        alice, token = self.login("alice")
+        for i in range(20):
+            alice(create_direct_message(token, f"message {i}", "bob", 1.0))
+
+        sock = socket.create_connection(("127.0.0.1", self.server.port), timeout=5)
+        self.connections.append(sock)
+        send = sock.makefile("wb")
+        recv = sock.makefile("rb")
+        send.write(create_auth_message("bob", "pw", ["zlib"]).encode() + b"\r\n")
+        send.flush()
+        resp = extract_json(recv.readline())  # the negotiation reply itself is never compressed
+        self.assertEqual(resp.compression, "zlib")
+        send.write(create_fetch_message(resp.token, "all").encode() + b"\r\n")
+        send.flush()
+        data = read_message(recv)
+        self.assertTrue(data[0] & 0x01)
+        self.assertEqual(len(extract_json(data).messages), 20)
+
+    def test_json_clients_unchanged(self):
+        """Test clients that do not offer an encoding get no encoding field."""
+        resp = self.raw_request(create_auth_message("alice", "pw"))["response"]
+        self.assertNotIn("encoding", resp)
+
+
+class TestReplication(ServerTestCase):
+    """Tests for a follower replicating the store of a primary."""
+
+    server_options = {"replication_address": ("127.0.0.1", 0), "replication_key": b"secret",
+                      "archive_after": 60, "archive_interval": 0, "stats_interval": 0}
+
+    def setUp(self):
+        """Start the primary with one user and a follower of it."""
+        super().setUp()
+        self.login("bob")
+        self.follower_dir = tempfile.TemporaryDirectory()
+        self.follower = server.DSUServer("127.0.0.1", 0, self.follower_dir.name, stats_interval=0,
+                                         follow_address=self.server.replication_address,
+                                         replication_key=b"secret")
+        self.follower_thread = threading.Thread(target=self.follower.start_server, daemon=True)
+        self.follower_thread.start()
+        self.assertTrue(self.follower.ready.wait(5))
+
+    def tearDown(self):
+        """Stop the follower, then the primary."""
+        self.follower.stop()
+        self.follower_thread.join(5)
+        self.follower_dir.cleanup()
+        super().tearDown()
+
+    def wait_for_follower(self):
+        """Wait until the follower has applied every mutation of the primary."""
+        deadline = time.time() + 5
+        while self.follower.replication_seq != self.server.replication_seq \
+                or self.follower.replication_epoch != self.server.replication_epoch:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_follower_serves_replicated_reads(self):
+        """Test snapshot and streamed mutations reach the follower and its reads leave messages unread."""
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "one", "bob", 1.0))
+        alice(create_direct_message(token, "two", "bob", 1.0))
+        self.wait_for_follower()
+
+        bob, bob_token = self.login("bob", port=self.follower.port)
+        resp = bob(create_fetch_message(bob_token, "all"))
+        self.assertEqual([(m["id"], m["message"]) for m in resp.messages], [(1, "one"), (2, "two")])
+        self.assertEqual(bob(create_search_message(bob_token, "two")).messages[0]["message"], "two")
+        primary_bob, primary_token = self.login("bob")
+        unread = primary_bob(create_fetch_message(primary_token, "unread"))
+        self.assertEqual(len(unread.messages), 2)
+
+        self.wait_for_follower()
+        self.assertEqual(bob(create_fetch_message(bob_token, "all")).version, unread.version)
+        self.server.archive_messages(now=time.time() + 120)
+        self.wait_for_follower()
+        self.assertEqual(len(self.follower._segment_paths("bob")), 1)
+        self.assertEqual(len(bob(create_fetch_message(bob_token, "all")).messages), 2)
+
+    def test_follower_recovers_from_failed_batch(self):
+        """Test a batch the follower cannot apply makes it reload a snapshot instead of stopping."""
+        self.wait_for_follower()
+        apply = self.follower._apply_mutations
+        failures = []
+
+        def failing_apply(entries):
+            if not failures:
+                failures.append(entries)
+                raise KeyError("bob")
+            apply(entries)
+
+        with patch.object(self.follower, "_apply_mutations", side_effect=failing_apply):
+            alice, token = self.login("alice")
+            alice(create_direct_message(token, "one", "bob", 1.0))
+            self.wait_for_follower()
+        self.assertEqual(len(failures), 1)
+        bob, bob_token = self.login("bob", port=self.follower.port)
+        self.assertEqual([m["message"] for m in bob(create_fetch_message(bob_token, "all")).messages], ["one"])
+
+    def test_fetch_survives_snapshot_reload(self):
+        """Test a fetch whose listed segments are swapped out by a snapshot reload lists them again."""
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "one", "bob", 1.0))
+        self.server.archive_messages(now=time.time() + 120)
+        self.wait_for_follower()
+        iter_archive = self.follower._iter_archive
+        reloads = []
+
+        def reloading_iter(segments):
+            if not reloads:
+                reloads.append(segments)
+                self.follower._load_snapshot(self.server.replication_epoch, *self.server._snapshot())
+                raise FileNotFoundError(segments[0])
+            return iter_archive(segments)
+
+        with patch.object(self.follower, "_iter_archive", side_effect=reloading_iter):
+            follower_alice, follower_token = self.login("alice", port=self.follower.port)
+            resp = follower_alice(create_fetch_message(follower_token, "all"))
+        self.assertEqual(len(reloads), 1)
+        self.assertEqual([m["message"] for m in resp.messages], ["one"])
+        archive = self.follower.archive_path
+        self.assertEqual(sorted(os.listdir(archive.parent)), sorted(["users.json", archive.name]))
+        self.assertEqual(len(self.follower._segment_paths("alice")), 1)
+
+    def test_snapshot_reads_segments_without_store_lock(self):
+        """Test only users.json is read under the store lock when a snapshot is taken."""
+        alice, token = self.login("alice")
+        alice(create_direct_message(token, "one", "bob", 1.0))
+        self.server.archive_messages(now=time.time() + 120)
+        read_bytes = pathlib.Path.read_bytes
+        locked = {}
+
+        def checking_read(path):
+            locked[path.name] = server.users_file_lock.locked()
+            return read_bytes(path)
+
+        with patch.object(pathlib.Path, "read_bytes", checking_read):
+            _, _, archive = self.server._snapshot()
+        self.assertEqual(list(archive), ["alice/000000.jsonl.gz"])
+        self.assertEqual(locked, {self.server.users_path.name: True, "000000.jsonl.gz": False})
+
+    def test_follower_is_read_only(self):
+        """Test the follower refuses writes and unknown users."""
+        self.wait_for_follower()
+        bob, token = self.login("bob", port=self.follower.port)
+        resp = bob(create_direct_message(token, "hi", "bob", 1.0))
+        self.assertEqual((resp.type, resp.message), ("error", server.READ_ONLY_MESSAGE))
+        self.assertEqual(bob(create_fetch_message(token, "unread")).type, "error")
+        carol = self.connect(self.follower.port)
+        self.assertEqual(carol(create_auth_message("carol", "pw")).type, "error")
+
+    def test_lag_and_promotion(self):
+        """Test stats report replication lag and a promoted follower accepts writes."""
+        self.login("alice")
+        self.wait_for_follower()
+        stats = self.raw_request(json.dumps({"stats": {}}))["response"]["stats"]["replication"]
+        self.assertEqual(stats["role"], "primary")
+        status = self.follower.replication_status()
+        self.assertEqual((status["role"], status["lag_mutations"]), ("follower", 0))
+        self.assertTrue(status["connected"])
+
+        self.server.stop()
+        self.thread.join(5)
+        sock = socket.create_connection(("127.0.0.1", self.follower.port), timeout=5)
+        self.connections.append(sock)
+        sock.sendall(json.dumps({"promote": {}}).encode() + b"\r\n")
+        self.assertEqual(json.loads(sock.makefile("r").readline())["response"]["type"], "ok")
+        self.assertEqual(self.follower.role, "primary")
+        self.assertFalse(self.follower.promote())
+
+        alice, token = self.login("alice", port=self.follower.port)
+        self.assertEqual(alice(create_direct_message(token, "still here", "bob", 1.0)).type, "ok")
+        self.login("carol", port=self.follower.port)
+
+
+class TestDSUCluster(unittest.TestCase):
+    """Tests for the multi-process, user-partitioned server."""
+
+    def setUp(self):
+        """Start a two-process cluster in a background thread."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cluster = server.DSUCluster("127.0.0.1", 0, self.tmpdir.name, processes=2, stats_interval=0)
+        self.thread = threading.Thread(target=self.cluster.start_server, daemon=True)
+        self.thread.start()
+        self.assertTrue(self.cluster.ready.wait(10))
+        self.connections = []
+
+    def tearDown(self):
+        """Stop the cluster and remove the store."""
+        for conn in self.connections:
+            conn.close()
+        self.cluster.stop()
+        self.thread.join(15)
+        self.tmpdir.cleanup()
+
+    def login(self, username):
+        """Open a connection and authenticate, returning (request, token)."""
+        sock = socket.create_connection(("127.0.0.1", self.cluster.port), timeout=10)
+        self.connections.append(sock)
+        send = sock.makefile("w")
+        recv = sock.makefile("r")
+
+        def request(payload):
+            send.write(payload + "\r\n")
+            send.flush()
+            return extract_json(recv.readline())
+
+        resp = request(create_auth_message(username, "pw"))
+        self.assertEqual(resp.type, "ok")
+        return request, resp.token
+
+    def test_users_are_partitioned(self):
+        """Test each user is stored only in the shard of its partition."""
+        self.assertNotEqual(server.partition_of("alice", 2), server.partition_of("bob", 2))
+        self.login("alice")
+        self.login("bob")
+        shard = self.cluster.shard_path(server.partition_of("alice", 2))
+        with open(shard / "users.json", encoding="utf-8") as f:
+            self.assertEqual(list(json.load(f)), ["alice"])
+
+    def test_silent_connections_do_not_stall_logins(self):
+        """Test clients that connect and send nothing do not hold up other logins."""
+        for _ in range(8):
+            self.connections.append(socket.create_connection(("127.0.0.1", self.cluster.port), timeout=10))
+        start = time.monotonic()
+        self.login("alice")
+        self.assertLess(time.monotonic() - start, 2)
+
+    def test_cross_partition_message(self):
+        """Test a direct message is forwarded to the partition owning the recipient."""
+        self.login("bob")
+        alice, token = self.login("alice")
+        self.assertEqual(alice(create_direct_message(token, "hi bob", "bob", 1.0)).type, "ok")
+        self.assertEqual(alice(create_direct_message(token, "hi?", "nobody", 1.0)).type, "error")
+
+        bob, bob_token = self.login("bob")
+        resp = bob(create_fetch_message(bob_token, "unread"))
+        self.assertEqual([(m["from"], m["message"]) for m in resp.messages], [("alice", "hi bob")])
+        sent = alice(create_fetch_message(token, "all")).messages
+        self.assertEqual([m["recipient"] for m in sent], ["bob"])
+
+
+
+class TestClusterSharding(unittest.TestCase):
+    """Tests for splitting a single-process store into shards on cluster start."""
+
+    def setUp(self):
+        """Write a single-process store with two users."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.users = {"alice": {"password": "a", "messages": []}, "bob": {"password": "b", "messages": []}}
+        with open(os.path.join(self.tmpdir.name, "users.json"), "w", encoding="utf-8") as f:
+            json.dump(self.users, f)
+
+    def tearDown(self):
+        """Remove the store."""
+        self.tmpdir.cleanup()
+
+    def test_existing_store_is_split(self):
+        """Test every user lands in its partition's shard and the old store is kept aside."""
+        cluster = server.DSUCluster("127.0.0.1", 0, self.tmpdir.name, processes=2)
+        cluster.prepare_shards()
+        for username, record in self.users.items():
+            shard = cluster.shard_path(server.partition_of(username, 2))
+            with open(shard / "users.json", encoding="utf-8") as f:
+                self.assertEqual(json.load(f)[username], record)
+        self.assertEqual(sorted(os.listdir(self.tmpdir.name)), ["shard-0", "shard-1", "users.json.migrated"])
+        cluster.prepare_shards()  # Already sharded, nothing to do
+
+    def test_refuses_other_partition_count(self):
+        """Test a store sharded for another number of processes is refused."""
+        server.DSUCluster("127.0.0.1", 0, self.tmpdir.name, processes=2).prepare_shards()
+        with self.assertRaises(RuntimeError):
+            server.DSUCluster("127.0.0.1", 0, self.tmpdir.name, processes=3).prepare_shards()
+
+
+if __name__ == '__main__':
+    unittest.main()